@@ -89,6 +89,9 @@ kwargs = {
     'author' : 'Matteo Bastiani, Martin Craig',
     'author_email' : 'martin.craig@nottingham.ac.uk',
     'install_requires' : get_requirements(module_dir),
+    'extras_require' : {
+        'indexed_gzip' : ['indexed_gzip'],
+    },
     'packages' : find_packages(),
     'package_data' : {
         'squat.images': ['logos.png']
@@ -17,6 +17,13 @@ from eddy_qc.QUAD import (quad_tables, quad_mot, quad_s2v_mot, quad_eddy,
                             quad_ol_mat, quad_cnr_maps, quad_cnr_msr, 
                             quad_avg_maps, quad_susc, quad_json)
 from eddy_qc.utils import (fslpy, utils, ref_page)
+from ..eddy.textfiles import read_eddy_text
+from ..utils.imageio import load_image
+from ..eddy.stats import mask_index, mask_bbox, masked_volume_stats, uncrop
+from ..eddy.acquisition import acquisition_summary
+from ..eddy.outliers import outlier_counts
+from ..eddy.motion import excitation_mask, s2v_variance
+from ..eddy.volumes import DEFAULT_PRECISION, DEFAULT_BLOCK_SIZE, accumulate, ShellMeans, ShellPeMeans
 
 
 #=========================================================================================
@@ -74,7 +81,7 @@ def main(eddyBase, eddyIdx, eddyParams, mask, bvalsFile, bvecsFile, oDir, field,
         if eddyPara.ndim > 1:
             tmp_eddyPara = np.ascontiguousarray(eddyPara).view(np.dtype((np.void, eddyPara.dtype.itemsize * eddyPara.shape[1])))
             _, idx, inv_idx = np.unique(tmp_eddyPara, return_index=True, return_inverse=True)
-            eddyIdxs = inv_idx[eddyIdxs-1]+1
+            eddyIdxs = inv_idx.ravel()[eddyIdxs-1]+1
             eddyPara = eddyPara[idx]
         eddyPara = eddyPara.flatten()
     else:
@@ -131,7 +138,7 @@ def main(eddyBase, eddyIdx, eddyParams, mask, bvalsFile, bvecsFile, oDir, field,
         out_dir = eddyBase + '.qc'
 
     # Load eddy corrected file and check for consistency between input dimensions
-    eddy_epi = nib.load(eddyFile)   
+    eddy_epi = load_image(eddyFile)   
     if eddy_epi.shape[3] != np.max(bvals.shape):
         raise ValueError('Number of elements in bvals does not appear to be consistent with EDDY corrected file')
     elif eddy_epi.shape[3] != np.max(eddyIdxs.shape):
@@ -158,17 +165,13 @@ def main(eddyBase, eddyIdx, eddyParams, mask, bvalsFile, bvecsFile, oDir, field,
     # Get data info and fill data dictionary
     #=========================================================================================
     rounded_bvals = utils.round_bvals(bvals)
-    unique_bvals, counts = np.unique(rounded_bvals.astype(int), return_counts=True)
-    
-    unique_pedirs, counts_pedirs = np.unique(eddyIdxs, return_counts=True)
-    protocol = np.full((unique_pedirs.size,unique_bvals.size), -1, dtype=int)
-    c_b = 0
-    for b in unique_bvals:
-        c_p = 0
-        for p in unique_pedirs:
-            protocol[c_p, c_b] = ((rounded_bvals==b) & (eddyIdxs==p)).sum()
-            c_p = c_p + 1
-        c_b = c_b + 1
+    acq = acquisition_summary(rounded_bvals, eddyIdxs)
+    unique_bvals, shell_idx, counts = acq['unique_bvals'], acq['shell_idx'], acq['shell_counts']
+    unique_pedirs, pe_idx, counts_pedirs = acq['unique_pedirs'], acq['pe_idx'], acq['pe_counts']
+    protocol = acq['protocol']
+    # Index of each volume into the diffusion weighted shells, -1 for b=0 volumes
+    dw_shells = unique_bvals > 100
+    dw_shell_idx = np.where(dw_shells[shell_idx], shell_idx - np.count_nonzero(~dw_shells), -1)
     data = {
         'subj_id':eddyFile,
         'mask_id':mask,
@@ -184,6 +187,7 @@ def main(eddyBase, eddyIdx, eddyParams, mask, bvalsFile, bvecsFile, oDir, field,
         'bvecs':bvecs,
         'unique_bvals':unique_bvals[unique_bvals > 100],
         'bvals_dirs':counts[unique_bvals > 100],
+        'dw_shell_idx':dw_shell_idx,
         'eddy_idxs':eddyIdxs,
         'eddy_para':eddyPara,
         'unique_pedirs':unique_pedirs,
@@ -191,8 +195,23 @@ def main(eddyBase, eddyIdx, eddyParams, mask, bvalsFile, bvecsFile, oDir, field,
         'vol_size':eddy_epi.shape,
         'vox_size':np.array(eddy_epi.header.get_zooms()),
         'eddy_epi':eddy_epi,
-        'mask':mask_vol.get_data(),
+        'mask':np.asanyarray(mask_vol.dataobj),
     }
+    # Only the mask bounding box is read for image statistics and mean volumes
+    bbox = mask_bbox(data['mask'])
+    mask_idx = mask_index(data['mask'][bbox])
+
+    # Mean volume of each shell and mean b0 volume of each PE direction for the report
+    # pages, computed in a single pass over the data
+    b0_shell = np.flatnonzero(unique_bvals == 0)
+    accumulators = [ShellMeans(unique_bvals.size)]
+    if b0_shell.size:
+        accumulators.append(ShellPeMeans(b0_shell[0], unique_pedirs.size))
+    means = accumulate(eddy_epi, accumulators, shell_idx, pe_idx, block_size=DEFAULT_BLOCK_SIZE, precision=DEFAULT_PRECISION, bbox=bbox)
+    means = [uncrop(mean, bbox, eddy_epi.shape) for mean in means]
+    data['bval_means'] = {b : means[0][..., i] for i, b in enumerate(unique_bvals)}
+    if b0_shell.size:
+        data['b0_pe_means'] = [means[1][..., i] for i in range(unique_pedirs.size)]
     
     
     #=========================================================================================
@@ -249,7 +268,7 @@ def main(eddyBase, eddyIdx, eddyParams, mask, bvalsFile, bvecsFile, oDir, field,
         eddyOutput['motionFlag'] = True
         if verbose:
             print('RMS movement estimates file detected')
-        eddyOutput['motion'] = np.genfromtxt(motionFile,dtype=float)
+        eddyOutput['motion'] = read_eddy_text(motionFile)
         eddyOutput['avg_abs_mot'] = np.mean(eddyOutput['motion'][:,0])
         eddyOutput['avg_rel_mot'] = np.mean(eddyOutput['motion'][:,1])
     
@@ -257,7 +276,7 @@ def main(eddyBase, eddyIdx, eddyParams, mask, bvalsFile, bvecsFile, oDir, field,
         eddyOutput['paramsFlag'] = True
         if verbose:
             print('Eddy parameters file detected')
-        eddyOutput['params'] = np.genfromtxt(paramsFile, dtype=float)
+        eddyOutput['params'] = read_eddy_text(paramsFile)
         eddyOutput['avg_params'][0:6] = np.mean(eddyOutput['params'][:,0:6], axis=0)
         eddyOutput['avg_params'][6:9] = np.std(eddyOutput['params'][:,6:9], axis=0)
          
@@ -267,71 +286,47 @@ def main(eddyBase, eddyIdx, eddyParams, mask, bvalsFile, bvecsFile, oDir, field,
             print('Eddy s2v movement file detected')
             if slspecFile is None:
                 print('Warning: slspec file not provided. Assuming one excitation per slice.')
-        eddyOutput['s2vParams'] = np.genfromtxt(s2vParamsFile, dtype=float)
+        eddyOutput['s2vParams'] = read_eddy_text(s2vParamsFile)
         eddyOutput['s2vParams'][:,3:6] = np.rad2deg(eddyOutput['s2vParams'][:,3:6])
-        n_vox_thr = 240 # Minimum number of voxels in a masked slice
-        if slspecFile is not None:
-            n_ex = slspec.shape[0]
-            if slspec.ndim > 1:
-                mb = eddyOutput['s2vParams'].shape[1] # Multiband factor
-                ex_check = np.arange(0,n_ex)
-            else:
-                mb = 1
-                ex_check = np.where(np.sum(np.sum(data['mask'][:,:,slspec], axis=0), axis=0) > n_vox_thr)
-                print(ex_check)
-        else:
-            mb = 1
-            n_ex = data['vol_size'][2]
-            ex_check = np.arange(0,n_ex)
+        n_ex, ex_mask = excitation_mask(slspec if slspecFile is not None else None, data['mask'], data['vol_size'][2])
         if (n_ex * data['bvals'].size) != eddyOutput['s2vParams'].shape[0]:
             print('Warning: number of s2v parameters does not match the expected one! Skipping s2v QC...')
             eddyOutput['s2vFlag'] = False
         else:
-            for i in np.arange(0, data['bvals'].size):
-                tmp = eddyOutput['s2vParams'][i*n_ex:(i+1)*n_ex]
-                eddyOutput['var_s2v_params'][i] = np.var(tmp[ex_check], ddof=1, axis=0)
+            eddyOutput['var_s2v_params'] = s2v_variance(eddyOutput['s2vParams'], data['bvals'].size, ex_mask)
             eddyOutput['avg_std_s2v_params'] = np.sqrt(np.mean(eddyOutput['var_s2v_params'], axis=0))
             
     if os.path.isfile(olMapFile):
         eddyOutput['olFlag'] = True
         if verbose:
             print('Outliers outuput files detected')
-        eddyOutput['olMap'] = np.genfromtxt(olMapFile,dtype=None, delimiter=" ", skip_header=1)
-        eddyOutput['olMap_std'] = np.genfromtxt(eddyBase + '.eddy_outlier_n_stdev_map', dtype=float, delimiter=" ", skip_header=1)
+        eddyOutput['olMap'] = read_eddy_text(olMapFile)
+        eddyOutput['olMap_std'] = read_eddy_text(eddyBase + '.eddy_outlier_n_stdev_map')
         eddyOutput['tot_ol'] = 100*np.count_nonzero(eddyOutput['olMap'])/(data['no_dw_vols']*data['vol_size'][2])
-        for i in range(0, data['unique_bvals'].size):
-            eddyOutput['b_ol'][i] = 100*np.count_nonzero(eddyOutput['olMap'][data['bvals'] == data['unique_bvals'][i], :])/(data['bvals_dirs'][i]*data['vol_size'][2])
-        for i in range(0, data['no_PE_dirs']):
-            eddyOutput['pe_ol'][i] = 100*np.count_nonzero(eddyOutput['olMap'][data['eddy_idxs'] == data['unique_pedirs'][i],:])/(data['pedirs_count'][i]*data['vol_size'][2])
+        ol_counts = outlier_counts(eddyOutput['olMap'], shell_idx, pe_idx, unique_bvals.size, unique_pedirs.size)
+        eddyOutput['b_ol'] = 100*ol_counts['shell_pe'][unique_bvals > 100].sum(axis=1)/(data['bvals_dirs']*data['vol_size'][2])
+        eddyOutput['pe_ol'] = 100*ol_counts['shell_pe'].sum(axis=0)/(data['pedirs_count']*data['vol_size'][2])
         
     if os.path.isfile(cnrFile):
         eddyOutput['cnrFlag'] = True
         eddyOutput['cnrFile'] = cnrFile
         if verbose:
             print('CNR outuput files detected')
-        cnrImg = nib.load(cnrFile)
-        cnr = cnrImg.get_data()
-        if np.count_nonzero(np.isnan(cnr)):
+        cnrImg = load_image(cnrFile)
+        cnr_stats = masked_volume_stats(cnrImg, mask_idx, precision=DEFAULT_PRECISION, bbox=bbox)
+        if np.count_nonzero(cnr_stats['num_nan']):
             print("!!!Warning!!! NaNs detected in the CNR maps!!!")
-        finiteMask = (data['mask'] != 0) * np.isfinite(cnr[:,:,:,0])
-        eddyOutput['avg_cnr'][0] = round(np.nanmean(cnr[:,:,:,0][finiteMask]), 2)
-        eddyOutput['std_cnr'][0] = round(np.nanstd(cnr[:,:,:,0][finiteMask]), 2)
-        for i in range(0,data['unique_bvals'].size):
-            finiteMask = (data['mask'] != 0) * np.isfinite(cnr[:,:,:,i+1])
-            eddyOutput['avg_cnr'][i+1] = round(np.nanmean(cnr[:,:,:,i+1][finiteMask]), 2)
-            eddyOutput['std_cnr'][i+1] = round(np.nanstd(cnr[:,:,:,i+1][finiteMask]), 2)
+        for i in range(0,data['unique_bvals'].size+1):
+            eddyOutput['avg_cnr'][i] = round(cnr_stats['mean'][i], 2)
+            eddyOutput['std_cnr'][i] = round(cnr_stats['std'][i], 2)
 
     if os.path.isfile(rssFile):
         eddyOutput['rssFlag'] = True
         if verbose:
             print('Eddy residuals file detected')
         eddyOutput['rssFile'] = rssFile
-        rssImg = nib.load(rssFile)
-        rss = rssImg.get_data()
-        for i in range(0,data['bvals'].size):
-            eddyOutput['avg_rss'][i] = np.mean(np.power(rss[:,:,:,i][data['mask'] != 0.0], 2))
-        rssImg.uncache()
-        del rss
+        rssImg = load_image(rssFile)
+        eddyOutput['avg_rss'] = masked_volume_stats(rssImg, mask_idx, precision=DEFAULT_PRECISION, bbox=bbox)['mean_sq']
         np.savetxt(data['qc_path'] + '/eddy_msr.txt', np.reshape(eddyOutput['avg_rss'], (1,-1)), fmt='%f', delimiter=' ')
     
     if os.path.isfile(fieldFile):
@@ -339,12 +334,10 @@ def main(eddyBase, eddyIdx, eddyParams, mask, bvalsFile, bvecsFile, oDir, field,
         if verbose:
             print('Topup fieldmap file detected')
         eddyOutput['fieldFile'] = fieldFile
-        fieldImg = nib.load(fieldFile)
-        fieldMap = fieldImg.get_data()
-        dispField = fieldMap*eddyPara[3]
-        eddyOutput['std_displacement'] = np.std(dispField[data['mask'] != 0.0])
-        fieldImg.uncache()
-        del fieldMap
+        fieldImg = load_image(fieldFile)
+        # Displacement is the field scaled by the readout time
+        field_stats = masked_volume_stats(fieldImg, mask_idx, precision=DEFAULT_PRECISION, bbox=bbox)
+        eddyOutput['std_displacement'] = field_stats['std'][0]*abs(eddyPara[3])
         
     
     # Stop if motion or parameters estimates are missing
@@ -33,7 +33,7 @@ def main(pdf, data, eddy):
 
     # Compute average b=0 volume
     # fslpy.select_dwi_vols(data=data['subj_id'], bvals=data['bvals_id'], output=data['qc_path'] + "/avg_b0", b=5, m=True)
-    vol = nib.Nifti1Image(np.mean(data['eddy_epi'].get_fdata()[..., data['bvals']==0], axis=3), data['eddy_epi'].get_affine(), data['eddy_epi'].header)
+    vol = nib.Nifti1Image(data['bval_means'][0], data['eddy_epi'].affine, data['eddy_epi'].header)
     nib.save(vol, data['qc_path'] + "/avg_b0.nii.gz")
     vol = vol.get_fdata()
     # Maximum intensity definition
@@ -53,7 +53,7 @@ def main(pdf, data, eddy):
     for b in data['unique_bvals']:
         # Compute average b=x volume
         # fslpy.select_dwi_vols(data=data['subj_id'], bvals=data['bvals_id'], output=data['qc_path'] + "/avg_b" + str(b), b=b, m=True)
-        vol = nib.Nifti1Image(np.mean(data['eddy_epi'].get_data()[..., data['bvals']==b], axis=3), data['eddy_epi'].get_affine(), data['eddy_epi'].header)
+        vol = nib.Nifti1Image(data['bval_means'][b], data['eddy_epi'].affine, data['eddy_epi'].header)
         nib.save(vol, data['qc_path'] + "/avg_b" + str(b) + ".nii.gz")
         vol = vol.get_data()
         i_max = np.round(np.mean(vol[:,:,:][data['mask'] != 0.0])+3*np.std(vol[:,:,:][data['mask'] != 0.0]))
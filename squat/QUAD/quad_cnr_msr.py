@@ -59,8 +59,8 @@ def main(pdf, data, eddy):
         gs01 = gridspec.GridSpecFromSubplotSpec(1+data['unique_bvals'].size, 1, subplot_spec=gs0[1])
         x = np.arange(data['bvals'].size)
         ax = plt.subplot(gs01[0, 0])
-        tmp_rss = eddy['avg_rss'][np.abs(data['bvals']) <= 100]
-        x_rss = x[np.abs(data['bvals']) <= 100]
+        tmp_rss = eddy['avg_rss'][data['dw_shell_idx'] < 0]
+        x_rss = x[data['dw_shell_idx'] < 0]
         idxs = np.array(np.where(tmp_rss > np.mean(tmp_rss) + 2*np.std(tmp_rss)))
         ax.plot(np.arange(1, 1+data['no_b0_vols']), tmp_rss, label="b=0")
         ax.scatter(idxs+1, np.ones(idxs.size)*np.max(tmp_rss)+200, s=50, c='r', marker='*', label='Outliers')
@@ -71,8 +71,8 @@ def main(pdf, data, eddy):
         ax.set_ylabel("MSR")
         ax.legend(loc='best', frameon=True, framealpha=0.5)
         for i in range(0, data['unique_bvals'].size):
-            tmp_rss = eddy['avg_rss'][np.abs(data['bvals']-data['unique_bvals'][i]) <= 100]
-            x_rss = x[np.abs(data['bvals']-data['unique_bvals'][i]) <= 100]
+            tmp_rss = eddy['avg_rss'][data['dw_shell_idx'] == i]
+            x_rss = x[data['dw_shell_idx'] == i]
             idxs = np.array(np.where(tmp_rss > np.mean(tmp_rss) + 2*np.std(tmp_rss)))
             ax = plt.subplot(gs01[i+1, 0])
             ax.set_ylabel("MSR")
@@ -1,6 +1,6 @@
 #!/usr/bin/env fslpython
 
-import json
+from ..utils.jsonio import write_json
 
 
 
@@ -36,38 +36,37 @@ def main(data, eddy, eddy_input):
         'data_file_eddy':data['subj_id'],
         'data_file_mask':data['mask_id'],
         'data_file_bvals':data['bvals_id'],
-        'data_no_dw_vols':data['no_dw_vols'].tolist(),
-        'data_no_b0_vols':data['no_b0_vols'].tolist(),
+        'data_no_dw_vols':data['no_dw_vols'],
+        'data_no_b0_vols':data['no_b0_vols'],
         'data_no_PE_dirs':data['no_PE_dirs'],
-        'data_protocol':data['protocol'].tolist(),
-        'data_no_shells':data['no_shells'].tolist(),
-        'data_unique_bvals':data['unique_bvals'].tolist(),
-        'data_unique_pes':data['unique_pedirs'].tolist(),
-        'data_eddy_para':data['eddy_para'].tolist(),
-        'data_vox_size':data['vox_size'][0:3].tolist(),
+        'data_protocol':data['protocol'],
+        'data_no_shells':data['no_shells'],
+        'data_unique_bvals':data['unique_bvals'],
+        'data_unique_pes':data['unique_pedirs'],
+        'data_eddy_para':data['eddy_para'],
+        'data_vox_size':data['vox_size'][0:3],
 
         'qc_path':data['qc_path'],
         'qc_mot_abs':round(eddy['avg_abs_mot'], 2),
         'qc_mot_rel':round(eddy['avg_rel_mot'], 2),
         'qc_params_flag':eddy['paramsFlag'],
-        'qc_params_avg':eddy['avg_params'].tolist(),
+        'qc_params_avg':eddy['avg_params'],
         'qc_s2v_params_flag':eddy['s2vFlag'],
-        'qc_s2v_params_avg_std':eddy['avg_std_s2v_params'].tolist(),
+        'qc_s2v_params_avg_std':eddy['avg_std_s2v_params'],
         'qc_field_flag':eddy['fieldFlag'],
-        'qc_vox_displ_std':eddy['std_displacement'].tolist(),
+        'qc_vox_displ_std':eddy['std_displacement'],
         'qc_ol_flag':eddy['olFlag'],
         'qc_outliers_tot':eddy['tot_ol'],
-        'qc_outliers_b':eddy['b_ol'].tolist(),
-        'qc_outliers_pe':eddy['pe_ol'].tolist(),
+        'qc_outliers_b':eddy['b_ol'],
+        'qc_outliers_pe':eddy['pe_ol'],
         'qc_cnr_flag':eddy['cnrFlag'],
-        'qc_cnr_avg':eddy['avg_cnr'].tolist(),
-        'qc_cnr_std':eddy['std_cnr'].tolist(),
+        'qc_cnr_avg':eddy['avg_cnr'],
+        'qc_cnr_std':eddy['std_cnr'],
         'qc_rss_flag':eddy['rssFlag'],
     }
 
-    # Write dictionary to json
-    with open(data['qc_path'] + '/qc.json', 'w') as fp:
-        json.dump(data_json, fp, sort_keys=True, indent=4, separators=(',', ': '))
+    # Write dictionary to json. Arrays are written directly by the JSON writer
+    write_json(data['qc_path'] + '/qc.json', data_json)
     
 
     
@@ -11,8 +11,88 @@ import math
 
 import numpy as np
 
+from .utils.jsonio import write_json
+from .utils.packbits import is_packed, packed_counts
+
 LOG = logging.getLogger(__name__)
 
+# QC field holding the bit-packed EDDY outlier map of a subject
+OUTLIER_MAP_KEY = "qc_outliers_map"
+
+# Suffix replacing the .json extension for the sidecar file of array-valued QC fields
+ARRAYS_SUFFIX = ".arrays.npz"
+
+def arrays_fname(json_fname):
+    """
+    :return: File name of the array sidecar for a JSON QC data file
+    """
+    return os.path.splitext(json_fname)[0] + ARRAYS_SUFFIX
+
+def is_array_ref(value):
+    """
+    :return: True if a JSON value is a reference to an array in a sidecar file
+    """
+    return isinstance(value, dict) and "npz" in value
+
+def save_arrays(data, json_fname):
+    """
+    Move numeric array-valued QC fields to a binary sidecar file
+
+    The sidecar is written next to the JSON file it belongs to, and each moved field
+    is replaced by a reference of the form ``{"npz" : <sidecar name>, "shape" : <shape>}``.
+    Other values are left unchanged - Numpy arrays are written directly by
+    :func:`squat.utils.jsonio.write_json`.
+
+    :param data: Dictionary of QC data
+    :param json_fname: Name of the JSON file the data will be written to
+    :return: Dictionary of QC data with references in place of arrays
+    """
+    sidecar_fname = arrays_fname(json_fname)
+    arrays, json_data = {}, {}
+    for k, v in data.items():
+        json_data[k] = v
+        if k.startswith("qc_") and isinstance(v, (list, np.ndarray)):
+            try:
+                arr = np.asarray(v)
+            except ValueError:
+                # Ragged lists
+                continue
+            if arr.ndim > 0 and arr.dtype.kind in "biuf":
+                arrays[k] = arr
+                json_data[k] = {"npz" : os.path.basename(sidecar_fname), "shape" : list(arr.shape)}
+
+    tmp_fname = sidecar_fname + f".{os.getpid()}.tmp"
+    with open(tmp_fname, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_fname, sidecar_fname)
+    return json_data
+
+def load_arrays(data, json_fname):
+    """
+    Replace references to arrays in a sidecar file with the arrays
+
+    :param data: Dictionary of QC data read from a JSON file
+    :param json_fname: Name of the JSON file. Sidecar names are relative to its directory
+    :return: Dictionary of QC data with arrays in place of references
+    """
+    refs = {k : v for k, v in data.items() if is_array_ref(v)}
+    if not refs:
+        return data
+    data = dict(data)
+    sidecars = {}
+    try:
+        for k, ref in refs.items():
+            sidecar_fname = os.path.join(os.path.dirname(json_fname), ref["npz"])
+            if sidecar_fname not in sidecars:
+                sidecars[sidecar_fname] = np.load(sidecar_fname, allow_pickle=False)
+            data[k] = sidecars[sidecar_fname][k]
+    except (OSError, KeyError, ValueError) as exc:
+        raise IOError(f"Could not read QC arrays referenced from {json_fname} : {exc}")
+    finally:
+        for sidecar in sidecars.values():
+            sidecar.close()
+    return data
+
 def read_json(fname, desc):
     try:
         with open(fname, 'r') as f:
@@ -26,9 +106,18 @@ class SubjectData(dict):
         LOG.debug(f"Subject {subjid} loading from {json_fnames}")
         self.subjid = subjid
         self.subjdir = subjdir
+        # JSON file which each array field stored in a sidecar file was referenced from.
+        # These are only read when the field is first accessed
+        self._array_refs = {}
         for fname in json_fnames:
             try:
-                self.update(read_json(fname, "subject QC"))
+                data = read_json(fname, "subject QC")
+                self.update(data)
+                for k, v in data.items():
+                    if is_array_ref(v):
+                        self._array_refs[k] = fname
+                    else:
+                        self._array_refs.pop(k, None)
             except IOError as exc:
                 LOG.warn(f"Failed to read subject QC data from {fname} - skipping this file")
 
@@ -41,6 +130,9 @@ class SubjectData(dict):
         for f in self:
             if not f.startswith("qc_"):
                 continue
+            elif f in self._array_refs:
+                # Sidecar arrays are always numeric
+                self.qc_fields.append(f[3:])
             elif isinstance(self[f], (int, float)) and not isinstance(self[f], bool):
                 self.qc_fields.append(f[3:])
             elif isinstance(self[f], list):
@@ -50,6 +142,24 @@ class SubjectData(dict):
                 except ValueError:
                     pass # Not numeric data
 
+    def __getitem__(self, key):
+        if key in self._array_refs:
+            # Load array from sidecar file on first access
+            json_fname = self._array_refs.pop(key)
+            try:
+                value = load_arrays({key : dict.__getitem__(self, key)}, json_fname)[key]
+                self[key] = np.array(value, dtype=np.float32).tolist()
+            except IOError as exc:
+                LOG.warn(f"Failed to read {key} for subject {self.subjid}: {exc}")
+                del self[key]
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
     def get_image(self, name):
         """
         Get image data for this subject
@@ -81,6 +191,14 @@ class SubjectData(dict):
             return np.atleast_1d([])
 
 class GroupData(dict):
+    """
+    Group QC data
+
+    QC fields are read as lists of per-subject values, as in the group JSON file.
+    The first time a field is requested with :meth:`get_data` the lists are replaced
+    by a single read-only float array [NSUBJS, NVALS], so reports do not convert
+    the lists again for every plot
+    """
     def __init__(self, fname=None, subject_datas=[]):
         dict.__init__(self)
         if fname and subject_datas:
@@ -94,21 +212,68 @@ class GroupData(dict):
         """
         Get group data values
 
-        :param vars: Name of QC variable (without the qc_ prefix) or list of variable names
-        :return: 2D Numpy array of values shape [NSUBJS, NVALS], empty if any of the variables could not be found
+        :param var: Name of QC variable (without the qc_ prefix)
+        :return: Read-only 2D Numpy array of values shape [NSUBJS, NVALS], empty if the
+                 variable could not be found
         """
-        try:
-            return np.atleast_2d(self['qc_' + var])
-        except KeyError:
+        key = 'qc_' + var
+        if key not in self:
             LOG.debug(f"Missing variables in group data - looking for {var}")
             return np.atleast_2d([])
 
-    def write(self, fname):
+        values = self[key]
+        if not isinstance(values, np.ndarray):
+            values = np.atleast_2d(np.array(values, dtype=float))
+            values.flags.writeable = False
+            self[key] = values
+        return values.view()
+
+    def get_outlier_maps(self):
+        """
+        Get bit-packed outlier maps
+
+        :return: List of bit-packed outlier map for each subject, None for subjects without one
+        """
+        return self.get(OUTLIER_MAP_KEY, [None] * self.get("data_num_subjects", 0))
+
+    def get_slice_outliers(self):
+        """
+        Get the number of outlier volumes in each slice of each subject
+
+        Counts are computed from the bit-packed outlier maps without unpacking them
+
+        :return: 2D Numpy array shape [NSUBJS, NSLICES], NaN for subjects without an outlier
+                 map and for slices beyond the number of slices of a subject
+        """
+        counts = [None if not is_packed(m) else packed_counts(m)[1] for m in self.get_outlier_maps()]
+        num_slices = max([c.size for c in counts if c is not None], default=0)
+        slice_outliers = np.full((len(counts), num_slices), np.nan)
+        for idx, subject_counts in enumerate(counts):
+            if subject_counts is not None:
+                slice_outliers[idx, :subject_counts.size] = subject_counts
+        return slice_outliers
+
+    def write(self, fname, compact=False, digits=None, field_digits=None):
         """
         Write group data to JSON file
+
+        Array-valued QC fields of single subject data are held at float32 precision and
+        are written with the shortest text which reproduces each float32 value.
+
+        :param compact: If True, write without indentation or line breaks
+        :param digits: Number of significant digits of floating point QC values. If None,
+                       values are written exactly
+        :param field_digits: Optional dictionary mapping field names or glob patterns to
+                             the number of significant digits for matching fields,
+                             overriding ``digits``
         """
-        with open(fname, 'w') as f:
-            json.dump(self, f, sort_keys=True, indent=4, separators=(',', ': '))
+        data = dict(self)
+        for key in self._float32_fields:
+            data[key] = [np.asarray(values, dtype=np.float32) for values in self[key]]
+        field_digits = dict(field_digits or {})
+        if digits is not None:
+            field_digits.setdefault("qc_*", digits)
+        write_json(fname, data, indent=None if compact else 4, field_digits=field_digits)
 
     def _read_subject_data(self, subject_datas):
         """
@@ -116,8 +281,10 @@ class GroupData(dict):
 
         :param subject_datas: Sequence of single subject QC data dictionaries
         """
-        # Get QC fields - these may not match for all subjects
+        # Get QC fields - these may not match for all subjects. Array-valued fields are
+        # float32 values
         self.qc_fields = set()
+        self._float32_fields = set()
         for idx, subject_data in enumerate(subject_datas):
             self.qc_fields.update(subject_data.qc_fields)
 
@@ -129,10 +296,17 @@ class GroupData(dict):
                 if key not in self:
                     self[key] = []
                 value = subject_data.get(key, None)
-                if value is not None and not isinstance(value, list):
+                if isinstance(value, list):
+                    self._float32_fields.add(key)
+                elif value is not None:
                     value = [value]
                 self[key].append(value)
 
+        # Bit-packed outlier maps are kept for each subject for cross-subject slice analysis
+        outlier_maps = [subject_data.get(OUTLIER_MAP_KEY, None) for subject_data in subject_datas]
+        if any(m is not None for m in outlier_maps):
+            self[OUTLIER_MAP_KEY] = outlier_maps
+
         # Get data fields which should match for all subjects
         self.data_fields = set()
         for idx, subject_data in enumerate(subject_datas):
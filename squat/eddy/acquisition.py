@@ -0,0 +1,48 @@
+"""
+SQUAT: Study-wise QUality Assessment Tool
+
+Summary of the acquisition protocol. Each volume is mapped to its shell and
+phase encoding direction once, and all counts are derived from those maps so
+that later stages can group volumes by index rather than by comparing
+b-values or EDDY indices
+
+Martin Craig, SPMIC, Nottingham
+"""
+import logging
+
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+def acquisition_summary(rounded_bvals, eddy_idxs):
+    """
+    Summarise the shells and phase encoding directions of an acquisition
+
+    :param rounded_bvals: 1D array of b-values for each volume, rounded to their shell
+    :param eddy_idxs: 1D array of EDDY acquisition parameter indices for each volume
+    :return: Dictionary containing ``unique_bvals`` (sorted shell b-values), ``shell_idx``
+             (shell index of each volume), ``shell_counts`` (number of volumes in each
+             shell), ``unique_pedirs`` (sorted EDDY indices), ``pe_idx`` (phase encoding
+             direction index of each volume), ``pe_counts`` (number of volumes in each
+             phase encoding direction) and ``protocol`` (number of volumes in each phase
+             encoding direction and shell [NPEDIRS, NSHELLS])
+    """
+    rounded_bvals, eddy_idxs = np.ravel(rounded_bvals), np.ravel(eddy_idxs)
+    if rounded_bvals.size != eddy_idxs.size:
+        raise ValueError(f"Number of b-values {rounded_bvals.size} does not match number of EDDY indices {eddy_idxs.size}")
+
+    unique_bvals, shell_idx, shell_counts = np.unique(rounded_bvals.astype(int), return_inverse=True, return_counts=True)
+    unique_pedirs, pe_idx, pe_counts = np.unique(eddy_idxs, return_inverse=True, return_counts=True)
+    shell_idx, pe_idx = shell_idx.ravel(), pe_idx.ravel()
+    # Each volume's (PE, shell) cell as a flat index so one bincount gives the protocol matrix
+    num_cells = unique_pedirs.size * unique_bvals.size
+    protocol = np.bincount(pe_idx * unique_bvals.size + shell_idx, minlength=num_cells)
+    return {
+        "unique_bvals" : unique_bvals,
+        "shell_idx" : shell_idx,
+        "shell_counts" : shell_counts,
+        "unique_pedirs" : unique_pedirs,
+        "pe_idx" : pe_idx,
+        "pe_counts" : pe_counts,
+        "protocol" : protocol.reshape(unique_pedirs.size, unique_bvals.size),
+    }
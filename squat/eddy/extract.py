@@ -9,17 +9,35 @@ Martin Craig, SPMIC, Nottingham
 """
 
 import argparse
+import concurrent.futures
+import cProfile
 import os
+import time
 import warnings
 import numpy as np
 import nibabel as nib
 import logging
 import json
 import sys
-
-import fsl.wrappers as fsl
-
-from . import utils
+import types
+
+from . import utils, manifest, memory, scheduler
+from .memory import format_memory
+from .stats import mask_index, mask_bbox
+from .acquisition import acquisition_summary
+from .volumes import PRECISIONS, DEFAULT_PRECISION, DEFAULT_BLOCK_SIZE
+from .stages import STAGES
+from ..utils.bvals import round_bvals_median
+from ..utils.imageio import load_image, configure_cache, configure_index_cache, CACHE_DIR_ENV, DEFAULT_CACHE_SIZE, INDEX_DIR_ENV
+from ..utils.jsonio import write_json, parse_digits
+from ..utils.rendercache import configure_render_cache, RENDER_CACHE_DIR_ENV, DEFAULT_RENDER_CACHE_SIZE
+from ..utils.perf import PerfRecorder, NullPerfRecorder
+from ..data import save_arrays, load_arrays, arrays_fname, ARRAYS_SUFFIX
+
+PROFILE_FNAME = "squat_profile.prof"
+
+# Methods of grouping b-values into shells
+BVAL_ROUNDING = ("nearest", "median")
 
 warnings.filterwarnings("ignore")
 
@@ -57,6 +75,43 @@ def _imgfile(fname):
         if os.path.isfile(img_fname):
             return img_fname
 
+def _get_parser(exit_on_error=True):
+    parser = argparse.ArgumentParser('SQUAT_EDDY - extract QC data from Eddy run', add_help=True, exit_on_error=exit_on_error)
+    parser.add_argument('--eddydir', help='Path to directory containing EDDY output. Required unless --subjects-file is given')
+    parser.add_argument('--subjects-file', help='Text file containing paths to multiple EDDY output directories, one per line')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of subjects to process in parallel when using --subjects-file')
+    parser.add_argument('--eddybase', help='Base name of EDDY output')
+    parser.add_argument('--idx', required=True, help='Path to text file containing indices for all volumes into acquisition parameters relative to eddydir')
+    parser.add_argument('--eddy-params', required=True, help='Path to file containing acquisition parameters relative to eddydir')
+    parser.add_argument('--mask', required=True, help="Binary mask file")
+    parser.add_argument('--bvals', required=True, help="BVALs file")
+    parser.add_argument('--bvecs', help="BVECs file")
+    parser.add_argument('--field', help="TOPUP estimated field (in Hz)")
+    parser.add_argument('--slspec', help="Text file specifying slice/group acquisition")
+    parser.add_argument('-o', '--output', help="Output directory - defaults to <eddydir>/<eddybase>.qc. With --subjects-file, output for each subject is written to a subdirectory named after its EDDY directory")
+    parser.add_argument('--overwrite', action="store_true", default=False, help='If specified, overwrite any existing output')
+    parser.add_argument('--incremental', action="store_true", default=False, help='If specified, reuse existing output and only recompute QC data whose input files have changed since the last run')
+    parser.add_argument('--block-size', type=int, help=f"Number of volumes to read at a time from 4D images. Defaults to {DEFAULT_BLOCK_SIZE}, or with --max-memory the largest number which fits")
+    parser.add_argument('--max-memory', help="Approximate memory limit, e.g. 4G or 512M. Image reads are sized to fit within it, and extraction fails before reading any image data if this is not possible")
+    parser.add_argument('--cache-dir', help=f"Directory in which to keep uncompressed copies of large compressed images so later runs can memory-map them rather than decompressing again, and decoded copies of EDDY text outputs. Defaults to the {CACHE_DIR_ENV} environment variable. If neither is set no cache is used")
+    parser.add_argument('--cache-size', default=format_memory(DEFAULT_CACHE_SIZE), help="Maximum total size of the image cache, e.g. 20G. Least recently used copies are removed to keep within it")
+    parser.add_argument('--index-dir', help=f"Directory in which to keep seek point indexes of compressed images so later runs can read any volume without decompressing from the start. Defaults to the {INDEX_DIR_ENV} environment variable, or squat/indexes in the user's cache directory")
+    parser.add_argument('--no-index-cache', action="store_true", default=False, help="Do not keep seek point indexes of compressed images between runs")
+    parser.add_argument('--render-cache-dir', help=f"Directory in which to keep rendered slice images so images of unchanged data are not rendered again. Defaults to the {RENDER_CACHE_DIR_ENV} environment variable. If neither is set no cache is used")
+    parser.add_argument('--render-cache-size', default=format_memory(DEFAULT_RENDER_CACHE_SIZE), help="Maximum total size of the render cache, e.g. 2G. Least recently used images are removed to keep within it")
+    parser.add_argument('--threads', type=int, default=1, help="Maximum number of extraction stages to run concurrently, and of threads each stage uses to read compressed images")
+    parser.add_argument('--precision', choices=PRECISIONS, default=DEFAULT_PRECISION, help="Precision of image statistics. float32 works on the stored data type and only uses float64 to accumulate sums")
+    parser.add_argument('--no-crop', action="store_true", default=False, help="Read the whole field of view of each image rather than only the bounding box of the mask. Mean images are then rendered with the full background")
+    parser.add_argument('--bval-rounding', choices=BVAL_ROUNDING, default="nearest", help="How b-values are grouped into shells. nearest rounds to the nearest 100, median rounds each cluster of b-values within 100 of each other to its median")
+    parser.add_argument('--signal-profiles', action="store_true", default=False, help="Include the mean in-mask signal of each volume (signal_vol) and of each slice of each volume (signal_slice_vol) in the QC data. Slices with no voxels in the mask have zero signal")
+    parser.add_argument('--array-sidecar', action="store_true", default=False, help=f"Write array-valued QC measures to a binary sidecar file qc{ARRAYS_SUFFIX} referenced from qc.json, rather than inline. Scalar measures are still written to qc.json")
+    parser.add_argument('--compact-json', action="store_true", default=False, help="Write qc.json without indentation or line breaks")
+    parser.add_argument('--json-digits', nargs="+", help="Number of significant digits of floating point values in qc.json, e.g. 6. A field name or glob pattern can be given to set the digits of matching fields, e.g. qc_outliers_*=3. By default values are written exactly")
+    parser.add_argument('--perf', action="store_true", default=False, help="Record wall time, CPU time, bytes read and peak memory of each extraction stage in the perf section of qc.json")
+    parser.add_argument('--profile', action="store_true", default=False, help=f"Record performance data as for --perf and also write Python profiler output to {PROFILE_FNAME} in the output directory")
+    parser.add_argument('--debug', action="store_true", default=False, help="Enable debug logging")
+    return parser
+
 def main():
     """
     Generate QC report data for single subject dMRI data
@@ -70,29 +125,205 @@ def main():
 
     The JSON file can then be read by squat to generate a group report.
 
+    Multiple EDDY directories can be processed in one invocation using --subjects-file,
+    optionally in parallel using --jobs.
+
     Output:
        output-dir/qc.pdf: single subject QC report 
        output-dir/qc.json: single subject QC and data info database
        output-dir/vols_no_outliers.txt: text file that contains the list of the non-outlier volumes (based on eddy residuals)
     """
-    parser = argparse.ArgumentParser('SQUAT_EDDY - extract QC data from Eddy run', add_help=True)
-    parser.add_argument('--eddydir', required=True, help='Path to directory containing EDDY output')
-    parser.add_argument('--eddybase', help='Base name of EDDY output')
-    parser.add_argument('--idx', required=True, help='Path to text file containing indices for all volumes into acquisition parameters relative to eddydir')
-    parser.add_argument('--eddy-params', required=True, help='Path to file containing acquisition parameters relative to eddydir')
-    parser.add_argument('--mask', required=True, help="Binary mask file")
-    parser.add_argument('--bvals', required=True, help="BVALs file")
-    parser.add_argument('--bvecs', help="BVECs file")
-    parser.add_argument('--field', help="TOPUP estimated field (in Hz)")
-    parser.add_argument('--slspec', help="Text file specifying slice/group acquisition")
-    parser.add_argument('-o', '--output', help="Output directory - defaults to <eddydir>/qc")
-    parser.add_argument('--overwrite', action="store_true", default=False, help='If specified, overwrite any existing output')
-    parser.add_argument('--debug', action="store_true", default=False, help="Enable debug logging")
+    parser = _get_parser()
     args = parser.parse_args()
+    if not args.eddydir and not args.subjects_file:
+        parser.error("Either --eddydir or --subjects-file must be given")
+    elif args.eddydir and args.subjects_file:
+        parser.error("Cannot specify --eddydir and --subjects-file at the same time")
 
     _setup_logging(args)
 
-    #def extract(eddyBase, eddyIdx, eddyParams, mask, bvalsFile, bvecsFile, oDir, field, slspecFile, verbose):
+    if args.subjects_file:
+        options = dict(vars(args))
+        eddydirs = _read_subjects_file(options.pop("subjects_file"))
+        options.pop("eddydir")
+        results = extract_batch(eddydirs, jobs=options.pop("jobs"), **options)
+        if not all(result["success"] for result in results):
+            sys.exit(1)
+    else:
+        _extract(args)
+
+def _read_subjects_file(fname):
+    try:
+        with open(fname) as fp:
+            return [l.strip() for l in fp.readlines() if l.strip()]
+    except IOError as exc:
+        raise ValueError(f"Failed to read EDDY directories from {fname}: {exc}")
+
+def extract(eddydir, idx, eddy_params, mask, bvals, **kwargs):
+    """
+    Extract QC data from a single EDDY run
+
+    This is the callable equivalent of the squat_eddy command line
+
+    :param eddydir: Path to directory containing EDDY output
+    :param idx: Path to EDDY index file, relative to eddydir
+    :param eddy_params: Path to EDDY acquisition parameters file, relative to eddydir
+    :param mask: Binary mask file
+    :param bvals: BVALs file
+    :param kwargs: Other options, named as the command line options with '-' replaced by '_'
+    :return: Path to output directory
+    """
+    parser = _get_parser(exit_on_error=False)
+    argv = ["--eddydir", eddydir, "--idx", idx, "--eddy-params", eddy_params, "--mask", mask, "--bvals", bvals]
+    return _extract(_parse_kwargs(parser, argv, kwargs))
+
+def _parse_kwargs(parser, argv, kwargs):
+    """
+    Parse options given as keyword arguments with the command line parser, so they are
+    validated (e.g. against the allowed choices) exactly as on the command line
+
+    :param parser: Command line parser, created with ``exit_on_error=False``
+    :param argv: Command line arguments for the required options
+    :param kwargs: Other options, named as the command line options with '-' replaced by '_'
+    :return: Options namespace
+    """
+    known = vars(parser.parse_args(argv))
+    argv = list(argv)
+    for k, v in kwargs.items():
+        if k not in known:
+            raise ValueError(f"Unknown option: {k}")
+        flag = "--" + k.replace("_", "-")
+        if v is None or v is False or (isinstance(v, (list, tuple)) and not v):
+            continue
+        elif v is True:
+            # Boolean options are all flags which default to False
+            argv.append(flag)
+        elif isinstance(v, (list, tuple)):
+            argv += [flag] + [str(item) for item in v]
+        else:
+            argv.append(f"{flag}={v}")
+
+    try:
+        return parser.parse_args(argv)
+    except argparse.ArgumentError as exc:
+        raise ValueError(str(exc))
+
+def _extract_subject(eddydir, options):
+    """
+    Extract QC data for one subject of a batch, catching any failure so it is reported
+    rather than stopping the batch
+
+    :return: Dictionary of subject result
+    """
+    start = time.time()
+    try:
+        output = extract(eddydir, **options)
+        return {"eddydir" : eddydir, "success" : True, "time" : time.time() - start, "output" : output, "error" : None}
+    except Exception as exc:
+        LOG.exception(f"Failed to extract QC data from {eddydir}")
+        return {"eddydir" : eddydir, "success" : False, "time" : time.time() - start, "output" : None, "error" : str(exc)}
+
+def extract_batch(eddydirs, jobs=1, output=None, **kwargs):
+    """
+    Extract QC data from multiple EDDY runs
+
+    Subjects are processed on a pool of worker processes which are reused between
+    subjects. A failure for one subject does not affect the others.
+
+    :param eddydirs: Sequence of paths to EDDY output directories
+    :param jobs: Number of subjects to process in parallel
+    :param output: Optional output directory. Output for each subject is written to a
+                   subdirectory named after its EDDY directory. If not given, the default
+                   output location within each EDDY directory is used
+    :param kwargs: Other options as for :func:`extract`. These are shared by all subjects
+    :return: List of dictionaries, one per subject, with keys ``eddydir``, ``success``,
+             ``time``, ``output`` and ``error``
+    """
+    subject_options = []
+    for eddydir in eddydirs:
+        options = dict(kwargs)
+        if output:
+            options["output"] = os.path.join(output, os.path.basename(os.path.normpath(eddydir)))
+        subject_options.append((eddydir, options))
+
+    if output:
+        outputs = [options["output"] for _eddydir, options in subject_options]
+        if len(set(outputs)) != len(outputs):
+            raise ValueError("EDDY directory names are not unique so cannot be used as output directory names - do not specify an output directory")
+
+    LOG.info(f"Extracting QC data for {len(subject_options)} subjects using {jobs} jobs")
+    if jobs > 1:
+        results = []
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            futures = [executor.submit(_extract_subject, eddydir, options) for eddydir, options in subject_options]
+            for (eddydir, _options), future in zip(subject_options, futures):
+                try:
+                    results.append(future.result())
+                except Exception as exc:
+                    # Worker process died, e.g. out of memory
+                    LOG.error(f"Worker failed while extracting QC data from {eddydir}: {exc}")
+                    results.append({"eddydir" : eddydir, "success" : False, "time" : None, "output" : None, "error" : str(exc)})
+    else:
+        results = [_extract_subject(eddydir, options) for eddydir, options in subject_options]
+
+    LOG.info("Batch summary:")
+    for result in results:
+        time_str = "" if result["time"] is None else " (%.1fs)" % result["time"]
+        if result["success"]:
+            LOG.info(f" - {result['eddydir']}: OK{time_str}")
+        else:
+            LOG.info(f" - {result['eddydir']}: FAILED{time_str}: {result['error']}")
+    num_success = sum(result["success"] for result in results)
+    LOG.info(f"{num_success}/{len(results)} subjects succeeded")
+    return results
+
+def _block_sizes(args, eddy_epi, mask_img, files, field, num_means):
+    """
+    Choose the number of volumes to read at a time from each 4D image
+
+    Without a memory limit the --block-size option is used for every image. With a
+    memory limit each image uses the largest block size, up to --block-size if given,
+    which is estimated to fit its share of the limit. Only image headers are read.
+
+    :return: Dictionary mapping file key to block size for the corrected data
+             (``eddy``), CNR maps (``cnr``), residuals (``residuals``) and TOPUP
+             field (``field``)
+    """
+    block_size = args.block_size if args.block_size else DEFAULT_BLOCK_SIZE
+    if not args.max_memory:
+        return {"eddy" : block_size, "cnr" : block_size, "residuals" : block_size, "field" : block_size}
+
+    max_memory = memory.parse_memory(args.max_memory)
+    fixed_memory = memory.BASE_MEMORY + memory.mask_memory(mask_img)
+    # Up to --threads stages run at once, so each of the image passes which may run
+    # concurrently gets an equal share of the memory not used by the shared data
+    concurrent_passes = max(1, min(args.threads, 3))
+    pass_memory = fixed_memory + (max_memory - fixed_memory) // concurrent_passes
+    kwargs = {"precision" : args.precision, "threads" : args.threads, "max_block_size" : args.block_size}
+    block_sizes = {"eddy" : memory.fit_block_size(eddy_epi, pass_memory, fixed_memory, num_means=num_means, **kwargs)}
+    for key in ("cnr", "residuals"):
+        if os.path.isfile(files[key]):
+            block_sizes[key] = memory.fit_block_size(nib.load(files[key]), pass_memory, fixed_memory, **kwargs)
+        else:
+            block_sizes[key] = block_size
+    if field is not None and os.path.isfile(field):
+        block_sizes["field"] = memory.fit_block_size(nib.load(field), pass_memory, fixed_memory, **kwargs)
+    else:
+        block_sizes["field"] = block_size
+
+    for key, size in block_sizes.items():
+        LOG.info(f"Reading {key} image {size} volumes at a time to fit memory limit {memory.format_memory(max_memory)}")
+    return block_sizes
+
+def _context(args):
+    """
+    Read and check the EDDY run inputs
+
+    Image headers are read but image data is not, apart from the mask
+
+    :param args: Options namespace as produced by the command line parser
+    :return: Extraction context shared by the extraction stages
+    """
     if not os.path.isdir(args.eddydir):
         raise ValueError(f"Not a directory: {args.eddydir}")
     LOG.info(f"Using EDDY directory: {args.eddydir}")
@@ -103,13 +334,15 @@ def main():
             for fname in eddy_files:
                 if fname.endswith(ext):
                     args.eddybase = fname[:-len(ext)]
+        if not args.eddybase:
+            raise ValueError(f"Could not find EDDY output in {args.eddydir} - specify the base name using --eddybase")
 
     LOG.info(f"Using EDDY base name: {args.eddybase}")
 
     eddyfile = None
     for ext in (".nii", ".nii.gz"):
-        eddyfile = _eddyfile(args, ext)
-        if os.path.isfile(eddyfile):
+        if os.path.isfile(_eddyfile(args, ext)):
+            eddyfile = _eddyfile(args, ext)
             break
 
     if not eddyfile:
@@ -139,7 +372,7 @@ def main():
         if eddyPara.ndim > 1:
             tmp_eddyPara = np.ascontiguousarray(eddyPara).view(np.dtype((np.void, eddyPara.dtype.itemsize * eddyPara.shape[1])))
             _, idx, inv_idx = np.unique(tmp_eddyPara, return_index=True, return_inverse=True)
-            eddyIdxs = inv_idx[eddyIdxs-1]+1
+            eddyIdxs = inv_idx.ravel()[eddyIdxs-1]+1
             eddyPara = eddyPara[idx]
         eddyPara = eddyPara.flatten()
     except Exception as exc:
@@ -172,33 +405,34 @@ def main():
     # OUTPUT FOLDER
     if not args.output:
         args.output = _eddyfile(args, ".qc")
-    if os.path.exists(args.output) and not args.overwrite:
+    if os.path.exists(args.output) and not (args.overwrite or args.incremental):
         raise ValueError(f"Output directory {args.output} already exists - remove or specify a different name")
-    os.makedirs(args.output, exist_ok=True)
 
-    # Load eddy corrected file and check for consistency between input dimensions
-    eddy_epi = nib.load(eddyfile)   
-    if bvals is not None and eddy_epi.shape[3] != np.max(bvals.shape):
+    # Check for consistency between input dimensions. Only the headers of the eddy corrected
+    # and brain mask files are read until the memory budget has been checked
+    eddy_hdr_img = nib.load(eddyfile)
+    if bvals is not None and eddy_hdr_img.shape[3] != np.max(bvals.shape):
         raise ValueError(f'Number of bvals not consistent with EDDY corrected file {eddyfile}')
-    elif eddy_epi.shape[3] != np.max(eddyIdxs.shape):
+    elif eddy_hdr_img.shape[3] != np.max(eddyIdxs.shape):
         raise ValueError(f'Number of eddy indices not consistent with EDDY corrected file {eddyfile}')
 
-    # Load binary brain mask file
-    if mask_file:
-        mask = nib.load(mask_file).get_fdata()
-        if eddy_epi.shape[0:3] != mask.shape:
-            raise ValueError('Mask and data dimensions are not consistent')
+    mask_img = nib.load(mask_file)
+    if eddy_hdr_img.shape[0:3] != mask_img.shape:
+        raise ValueError('Mask and data dimensions are not consistent')
 
     #=========================================================================================
     # Get data info and fill data dictionary
     #=========================================================================================
-    rounded_bvals = utils.round_bvals(bvals)
-    unique_bvals, counts = np.unique(rounded_bvals.astype(int), return_counts=True)
-    unique_pedirs, counts_pedirs = np.unique(eddyIdxs, return_counts=True)
-    protocol = np.full((unique_pedirs.size,unique_bvals.size), -1, dtype=int)
-    for c_b, b in enumerate(unique_bvals):
-        for c_p, p in enumerate(unique_pedirs):
-            protocol[c_p, c_b] = ((rounded_bvals==b) & (eddyIdxs==p)).sum()
+    if args.bval_rounding == "median":
+        rounded_bvals = round_bvals_median(bvals)
+    elif args.bval_rounding == "nearest":
+        rounded_bvals = utils.round_bvals(bvals)
+    else:
+        raise ValueError(f"Unknown b-value rounding method: {args.bval_rounding}")
+    acq = acquisition_summary(rounded_bvals, eddyIdxs)
+    unique_bvals, shell_idx, counts = acq["unique_bvals"], acq["shell_idx"], acq["shell_counts"]
+    unique_pedirs, pe_idx, counts_pedirs = acq["unique_pedirs"], acq["pe_idx"], acq["pe_counts"]
+    protocol = acq["protocol"]
 
     data = {
         #'subjid' : eddyfile,
@@ -218,158 +452,168 @@ def main():
         'unique_pedirs' : unique_pedirs,
         #'counts_pedirs' : counts_pedirs,
         #'shape' : eddy_epi.shape,
-        'vox_sizes' : np.array(eddy_epi.header.get_zooms())[:3],
+        'vox_sizes' : np.array(eddy_hdr_img.header.get_zooms())[:3],
         #'file_epi' : eddy_epi,
     }
 
+    files = {
+        "motion" : _eddyfile(args, '.eddy_movement_rms'),                   # Text file containing no. volumes X 2 columns
+        "params" : _eddyfile(args, '.eddy_parameters'),                     # Text file containing no. volumes X 9 columns
+        "s2v_params" : _eddyfile(args, '.eddy_movement_over_time'),         # Text file containing (no. volumes X no.slices / MB) rows and 6 columns
+        "ol_map" : _eddyfile(args, '.eddy_outlier_map'),                    # Text file containing binary matrix [no. volumes X no. slices]
+        "ol_map_std" : _eddyfile(args, '.eddy_outlier_n_stdev_map'),        # Text file containing matrix [no. volumes X no. slices]
+        "cnr" : _eddyfile(args, '.eddy_cnr_maps.nii.gz'),                   # 4D file containing the eddy-based b-CNR maps (std(pred)/std(res))
+        "residuals" : _eddyfile(args, '.eddy_residuals.nii.gz'),            # 4D file containing the eddy-based residuals
+    }
+
+    # Number of volumes to read at a time from each 4D image
+    block_sizes = _block_sizes(args, eddy_hdr_img, mask_img, files, field, unique_bvals.size + unique_pedirs.size)
+
+    # Open the eddy corrected file now that the memory budget has been checked. The file
+    # is kept open so volumes can be streamed without re-reading from the start each time
+    eddy_epi = load_image(eddyfile)
+
+    # Load mask data
+    mask = np.asanyarray(mask_img.dataobj)
+    # Voxels outside the mask bounding box do not contribute to any image statistics
+    bbox = None if args.no_crop else mask_bbox(mask)
+    mask_idx = mask_index(mask if bbox is None else mask[bbox])
+    os.makedirs(args.output, exist_ok=True)
+
     #=========================================================================================
-    # Check which output files exist and compute qc output
+    # Shared information used by the extraction stages
     #=========================================================================================
-    qc_data = {}
-    motionFile = _eddyfile(args, '.eddy_movement_rms')            # Text file containing no. volumes X 2 columns
-    paramsFile = _eddyfile(args, '.eddy_parameters')              # Text file containing no. volumes X 9 columns
-    s2vParamsFile = _eddyfile(args, '.eddy_movement_over_time')   # Text file containing (no. volumes X no.slices / MB) rows and 6 columns
-    olMapFile = _eddyfile(args, '.eddy_outlier_map')              # Text file containing binary matrix [no. volumes X no. slices]
-    cnrFile = _eddyfile(args, '.eddy_cnr_maps.nii.gz')            # 4D file containing the eddy-based b-CNR maps (std(pred)/std(res))
-    rssFile = _eddyfile(args, '.eddy_residuals.nii.gz')           # 4D file containing the eddy-based residuals
-
-    # Output slice images for each shell
-    epi_vol = eddy_epi.get_fdata()
-    for bval in unique_bvals:
-        bval_vol = np.mean(epi_vol[..., rounded_bvals==bval], axis=3)
-        nii = nib.Nifti1Image(bval_vol, eddy_epi.affine, eddy_epi.header)
-        #nii.save(vol, data['qc_path'] + "/avg_b0.nii.gz")
-        i_max = np.round(np.mean(bval_vol[mask > 0]) + 3*np.std(bval_vol[mask > 0]))
-        fsl.slicer(nii, a=os.path.join(args.output, f"avg_b{bval}.png"), i=(0, i_max))
-
-    if os.path.isfile(motionFile):
-        LOG.debug('RMS movement estimates file detected')
-        motion = np.genfromtxt(motionFile,dtype=float)
-        qc_data['motion_abs'] = motion[:, 0]
-        qc_data['motion_rel'] = motion[:, 1]
-        qc_data['motion_abs_mean'] = np.mean(motion[:, 0])
-        qc_data['motion_rel_mean'] = np.mean(motion[:, 1])
-
-    if os.path.isfile(paramsFile):
-        LOG.debug('Eddy parameters file detected')
-        params = np.genfromtxt(paramsFile, dtype=float)
-        qc_data["motion_v2v_trans"] = params[:,0:3]
-        qc_data["motion_v2v_rot"] = np.rad2deg(params[:,3:6])
-        qc_data['motion_ec_lin'] = params[:,6:9]
-        qc_data['motion_v2v_trans_mean'] = np.mean(params[:,0:3], axis=0)
-        qc_data['motion_v2v_rot_mean'] = np.mean(np.rad2deg(params[:,3:6]), axis=0)
-        qc_data['motion_ec_lin_std'] = np.std(params[:,6:9], axis=0)
-
-    if os.path.isfile(s2vParamsFile):
-        LOG.debug('Eddy s2v movement file detected')
-        s2v_params = np.genfromtxt(s2vParamsFile, dtype=float)
-        qc_data['motion_s2v_trans'] = s2v_params[:,0:3]
-        qc_data['motion_s2v_rot'] = np.rad2deg(s2v_params[:,3:6])
-        n_vox_thr = 240 # Minimum number of voxels in a masked slice
-        if slspec is not None:
-            n_ex = slspec.shape[0]
-            if slspec.ndim > 1:
-                ex_check = np.arange(0, n_ex)
-            else:
-                ex_check = np.where(np.sum(np.sum(mask[:,:,slspec], axis=0), axis=0) > n_vox_thr)
-        else:
-            LOG.warn('slspec file not provided. Assuming one excitation per slice.')
-            n_ex = eddy_epi.shape[2]
-            ex_check = np.arange(0, n_ex)
-
-        if n_ex * bvals.size != qc_data['s2v_params'].shape[0]:
-            LOG.warn('Number of s2v parameters does not match the expected one! Skipping s2v QC...')
-            qc_data.pop('motion_s2v_trans')
-            qc_data.pop('motion_s2v_rot')
+    ctx = types.SimpleNamespace(
+        output=args.output,
+        threads=args.threads,
+        precision=args.precision,
+        bval_rounding=args.bval_rounding,
+        signal_profiles=args.signal_profiles,
+        eddyfile=eddyfile,
+        eddy_epi=eddy_epi,
+        mask_file=mask_file,
+        mask=mask,
+        mask_idx=mask_idx,
+        bbox=bbox,
+        field=field,
+        slspec=slspec,
+        slspec_file=args.slspec,
+        acq_files=[_relfile(args, args.bvals), _relfile(args, args.idx), _relfile(args, args.eddy_params)],
+        bvals=bvals,
+        rounded_bvals=rounded_bvals,
+        unique_bvals=unique_bvals,
+        shell_idx=shell_idx,
+        counts=counts,
+        eddy_idxs=eddyIdxs,
+        unique_pedirs=unique_pedirs,
+        pe_idx=pe_idx,
+        counts_pedirs=counts_pedirs,
+        protocol=protocol,
+        eddy_para=eddyPara,
+        data=data,
+        files=files,
+        block_sizes=block_sizes,
+    )
+    return ctx
+
+def _extract(args):
+    """
+    Extract QC data from a single EDDY run
+
+    :param args: Options namespace as produced by the command line parser
+    :return: Path to output directory
+    """
+    if args.cache_dir:
+        configure_cache(args.cache_dir, memory.parse_memory(args.cache_size))
+    if args.index_dir or args.no_index_cache:
+        configure_index_cache(args.index_dir, enabled=not args.no_index_cache)
+    if args.render_cache_dir:
+        configure_render_cache(args.render_cache_dir, memory.parse_memory(args.render_cache_size))
+    perf = PerfRecorder() if args.perf or args.profile else NullPerfRecorder()
+    if not args.profile:
+        return _extract_qc(args, perf)
+
+    profiler = cProfile.Profile()
+    output = profiler.runcall(_extract_qc, args, perf)
+    profiler.dump_stats(os.path.join(output, PROFILE_FNAME))
+    LOG.info(f"Profile written to {os.path.join(output, PROFILE_FNAME)}")
+    return output
+
+def _extract_qc(args, perf):
+    """
+    :param args: Options namespace as produced by the command line parser
+    :param perf: PerfRecorder for performance measurements, or NullPerfRecorder
+    :return: Path to output directory
+    """
+    with perf.measure("inputs"):
+        ctx = _context(args)
+    ctx.perf = perf
+
+    #=========================================================================================
+    # Run extraction stages. In incremental mode, stages whose inputs are unchanged since
+    # the last run reuse their previous QC data
+    #=========================================================================================
+    qc_fname = os.path.join(args.output, 'qc.json')
+    previous_manifest, previous_qc = {}, {}
+    if args.incremental:
+        previous_manifest = manifest.read_manifest(args.output)
+        if os.path.isfile(qc_fname):
+            with open(qc_fname, 'r') as fp:
+                previous_qc = json.load(fp)
+            try:
+                previous_qc = load_arrays(previous_qc, qc_fname)
+            except IOError as exc:
+                LOG.warn(f"Could not reuse previous results: {exc}")
+                previous_qc = {}
+
+    stage_records, stage_qc, to_run, fingerprints = {}, {}, {}, {}
+    for stage in STAGES:
+        previous = previous_manifest.get("stages", {}).get(stage.name)
+        stage_records[stage.name] = manifest.stage_record(stage.inputs(ctx), stage.options(ctx), [], stage.outputs(ctx), previous, with_hash=args.incremental, memo=fingerprints)
+        if manifest.stage_unchanged(previous, stage_records[stage.name]) and all("qc_" + k in previous_qc for k in previous["qc_keys"]):
+            LOG.info(f"Stage {stage.name}: inputs unchanged, reusing previous results")
+            stage_qc[stage.name] = {k : previous_qc["qc_" + k] for k in previous["qc_keys"]}
         else:
-            qc_data['motion_s2v_trans_var'] = np.zeros((bvals.size, 3))
-            qc_data['motion_s2v_rot_var'] = np.zeros((bvals.size, 3))
-            for i in np.arange(0, bvals.size):
-                tmp = s2v_params[i*n_ex:(i+1)*n_ex]
-                qc_data['motion_s2v_trans_var'][i] = np.var(qc_data['motion_s2v_trans'][i*n_ex:(i+1)*n_ex][ex_check], ddof=1, axis=0)
-                qc_data['motion_s2v_rot_var'][i] = np.var(qc_data['motion_s2v_rot'][i*n_ex:(i+1)*n_ex][ex_check], ddof=1, axis=0)
-            qc_data['motion_s2v_trans_std_mean'] = np.sqrt(np.mean(qc_data['motion_s2v_trans_var'], axis=0))
-            qc_data['motion_s2v_rot_std_mean'] = np.sqrt(np.mean(qc_data['motion_s2v_rot_var'], axis=0))
-            
-    if os.path.isfile(olMapFile):
-        LOG.debug('Outliers outuput files detected')
-        ol_map = np.genfromtxt(olMapFile, dtype=None, delimiter=" ", skip_header=1)
-        ol_map_std = np.genfromtxt(_eddyfile(args, '.eddy_outlier_n_stdev_map'), dtype=float, delimiter=" ", skip_header=1)
-        qc_data['outliers_tot'] = 100*np.count_nonzero(ol_map)/(data['num_dw_vols']*eddy_epi.shape[2])
-        qc_data['outliers_tot_vol'] = 100*np.sum(ol_map, axis=1)/ol_map.shape[1]
-        qc_data['outliers_slice_vol'] = ol_map_std
-        qc_data['outliers_tot_bval'] = np.full(data['unique_bvals'].size, -1.0)
-        qc_data['outliers_tot_pe'] = np.full(data['num_pe_dirs'], -1.0)
-        for i, bval in enumerate(data['unique_bvals']):
-            LOG.debug("unique bval: %i" % bval)
-            qc_data['outliers_tot_bval'][i] = 100*np.count_nonzero(ol_map[rounded_bvals == bval, :])/(counts[unique_bvals > 100][i]*eddy_epi.shape[2])
-        for i in range(0, data['num_pe_dirs']):
-            qc_data['outliers_tot_pe'][i] = 100*np.count_nonzero(ol_map[eddyIdxs == data['unique_pedirs'][i],:])/(counts_pedirs[i]*eddy_epi.shape[2])
-        
-    if os.path.isfile(cnrFile):
-        LOG.debug('CNR output files detected')
-        cnrImg = nib.load(cnrFile)
-        cnr = cnrImg.get_data()
-        if np.count_nonzero(np.isnan(cnr)):
-            LOG.warn("NaNs detected in the CNR maps")
-        finiteMask = (mask != 0) * np.isfinite(cnr[:,:,:,0])
-        qc_data['snr_mean'] = float(np.nanmean(cnr[:,:,:,0][finiteMask]))
-        qc_data['snr_std'] = float(np.nanstd(cnr[:,:,:,0][finiteMask]))
-        qc_data['cnr_mean_bval'] = np.full(data['unique_bvals'].size, -1.0, dtype=float)
-        qc_data['cnr_std_bval'] = np.full(data['unique_bvals'].size, -1.0, dtype=float)
-        for i in range(data['unique_bvals'].size):
-            finiteMask = (mask != 0) * np.isfinite(cnr[:,:,:,i+1])
-            qc_data['cnr_mean_bval'][i] = np.nanmean(cnr[:,:,:,i+1][finiteMask])
-            qc_data['cnr_std_bval'][i] = np.nanstd(cnr[:,:,:,i+1][finiteMask])
-
-        # Output CNR/SNR slice maps
-        for idx, bval in enumerate(unique_bvals):
-            bval_vol = cnr[..., idx]
-            nii = nib.Nifti1Image(bval_vol, cnrImg.affine, cnrImg.header)
-            #nii.save(vol, data['qc_path'] + f"/cnr_b{bval}.nii.gz")
-            i_max = np.round(np.mean(bval_vol[mask > 0]) + 3*np.std(bval_vol[mask > 0]))
-            fsl.slicer(nii, a=os.path.join(args.output, f"cnr_b{bval}.png"), i=(0, i_max))
-
-    if os.path.isfile(rssFile):
-        LOG.debug('Eddy residuals file detected')
-        rssImg = nib.load(rssFile)
-        rss = rssImg.get_data()
-        qc_data['res_mean'] = np.full(bvals.size, -1.0),
-        for i in range(0,bvals.size):
-            qc_data['res_mean'][i] = np.mean(np.power(rss[:,:,:,i][mask != 0.0], 2))
-        rssImg.uncache()
-        del rss
-        # FIXME
-        # np.savetxt(data['path'] + '/eddy_msr.txt', np.reshape(qc_data['avg_rss'], (1,-1)), fmt='%f', delimiter=' ')
-    
-    if field is not None:
-        if not os.path.isfile(field):
-            raise ValueError(f"No such file: {field}")
-        LOG.debug('Topup fieldmap file detected')
-        fieldImg = nib.load(field)
-        fieldMap = fieldImg.get_data()
-        dispField = fieldMap*eddyPara[3]
-        qc_data['field_disp_std'] = np.std(dispField[mask != 0.0])
-        fieldImg.uncache()
-        del fieldMap
+            to_run[stage.name] = stage
+
+    def _run_stage(name):
+        LOG.info(f"Stage {name}: running")
+        with perf.measure(name):
+            return to_run[name].run(ctx)
+
+    # Stages run concurrently on up to --threads threads once the stages they depend on
+    # have completed. The profiler only sees the main thread, so stages run on it when profiling
+    dependencies = {name : [dep for dep in stage.depends if dep in to_run] for name, stage in to_run.items()}
+    stage_qc.update(scheduler.run_tasks(dependencies, _run_stage, 1 if args.profile else args.threads))
+
+    qc_data = {}
+    for stage in STAGES:
+        stage_records[stage.name]["qc_keys"] = sorted(stage_qc[stage.name])
+        qc_data.update(stage_qc[stage.name])
 
     # Stop if motion or parameters estimates are missing FIXME
     #if (eddyOutput['motionFlag'] == False or
     #    eddyOutput['paramsFlag'] == False):
     #    raise ValueError('Motion estimates and/or eddy estimated parameters are missing!')
 
-    full_data = {}
-    for k, v in data.items():
-        if isinstance(v, np.ndarray):
-            full_data['data_' + k] = v.tolist()
-        else:
-            full_data['data_' + k] = v
-    for k, v in qc_data.items():
-        if isinstance(v, np.ndarray):
-            full_data['qc_' + k] = v.tolist()
-        else:
-            full_data['qc_' + k] = v
+    # Arrays are written directly by the JSON writer so are not converted to lists
+    full_data = {'data_' + k : v for k, v in ctx.data.items()}
+    full_data.update({'qc_' + k : v for k, v in qc_data.items()})
+    digits, field_digits = parse_digits(args.json_digits)
+    json_options = {"indent" : None if args.compact_json else 4, "digits" : digits, "field_digits" : field_digits}
 
     # Export stats and data info to json file
-    with open(os.path.join(args.output, 'qc.json'), 'w') as fp:
-        json.dump(full_data, fp, sort_keys=True, indent=4, separators=(',', ': '))
+    with perf.measure("json_write"):
+        if args.array_sidecar:
+            full_data = save_arrays(full_data, qc_fname)
+        elif os.path.isfile(arrays_fname(qc_fname)):
+            os.remove(arrays_fname(qc_fname))
+        write_json(qc_fname, full_data, **json_options)
+    manifest.write_manifest(args.output, {"stages" : stage_records})
+
+    if args.perf or args.profile:
+        # The QC data is written first so the perf data includes the time taken to write it
+        full_data["perf"] = perf.results()
+        write_json(qc_fname, full_data, **json_options)
+
+    return args.output
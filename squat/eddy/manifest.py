@@ -0,0 +1,124 @@
+"""
+SQUAT: Study-wise QUality Assessment Tool
+
+Extraction manifest recording the input fingerprints of each extraction
+stage, so a re-run only needs to recompute stages whose inputs have changed
+
+Martin Craig, SPMIC, Nottingham
+"""
+import os
+import json
+import logging
+
+from ..utils.hashing import file_hash
+
+LOG = logging.getLogger(__name__)
+
+MANIFEST_FNAME = "squat_manifest.json"
+
+def fingerprint(fname, previous=None, with_hash=False, memo=None):
+    """
+    Get the fingerprint of an input file
+
+    :param fname: File path
+    :param previous: Previous fingerprint of the same file. If the size and modification time
+                     are unchanged its hash is reused rather than recomputed
+    :param with_hash: If True, include a hash of the file content
+    :param memo: Optional dictionary of fingerprints already taken in this run, keyed by
+                 file path. Used and updated so a file input to several stages is only
+                 hashed once
+    :return: Dictionary with keys ``size``, ``mtime`` and ``sha1``, or None if the
+             file does not exist
+    """
+    try:
+        stat = os.stat(fname)
+    except OSError:
+        return None
+
+    fp = {"size" : stat.st_size, "mtime" : stat.st_mtime_ns, "sha1" : None}
+    for known in (previous, (memo or {}).get(fname)):
+        if known and known["size"] == fp["size"] and known["mtime"] == fp["mtime"]:
+            fp["sha1"] = fp["sha1"] or known.get("sha1")
+    if with_hash and fp["sha1"] is None:
+        fp["sha1"] = file_hash(fname)
+    if memo is not None:
+        memo[fname] = dict(fp)
+    return fp
+
+def same_file(previous, current):
+    """
+    :return: True if two fingerprints are of the same file content. Files whose size and
+             modification time match are assumed unchanged, otherwise the hashes are
+             compared if both are known
+    """
+    if previous is None or current is None:
+        return previous is None and current is None
+    if previous["size"] != current["size"]:
+        return False
+    if previous["mtime"] == current["mtime"]:
+        return True
+    return previous.get("sha1") is not None and previous.get("sha1") == current.get("sha1")
+
+def stage_record(fnames, options, qc_keys, outputs, previous=None, with_hash=False, memo=None):
+    """
+    Create the manifest record for a stage
+
+    :param fnames: Stage input file paths. None entries are ignored
+    :param options: Dictionary of option values affecting the stage
+    :param qc_keys: Names of QC items produced by the stage
+    :param outputs: Paths of other output files produced by the stage
+    :param previous: Previous record for this stage, used to avoid re-hashing unchanged files
+    :param with_hash: If True, include content hashes of input files
+    :param memo: Optional dictionary of fingerprints shared between the stages of a run,
+                 see :func:`fingerprint`
+    :return: Manifest record dictionary
+    """
+    previous_inputs = previous.get("inputs", {}) if previous else {}
+    inputs = {}
+    for fname in fnames:
+        if fname is not None:
+            fname = os.path.abspath(fname)
+            inputs[fname] = fingerprint(fname, previous_inputs.get(fname), with_hash, memo)
+    return {
+        "inputs" : inputs,
+        "options" : options,
+        "qc_keys" : sorted(qc_keys),
+        "outputs" : sorted(outputs),
+    }
+
+def stage_unchanged(previous, current):
+    """
+    :param previous: Manifest record from a previous run, or None
+    :param current: Manifest record for this run. QC keys and outputs are ignored
+    :return: True if the stage inputs and options are unchanged and its output files still exist
+    """
+    if not previous:
+        return False
+    if previous.get("options") != current["options"]:
+        return False
+    if set(previous.get("inputs", {})) != set(current["inputs"]):
+        return False
+    for fname, fp in current["inputs"].items():
+        if not same_file(previous["inputs"][fname], fp):
+            LOG.debug(f"Input file changed: {fname}")
+            return False
+    return all(os.path.isfile(fname) for fname in previous.get("outputs", []))
+
+def read_manifest(outdir):
+    """
+    :return: Manifest dictionary from output directory, empty if not found or unreadable
+    """
+    fname = os.path.join(outdir, MANIFEST_FNAME)
+    try:
+        with open(fname, "r") as f:
+            return json.load(f)
+    except (IOError, json.JSONDecodeError) as exc:
+        LOG.debug(f"Could not read manifest {fname}: {exc}")
+        return {}
+
+def write_manifest(outdir, manifest):
+    """
+    Write manifest dictionary to output directory
+    """
+    with open(os.path.join(outdir, MANIFEST_FNAME), "w") as f:
+        json.dump(manifest, f, sort_keys=True, indent=4, separators=(',', ': '))
@@ -0,0 +1,124 @@
+"""
+SQUAT: Study-wise QUality Assessment Tool
+
+Memory budgeting for QC extraction. The peak memory use of each streaming
+pass over a 4D image is estimated from the image header alone, so the number
+of volumes read at a time can be chosen to fit a memory budget before any
+image data is read
+
+Martin Craig, SPMIC, Nottingham
+"""
+import re
+import logging
+
+import numpy as np
+
+from .volumes import compute_dtype, scaling
+
+LOG = logging.getLogger(__name__)
+
+# Allowance for the Python interpreter, loaded libraries and small arrays
+BASE_MEMORY = 256 * 1024**2
+
+_UNITS = {"" : 1, "K" : 1024, "M" : 1024**2, "G" : 1024**3, "T" : 1024**4}
+
+def parse_memory(value):
+    """
+    :param value: Memory size in bytes, optionally with a K, M, G or T suffix
+                  (binary units), e.g. ``4G`` or ``512M``
+    :return: Size in bytes
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d*)?)\s*([KMGT]?)B?\s*", str(value), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid memory size: {value}")
+    return int(float(match.group(1)) * _UNITS[match.group(2).upper()])
+
+def format_memory(num_bytes):
+    """
+    :return: Human readable memory size
+    """
+    for unit in ("T", "G", "M", "K"):
+        if num_bytes >= _UNITS[unit]:
+            return f"{num_bytes / _UNITS[unit]:.1f}{unit}"
+    return f"{num_bytes}B"
+
+def _read_itemsize(img, precision):
+    """
+    :return: Bytes per voxel of blocks read from an image at given precision
+    """
+    stored = np.dtype(img.get_data_dtype()).itemsize
+    slope, inter = getattr(img.dataobj, "slope", 1.0), getattr(img.dataobj, "inter", 0.0)
+    if (slope, inter) == (1.0, 0.0) or scaling(img, precision) != (1.0, 0.0):
+        # Read in the stored data type
+        return stored
+    # nibabel scales data to at most float64
+    return max(stored, 8)
+
+def mask_memory(mask_img):
+    """
+    :param mask_img: nibabel mask image. Only the header is used
+    :return: Estimated memory in bytes held by the mask and its voxel index during extraction
+    """
+    num_vox = int(np.prod(mask_img.shape[:3]))
+    itemsize = np.dtype(mask_img.get_data_dtype()).itemsize
+    # Mask data, its flattened copy, the non-zero test and the voxel index
+    return num_vox * (2 * itemsize + 1 + 8)
+
+def pass_memory(img, block_size, precision="float64", threads=1, num_means=0):
+    """
+    Estimate the peak memory of a streaming pass over an image
+
+    The estimate assumes every voxel is in the mask, since the mask size is not
+    known without reading the mask data.
+
+    :param img: 3D or 4D nibabel image. Only the header is used
+    :param block_size: Number of volumes read at a time
+    :param precision: Precision of the reductions
+    :param threads: Maximum number of blocks read concurrently
+    :param num_means: Number of mean volumes accumulated during the pass, if any
+    :return: Estimated memory in bytes
+    """
+    num_vox = int(np.prod(img.shape[:3]))
+    num_vols = 1 if len(img.shape) == 3 else img.shape[3]
+    block_size = max(1, min(int(block_size), num_vols))
+    compute_itemsize = compute_dtype(precision).itemsize
+
+    # Blocks as read, of which up to one per thread are held at a time
+    read = max(1, threads) * num_vox * block_size * _read_itemsize(img, precision)
+    # Block converted to the compute precision, two temporaries of the same size and
+    # a boolean finite value mask
+    work = num_vox * block_size * (3 * compute_itemsize + 1)
+    # Float64 sums and means for each mean volume
+    means = num_vox * num_means * 2 * 8
+    if num_means:
+        # Each group is summed from a copy of its volumes in the block, at most the whole
+        # block, plus the float64 sum of the copy
+        means += num_vox * (block_size * compute_itemsize + 8)
+    return read + work + means
+
+def fit_block_size(img, max_memory, fixed_memory=0, max_block_size=None, **kwargs):
+    """
+    Get the largest number of volumes to read at a time within a memory budget
+
+    :param img: 3D or 4D nibabel image. Only the header is used
+    :param max_memory: Memory budget in bytes
+    :param fixed_memory: Memory in bytes used by other data held during the pass
+    :param max_block_size: Maximum block size. Defaults to the number of volumes
+    :param kwargs: Other arguments to :func:`pass_memory`
+    :return: Block size
+    :raises ValueError: If a pass reading a single volume at a time does not fit the budget
+    """
+    num_vols = 1 if len(img.shape) == 3 else img.shape[3]
+    hi = num_vols if max_block_size is None else max(1, min(max_block_size, num_vols))
+    required = fixed_memory + pass_memory(img, 1, **kwargs)
+    if required > max_memory:
+        raise ValueError(f"Memory limit {format_memory(max_memory)} is too small to read {img.get_filename()}: at least {format_memory(required)} is needed")
+
+    lo = 1
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if fixed_memory + pass_memory(img, mid, **kwargs) <= max_memory:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
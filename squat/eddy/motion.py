@@ -0,0 +1,56 @@
+"""
+SQUAT: Study-wise QUality Assessment Tool
+
+Slice to volume motion statistics. The EDDY s2v parameters have one row per
+excitation of each volume, so they are reshaped to [volumes, excitations,
+parameters] and reduced over excitations for every volume at once
+
+Martin Craig, SPMIC, Nottingham
+"""
+import logging
+
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+# Minimum number of in-mask voxels in a single-slice excitation for it to be included
+S2V_MIN_VOXELS = 240
+
+def excitation_mask(slspec, mask, num_slices, min_voxels=S2V_MIN_VOXELS):
+    """
+    Get the excitations to include in slice to volume motion statistics
+
+    :param slspec: Slice acquisition specification with one row per excitation, or None
+                   to assume one excitation per slice in order
+    :param mask: 3D brain mask. Non-zero voxels are in the mask
+    :param num_slices: Number of slices in each volume
+    :param min_voxels: Single-slice excitations are only included if the slice has more
+                       than this number of voxels in the mask. Multiband excitations are
+                       always included
+    :return: Tuple of (number of excitations, boolean array of included excitations)
+    """
+    if slspec is None:
+        return num_slices, np.ones(num_slices, dtype=bool)
+
+    slspec = np.asarray(slspec, dtype=int)
+    num_ex = slspec.shape[0]
+    if slspec.ndim > 1:
+        return num_ex, np.ones(num_ex, dtype=bool)
+    slice_voxels = np.count_nonzero(mask, axis=(0, 1))
+    return num_ex, slice_voxels[slspec] > min_voxels
+
+def s2v_variance(params, num_vols, ex_mask):
+    """
+    Get the variance of slice to volume motion parameters within each volume
+
+    :param params: Array [NVOLS * NEX, NPARAMS] of motion parameters for each excitation of each volume
+    :param num_vols: Number of volumes
+    :param ex_mask: Boolean array [NEX] of excitations to include
+    :return: Array [NVOLS, NPARAMS] of the sample variance of each parameter over the
+             included excitations of each volume
+    """
+    params = np.asarray(params)
+    ex_mask = np.asarray(ex_mask, dtype=bool)
+    if params.ndim != 2 or params.shape[0] != num_vols * ex_mask.size:
+        raise ValueError(f"Number of s2v parameter rows {params.shape[0]} does not match {num_vols} volumes of {ex_mask.size} excitations")
+    return np.var(params.reshape(num_vols, ex_mask.size, -1)[:, ex_mask], ddof=1, axis=1)
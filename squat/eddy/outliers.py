@@ -0,0 +1,57 @@
+"""
+SQUAT: Study-wise QUality Assessment Tool
+
+Slice outlier counts from the EDDY outlier map. All groupings of volumes are
+computed from the per-volume counts using the volume to shell and volume to
+phase encoding direction indices, so the outlier map itself is only reduced
+once along each axis
+
+The binary outlier map can also be stored bit-packed (see
+:mod:`squat.utils.packbits`), and counts are computed from the packed bytes
+without unpacking
+
+Martin Craig, SPMIC, Nottingham
+"""
+import logging
+
+import numpy as np
+
+from ..utils.packbits import is_packed, packed_counts
+
+LOG = logging.getLogger(__name__)
+
+def outlier_counts(ol_map, shell_idx, pe_idx, num_shells, num_pe_dirs):
+    """
+    Count slice outliers
+
+    :param ol_map: Binary outlier map [NVOLS, NSLICES], or bit-packed outlier map
+    :param shell_idx: Shell index of each volume in range [0, num_shells)
+    :param pe_idx: Phase encoding direction index of each volume in range [0, num_pe_dirs)
+    :param num_shells: Number of shells
+    :param num_pe_dirs: Number of phase encoding directions
+    :return: Dictionary of integer arrays: ``vol`` (outlier slices in each volume),
+             ``slice`` (outlier volumes in each slice), ``shell_pe`` (outlier slices in
+             each shell and PE direction [NSHELLS, NPEDIRS]) and ``vols_shell_pe``
+             (number of volumes in each shell and PE direction [NSHELLS, NPEDIRS])
+    """
+    shell_idx, pe_idx = np.asarray(shell_idx, dtype=int), np.asarray(pe_idx, dtype=int)
+    shape = tuple(ol_map["shape"]) if is_packed(ol_map) else np.shape(ol_map)
+    if len(shape) != 2 or shape[0] != shell_idx.size or shell_idx.size != pe_idx.size:
+        raise ValueError(f"Outlier map shape {shape} does not match number of volumes {shell_idx.size}")
+
+    if is_packed(ol_map):
+        per_vol, per_slice = packed_counts(ol_map)
+    else:
+        per_vol = np.count_nonzero(ol_map, axis=1)
+        per_slice = np.count_nonzero(ol_map, axis=0)
+    # Each volume's (shell, PE) cell as a flat index so one bincount gives the cross-tabulation
+    cell = shell_idx * num_pe_dirs + pe_idx
+    num_cells = num_shells * num_pe_dirs
+    shell_pe = np.bincount(cell, weights=per_vol, minlength=num_cells).astype(int)
+    vols_shell_pe = np.bincount(cell, minlength=num_cells)
+    return {
+        "vol" : per_vol,
+        "slice" : per_slice,
+        "shell_pe" : shell_pe.reshape(num_shells, num_pe_dirs),
+        "vols_shell_pe" : vols_shell_pe.reshape(num_shells, num_pe_dirs),
+    }
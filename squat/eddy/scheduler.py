@@ -0,0 +1,69 @@
+"""
+SQUAT: Study-wise QUality Assessment Tool
+
+Runs a set of tasks with dependencies between them on a pool of threads. A
+task is started as soon as the tasks it depends on have completed, so
+independent tasks overlap. This suits QC extraction since most of the time
+is spent in gzip decompression and Numpy, which release the GIL
+
+Martin Craig, SPMIC, Nottingham
+"""
+import concurrent.futures
+import logging
+
+LOG = logging.getLogger(__name__)
+
+def _ready(dependencies, pending, results):
+    """
+    :return: Pending tasks whose dependencies have all completed, in order
+    """
+    return [name for name in pending if all(dep in results for dep in dependencies[name])]
+
+def run_tasks(dependencies, run, threads=1):
+    """
+    Run tasks in dependency order
+
+    :param dependencies: Dictionary mapping task name to a sequence of names of tasks
+                         which must complete before it starts. When more than one task
+                         is ready they are started in the order of this dictionary
+    :param run: Callable taking a task name and returning its result
+    :param threads: Maximum number of tasks run at once. If 1, tasks are run one at
+                    a time on the calling thread
+    :return: Dictionary mapping task name to result
+    :raises ValueError: If a dependency is not one of the tasks, or dependencies are circular.
+                        An exception raised by a task is re-raised once the tasks already
+                        running have finished
+    """
+    for name, deps in dependencies.items():
+        for dep in deps:
+            if dep not in dependencies:
+                raise ValueError(f"Unknown dependency of task {name}: {dep}")
+
+    results = {}
+    pending = list(dependencies)
+    if threads <= 1:
+        while pending:
+            ready = _ready(dependencies, pending, results)
+            if not ready:
+                raise ValueError(f"Circular dependencies between tasks: {', '.join(pending)}")
+            results[ready[0]] = run(ready[0])
+            pending.remove(ready[0])
+        return results
+
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        try:
+            while pending or running:
+                for name in _ready(dependencies, pending, results):
+                    LOG.debug(f"Starting task {name}")
+                    running[executor.submit(run, name)] = name
+                    pending.remove(name)
+                if not running:
+                    raise ValueError(f"Circular dependencies between tasks: {', '.join(pending)}")
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    results[running.pop(future)] = future.result()
+        finally:
+            for future in running:
+                future.cancel()
+    return results
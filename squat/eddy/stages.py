@@ -0,0 +1,382 @@
+"""
+SQUAT: Study-wise QUality Assessment Tool
+
+QC extraction stages for an EDDY run. Each stage computes one group of QC
+measures from the shared acquisition information and its own EDDY output
+files. Stages declare their input files so unchanged stages can be skipped
+on re-runs, and the stages they depend on so that independent stages can
+run concurrently
+
+Matteo Bastiani, FMRIB, Oxford
+Martin Craig, SPMIC, Nottingham
+"""
+import os
+import logging
+
+import numpy as np
+
+from .volumes import accumulate, ShellMeans, ShellPeMeans, VolumeSignal, SliceProfiles
+from .textfiles import read_eddy_text
+from .stats import masked_volume_stats, uncrop
+from .outliers import outlier_counts
+from .motion import excitation_mask, s2v_variance
+from ..utils.slicer import render_slices, png_bytes
+from ..utils.imageio import load_image, save_index
+from ..utils.packbits import pack_outlier_map
+from ..utils.rendercache import render_key, lookup, store, cached_render
+
+LOG = logging.getLogger(__name__)
+
+S2V_VAR_FNAME = "eddy_s2v_var.txt"
+
+def _write_png(ctx, fname, content):
+    with open(os.path.join(ctx.output, fname), "wb") as f:
+        f.write(content)
+
+def _zooms(ctx):
+    return [float(z) for z in ctx.data['vox_sizes']]
+
+class Stage:
+    """
+    A group of QC measures computed together
+
+    :ivar name: Stage name, used in the extraction manifest
+    :ivar depends: Names of stages which must complete before this stage runs, e.g.
+                   because they write files it reads. All stages may use the shared
+                   extraction context, which is complete before any stage runs
+    """
+    name = None
+    depends = ()
+
+    def inputs(self, ctx):
+        """
+        :param ctx: Extraction context
+        :return: List of input file paths which affect the output of this stage. Optional
+                 files which do not exist should still be included so that their
+                 later creation is detected
+        """
+        return []
+
+    def options(self, ctx):
+        """
+        :param ctx: Extraction context
+        :return: Dictionary of option values which affect the output of this stage
+        """
+        return {}
+
+    def outputs(self, ctx):
+        """
+        :param ctx: Extraction context
+        :return: List of output file paths written by this stage, other than the QC data
+        """
+        return []
+
+    def run(self, ctx):
+        """
+        Run the stage
+
+        :param ctx: Extraction context
+        :return: Dictionary of QC data items (without the qc_ prefix)
+        """
+        raise NotImplementedError()
+
+class CorrectedVolumes(Stage):
+    """
+    Metrics of the EDDY corrected data, all computed from a single read pass:
+
+     - Mean volume for each shell, output as slice images
+     - Mean b=0 volume for each phase encoding direction, output as slice images if
+       there is more than one phase encoding direction
+     - If requested, mean in-mask signal of each volume and of each slice of each volume
+
+    Only the mask bounding box is read, and mean volumes are padded back to the full
+    field of view for rendering. If every slice image is in the render cache the mean
+    volumes are not computed
+    """
+    name = "corrected_volumes"
+
+    def inputs(self, ctx):
+        return [ctx.eddyfile, ctx.mask_file] + ctx.acq_files
+
+    def options(self, ctx):
+        return {"precision" : ctx.precision, "bval_rounding" : ctx.bval_rounding, "crop" : ctx.bbox is not None, "signal_profiles" : ctx.signal_profiles}
+
+    def _b0_pe_dirs(self, ctx):
+        """
+        :return: Shell index of b=0 volumes and the phase encoding direction indices with
+                 b=0 volumes, or (None, []) if per-PE b=0 images are not generated
+        """
+        b0_shells = np.flatnonzero(ctx.unique_bvals <= 100)
+        if ctx.unique_pedirs.size < 2 or b0_shells.size == 0:
+            return None, []
+        b0_shell = b0_shells[0]
+        return b0_shell, np.flatnonzero(ctx.protocol[:, b0_shell])
+
+    def outputs(self, ctx):
+        _, pe_dirs = self._b0_pe_dirs(ctx)
+        return [os.path.join(ctx.output, f"avg_b{bval}.png") for bval in ctx.unique_bvals] + \
+               [os.path.join(ctx.output, f"avg_b0_pe{pe}.png") for pe in pe_dirs]
+
+    def _save_means(self, ctx, means, fnames, keys):
+        stats = masked_volume_stats(means, ctx.mask_idx, block_size=means.shape[3], precision=ctx.precision)
+        means = uncrop(means, ctx.bbox, ctx.eddy_epi.shape)
+        for idx, fname in fnames:
+            i_max = np.round(stats["mean"][idx] + 3*stats["std"][idx])
+            with ctx.perf.measure("slice_pngs"):
+                content = png_bytes(render_slices(means[..., idx], i=(0, i_max), zooms=_zooms(ctx)))
+                _write_png(ctx, fname, content)
+                store(keys[fname], content)
+
+    def run(self, ctx):
+        b0_shell, pe_dirs = self._b0_pe_dirs(ctx)
+        shell_fnames = [(idx, f"avg_b{bval}.png") for idx, bval in enumerate(ctx.unique_bvals)]
+        pe_fnames = [(pe, f"avg_b0_pe{pe}.png") for pe in pe_dirs]
+        # The slice images depend on all the stage inputs and options, and the intensity
+        # window is derived from them, so it is not part of the key
+        keys = {fname : render_key(self.inputs(ctx), image=fname, zooms=_zooms(ctx), renderer="png", **self.options(ctx)) for _idx, fname in shell_fnames + pe_fnames}
+        cached = {fname : lookup(key) for fname, key in keys.items()}
+        render = any(content is None for content in cached.values())
+
+        accumulators = {}
+        if ctx.signal_profiles:
+            accumulators["signal_vol"] = VolumeSignal(ctx.mask_idx)
+            accumulators["signal_slice_vol"] = SliceProfiles(ctx.mask_idx)
+        if render:
+            accumulators["shell_means"] = ShellMeans(ctx.unique_bvals.size)
+            if b0_shell is not None:
+                accumulators["pe_means"] = ShellPeMeans(b0_shell, ctx.unique_pedirs.size)
+        if not accumulators:
+            LOG.debug("Using cached mean volume slice images")
+            for fname, content in cached.items():
+                _write_png(ctx, fname, content)
+            return {}
+
+        results = accumulate(ctx.eddy_epi, list(accumulators.values()), ctx.shell_idx, ctx.pe_idx, block_size=ctx.block_sizes["eddy"], threads=ctx.threads, precision=ctx.precision, bbox=ctx.bbox)
+        results = dict(zip(accumulators, results))
+        save_index(ctx.eddy_epi)
+
+        if render:
+            self._save_means(ctx, results["shell_means"], shell_fnames, keys)
+            if b0_shell is not None:
+                self._save_means(ctx, results["pe_means"], pe_fnames, keys)
+        else:
+            LOG.debug("Using cached mean volume slice images")
+            for fname, content in cached.items():
+                _write_png(ctx, fname, content)
+
+        qc_data = {}
+        if ctx.signal_profiles:
+            # Slices with no voxels in the mask, including those outside the bounding box,
+            # have zero signal
+            slice_signal = results["signal_slice_vol"]
+            slice_signal[:, accumulators["signal_slice_vol"].counts == 0] = 0
+            qc_data["signal_vol"] = results["signal_vol"]
+            qc_data["signal_slice_vol"] = np.zeros((ctx.eddy_epi.shape[3], ctx.eddy_epi.shape[2]))
+            qc_data["signal_slice_vol"][:, slice(None) if ctx.bbox is None else ctx.bbox[2]] = slice_signal
+        return qc_data
+
+class Motion(Stage):
+    """
+    Volume to volume motion and eddy current parameters
+    """
+    name = "motion"
+
+    def inputs(self, ctx):
+        return [ctx.files["motion"], ctx.files["params"]]
+
+    def run(self, ctx):
+        qc_data = {}
+        if os.path.isfile(ctx.files["motion"]):
+            LOG.debug('RMS movement estimates file detected')
+            motion = read_eddy_text(ctx.files["motion"])
+            qc_data['motion_abs'] = motion[:, 0]
+            qc_data['motion_rel'] = motion[:, 1]
+            qc_data['motion_abs_mean'] = np.mean(motion[:, 0])
+            qc_data['motion_rel_mean'] = np.mean(motion[:, 1])
+
+        if os.path.isfile(ctx.files["params"]):
+            LOG.debug('Eddy parameters file detected')
+            params = read_eddy_text(ctx.files["params"])
+            qc_data["motion_v2v_trans"] = params[:,0:3]
+            qc_data["motion_v2v_rot"] = np.rad2deg(params[:,3:6])
+            qc_data['motion_ec_lin'] = params[:,6:9]
+            qc_data['motion_v2v_trans_mean'] = np.mean(params[:,0:3], axis=0)
+            qc_data['motion_v2v_rot_mean'] = np.mean(np.rad2deg(params[:,3:6]), axis=0)
+            qc_data['motion_ec_lin_std'] = np.std(params[:,6:9], axis=0)
+        return qc_data
+
+class SliceToVolume(Stage):
+    """
+    Slice to volume (within volume) motion
+    """
+    name = "s2v"
+
+    def inputs(self, ctx):
+        return [ctx.files["s2v_params"], ctx.mask_file, ctx.slspec_file] + ctx.acq_files
+
+    def outputs(self, ctx):
+        if not os.path.isfile(ctx.files["s2v_params"]):
+            return []
+        return [os.path.join(ctx.output, S2V_VAR_FNAME)]
+
+    def run(self, ctx):
+        qc_data = {}
+        if not os.path.isfile(ctx.files["s2v_params"]):
+            return qc_data
+
+        LOG.debug('Eddy s2v movement file detected')
+        s2v_params = read_eddy_text(ctx.files["s2v_params"])
+        if ctx.slspec is None:
+            LOG.warn('slspec file not provided. Assuming one excitation per slice.')
+        n_ex, ex_mask = excitation_mask(ctx.slspec, ctx.mask, ctx.eddy_epi.shape[2])
+
+        num_vols = ctx.bvals.size
+        if n_ex * num_vols != s2v_params.shape[0]:
+            LOG.warn('Number of s2v parameters does not match the expected one! Skipping s2v QC...')
+            return qc_data
+
+        s2v_params = np.hstack([s2v_params[:, 0:3], np.rad2deg(s2v_params[:, 3:6])])
+        s2v_var = s2v_variance(s2v_params, num_vols, ex_mask)
+        qc_data['motion_s2v_trans'] = s2v_params[:, 0:3]
+        qc_data['motion_s2v_rot'] = s2v_params[:, 3:6]
+        qc_data['motion_s2v_trans_var'] = s2v_var[:, 0:3]
+        qc_data['motion_s2v_rot_var'] = s2v_var[:, 3:6]
+        qc_data['motion_s2v_trans_std_mean'] = np.sqrt(np.mean(qc_data['motion_s2v_trans_var'], axis=0))
+        qc_data['motion_s2v_rot_std_mean'] = np.sqrt(np.mean(qc_data['motion_s2v_rot_var'], axis=0))
+        # Per-volume variance time series: translations (mm^2) then rotations (deg^2)
+        np.savetxt(os.path.join(ctx.output, S2V_VAR_FNAME), s2v_var, fmt='%f', delimiter=' ')
+        return qc_data
+
+class Outliers(Stage):
+    """
+    Slice outliers detected by EDDY
+    """
+    name = "outliers"
+
+    def inputs(self, ctx):
+        return [ctx.files["ol_map"], ctx.files["ol_map_std"], ctx.eddyfile] + ctx.acq_files
+
+    def options(self, ctx):
+        return {"bval_rounding" : ctx.bval_rounding}
+
+    def run(self, ctx):
+        qc_data = {}
+        if not os.path.isfile(ctx.files["ol_map"]):
+            return qc_data
+
+        LOG.debug('Outliers outuput files detected')
+        data = ctx.data
+        num_slices = ctx.eddy_epi.shape[2]
+        # The binary map is kept bit-packed so it can be stored for cross-subject analysis
+        ol_map = pack_outlier_map(read_eddy_text(ctx.files["ol_map"]))
+        ol_map_std = read_eddy_text(ctx.files["ol_map_std"])
+        counts = outlier_counts(ol_map, ctx.shell_idx, ctx.pe_idx, ctx.unique_bvals.size, ctx.unique_pedirs.size)
+        dw = ctx.unique_bvals > 100
+        shell_pe, vols_shell_pe = counts["shell_pe"][dw], counts["vols_shell_pe"][dw]
+        qc_data['outliers_tot'] = 100*counts["vol"].sum()/(data['num_dw_vols']*num_slices)
+        qc_data['outliers_tot_vol'] = 100*counts["vol"]/ol_map["shape"][1]
+        qc_data['outliers_tot_slice'] = 100*counts["slice"]/data['num_dw_vols']
+        qc_data['outliers_slice_vol'] = ol_map_std
+        qc_data['outliers_map'] = ol_map
+        qc_data['outliers_tot_bval'] = 100*shell_pe.sum(axis=1)/(vols_shell_pe.sum(axis=1)*num_slices)
+        qc_data['outliers_tot_pe'] = 100*counts["shell_pe"].sum(axis=0)/(ctx.counts_pedirs*num_slices)
+        # Shells x PE directions, -1 where a shell has no volumes with a PE direction
+        with np.errstate(invalid="ignore", divide="ignore"):
+            qc_data['outliers_tot_bval_pe'] = np.where(vols_shell_pe > 0, 100*shell_pe/(vols_shell_pe*num_slices), -1.0)
+        return qc_data
+
+class Cnr(Stage):
+    """
+    SNR/CNR from the EDDY CNR maps
+    """
+    name = "cnr"
+
+    def inputs(self, ctx):
+        return [ctx.files["cnr"], ctx.mask_file] + ctx.acq_files
+
+    def options(self, ctx):
+        return {"precision" : ctx.precision, "bval_rounding" : ctx.bval_rounding}
+
+    def outputs(self, ctx):
+        if not os.path.isfile(ctx.files["cnr"]):
+            return []
+        return [os.path.join(ctx.output, f"cnr_b{bval}.png") for bval in ctx.unique_bvals]
+
+    def run(self, ctx):
+        qc_data = {}
+        if not os.path.isfile(ctx.files["cnr"]):
+            return qc_data
+
+        LOG.debug('CNR output files detected')
+        cnrImg = load_image(ctx.files["cnr"])
+        cnr_stats = masked_volume_stats(cnrImg, ctx.mask_idx, block_size=ctx.block_sizes["cnr"], threads=ctx.threads, precision=ctx.precision, bbox=ctx.bbox)
+        save_index(cnrImg)
+        if np.count_nonzero(cnr_stats["num_nan"]):
+            LOG.warn("NaNs detected in the CNR maps")
+        num_shells = ctx.data['unique_bvals'].size
+        qc_data['snr_mean'] = float(cnr_stats["mean"][0])
+        qc_data['snr_std'] = float(cnr_stats["std"][0])
+        qc_data['cnr_mean_bval'] = cnr_stats["mean"][1:num_shells+1]
+        qc_data['cnr_std_bval'] = cnr_stats["std"][1:num_shells+1]
+
+        # Output CNR/SNR slice maps. The volume is only read if the image is not in the render cache
+        for idx, bval in enumerate(ctx.unique_bvals):
+            with ctx.perf.measure("slice_pngs"):
+                i_max = np.round(cnr_stats["mean"][idx] + 3*cnr_stats["std"][idx])
+                key = render_key([ctx.files["cnr"]], volume=idx, window=[0, i_max], zooms=_zooms(ctx), renderer="png")
+                render = lambda: png_bytes(render_slices(np.asanyarray(cnrImg.dataobj[..., idx]), i=(0, i_max), zooms=_zooms(ctx)))
+                _write_png(ctx, f"cnr_b{bval}.png", cached_render(key, render))
+        return qc_data
+
+class Residuals(Stage):
+    """
+    Mean squared residuals for each volume
+    """
+    name = "residuals"
+
+    def inputs(self, ctx):
+        return [ctx.files["residuals"], ctx.mask_file]
+
+    def options(self, ctx):
+        return {"precision" : ctx.precision}
+
+    def run(self, ctx):
+        qc_data = {}
+        if not os.path.isfile(ctx.files["residuals"]):
+            return qc_data
+
+        LOG.debug('Eddy residuals file detected')
+        rssImg = load_image(ctx.files["residuals"])
+        qc_data['res_mean'] = masked_volume_stats(rssImg, ctx.mask_idx, block_size=ctx.block_sizes["residuals"], threads=ctx.threads, precision=ctx.precision, bbox=ctx.bbox)["mean_sq"]
+        save_index(rssImg)
+        # FIXME
+        # np.savetxt(data['path'] + '/eddy_msr.txt', np.reshape(qc_data['avg_rss'], (1,-1)), fmt='%f', delimiter=' ')
+        return qc_data
+
+class Field(Stage):
+    """
+    Susceptibility induced displacement from the TOPUP field
+    """
+    name = "field"
+
+    def inputs(self, ctx):
+        return [ctx.field, ctx.mask_file] + ctx.acq_files
+
+    def options(self, ctx):
+        return {"precision" : ctx.precision}
+
+    def run(self, ctx):
+        qc_data = {}
+        if ctx.field is None:
+            return qc_data
+        if not os.path.isfile(ctx.field):
+            raise ValueError(f"No such file: {ctx.field}")
+
+        LOG.debug('Topup fieldmap file detected')
+        fieldImg = load_image(ctx.field)
+        # Displacement is the field scaled by the readout time so its std is the scaled field std
+        field_stats = masked_volume_stats(fieldImg, ctx.mask_idx, block_size=ctx.block_sizes["field"], precision=ctx.precision, bbox=ctx.bbox)
+        qc_data['field_disp_std'] = float(field_stats["std"][0] * abs(ctx.eddy_para[3]))
+        return qc_data
+
+STAGES = [CorrectedVolumes(), Motion(), SliceToVolume(), Outliers(), Cnr(), Residuals(), Field()]
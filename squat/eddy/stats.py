@@ -0,0 +1,132 @@
+"""
+SQUAT: Study-wise QUality Assessment Tool
+
+Masked image statistics. The in-mask voxel index is computed once and then
+per-volume statistics for every volume of an image are computed in a single
+vectorised pass over blocks of volumes. Only the bounding box of the mask
+needs to be read, since voxels outside it never contribute to the statistics.
+At float32 precision the statistics are computed on the stored data values
+and the image scaling is applied to the results
+
+Martin Craig, SPMIC, Nottingham
+"""
+import logging
+
+import numpy as np
+
+from .volumes import iter_volume_blocks, compute_dtype, scaling
+
+LOG = logging.getLogger(__name__)
+
+# Number of voxels either side of the mask included in its bounding box
+CROP_MARGIN = 2
+
+def mask_bbox(mask, margin=CROP_MARGIN):
+    """
+    Get the bounding box of a mask
+
+    :param mask: 3D mask array, non-zero voxels are in the mask
+    :param margin: Number of voxels to include either side of the mask, within the volume
+    :return: Tuple of three slices selecting the bounding box. If the mask is empty
+             this selects the whole volume
+    """
+    mask = np.asanyarray(mask) != 0
+    if not mask.any():
+        return tuple(slice(0, size) for size in mask.shape)
+    bbox = []
+    for axis, size in enumerate(mask.shape):
+        nonzero = np.flatnonzero(mask.any(axis=tuple(a for a in range(3) if a != axis)))
+        bbox.append(slice(max(0, int(nonzero[0]) - margin), min(size, int(nonzero[-1]) + 1 + margin)))
+    return tuple(bbox)
+
+def uncrop(data, bbox, shape, fill=0):
+    """
+    Pad data cropped to a bounding box back to the full volume, e.g. for rendering
+
+    :param data: Array [NX, NY, NZ, ...] cropped to the bounding box
+    :param bbox: Bounding box from :func:`mask_bbox`, or None for no cropping
+    :param shape: Shape of the full volume
+    :param fill: Value of voxels outside the bounding box
+    :return: Array with the first three dimensions of the full volume
+    """
+    if bbox is None:
+        return data
+    full = np.full(tuple(shape[:3]) + data.shape[3:], fill, dtype=np.result_type(data, fill))
+    full[bbox] = data
+    return full
+
+def mask_index(mask):
+    """
+    Get the flat index of in-mask voxels
+
+    :param mask: 3D mask array, non-zero voxels are in the mask
+    :return: 1D array of indices into the Fortran-ordered flattened volume, as used by
+             :func:`masked_values`
+    """
+    return np.flatnonzero(np.ravel(np.asanyarray(mask), order="F") != 0)
+
+def masked_values(block, index):
+    """
+    Extract in-mask voxel values from a block of volumes
+
+    :param block: Array [NX, NY, NZ, NVOLS]
+    :param index: In-mask voxel index from :func:`mask_index`
+    :return: Array [NVOXELS, NVOLS]
+    """
+    num_vox = int(np.prod(block.shape[:3]))
+    return np.reshape(block, (num_vox, -1), order="F")[index]
+
+def masked_volume_stats(img, index, block_size=1, threads=1, precision="float64", bbox=None):
+    """
+    Get statistics of the in-mask voxels for every volume of an image
+
+    Non-finite values are excluded from the mean, std and mean square, so
+    the results match np.nanmean / np.nanstd over the finite in-mask voxels.
+
+    :param img: 3D or 4D nibabel image or Numpy array
+    :param index: In-mask voxel index from :func:`mask_index`. If ``bbox`` is given this
+                  is the index into the mask cropped to the bounding box
+    :param block_size: Maximum number of volumes to read at a time
+    :param threads: Maximum number of blocks to read concurrently
+    :param precision: Precision of element-wise arithmetic. Sums are always accumulated
+                      in float64
+    :param bbox: Bounding box from :func:`mask_bbox`. If given only the bounding box
+                 of each volume is read
+    :return: Dictionary of 1D arrays with one value per volume: ``mean``, ``std``,
+             ``mean_sq`` (mean of squared values), ``num_nan`` (number of NaN
+             values in the mask) and ``num_finite`` (number of finite values in the mask)
+    """
+    num_vols = 1 if len(img.shape) == 3 else img.shape[3]
+    stats = {
+        "mean" : np.full(num_vols, np.nan),
+        "std" : np.full(num_vols, np.nan),
+        "mean_sq" : np.full(num_vols, np.nan),
+        "num_nan" : np.zeros(num_vols, dtype=int),
+        "num_finite" : np.zeros(num_vols, dtype=int),
+    }
+
+    dtype = compute_dtype(precision)
+    for start, block in iter_volume_blocks(img, block_size, threads, precision, bbox):
+        values = masked_values(block, index).astype(dtype)
+        stop = start + values.shape[1]
+        finite = np.isfinite(values)
+        num_finite = np.count_nonzero(finite, axis=0)
+        stats["num_nan"][start:stop] = np.count_nonzero(np.isnan(values), axis=0)
+        stats["num_finite"][start:stop] = num_finite
+        values[~finite] = 0
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = values.sum(axis=0, dtype=np.float64) / num_finite
+            dev = np.where(finite, values - mean.astype(dtype), 0)
+            stats["mean"][start:stop] = mean
+            stats["std"][start:stop] = np.sqrt(np.square(dev).sum(axis=0, dtype=np.float64) / num_finite)
+            stats["mean_sq"][start:stop] = np.square(values).sum(axis=0, dtype=np.float64) / num_finite
+
+    slope, inter = scaling(img, precision)
+    if (slope, inter) != (1.0, 0.0):
+        # Mean square of scaled values is the scaled variance plus the squared scaled mean
+        stats["mean"] = stats["mean"] * slope + inter
+        stats["std"] = stats["std"] * abs(slope)
+        stats["mean_sq"] = np.square(stats["std"]) + np.square(stats["mean"])
+
+    return stats
@@ -0,0 +1,153 @@
+"""
+SQUAT: Study-wise QUality Assessment Tool
+
+Fast readers for the fixed-layout text files written by EDDY. If the image
+cache directory is enabled (see :func:`squat.utils.imageio.configure_cache`),
+decoded arrays are cached there in a binary file keyed on the source file
+size and modification time, so repeated reads do not need to parse text.
+Nothing is ever written beside the source files
+
+Martin Craig, SPMIC, Nottingham
+"""
+import os
+import logging
+
+import numpy as np
+
+from ..utils.imageio import cache_sidecar, trim_cache
+
+LOG = logging.getLogger(__name__)
+
+CACHE_SUFFIX = ".squat_cache.npz"
+
+# Layout of EDDY text outputs keyed by file extension. ncols=None means the
+# number of columns is not fixed (e.g. it depends on the EDDY version)
+EDDY_TEXT_FORMATS = {
+    ".eddy_movement_rms" : {"dtype" : float, "skip_header" : 0, "ncols" : 2},
+    ".eddy_restricted_movement_rms" : {"dtype" : float, "skip_header" : 0, "ncols" : 2},
+    ".eddy_parameters" : {"dtype" : float, "skip_header" : 0, "ncols" : None},
+    ".eddy_movement_over_time" : {"dtype" : float, "skip_header" : 0, "ncols" : 6},
+    ".eddy_outlier_map" : {"dtype" : np.uint8, "skip_header" : 1, "ncols" : None},
+    ".eddy_outlier_n_stdev_map" : {"dtype" : float, "skip_header" : 1, "ncols" : None},
+    ".eddy_outlier_n_sqr_stdev_map" : {"dtype" : float, "skip_header" : 1, "ncols" : None},
+}
+
+# Lookup table of the bytes which may appear in a binary outlier map
+_BINARY_CHARS = np.zeros(256, dtype=bool)
+_BINARY_CHARS[[ord(c) for c in "01 \t\r\n"]] = True
+
+def _cache_fname(fname):
+    return cache_sidecar(fname, CACHE_SUFFIX)
+
+def _cache_key(fname, dtype, skip_header):
+    stat = os.stat(fname)
+    return {
+        "size" : stat.st_size,
+        "mtime" : stat.st_mtime_ns,
+        "dtype" : np.dtype(dtype).str,
+        "skip_header" : skip_header,
+    }
+
+def _load_cached(fname, key):
+    cache_fname = _cache_fname(fname)
+    if cache_fname is None or not os.path.isfile(cache_fname):
+        return None
+    try:
+        with np.load(cache_fname, allow_pickle=False) as cached:
+            for k, v in key.items():
+                if cached[k].item() != v:
+                    LOG.debug(f"Cached data for {fname} is out of date")
+                    return None
+            data = cached["data"]
+        # Mark as recently used
+        os.utime(cache_fname)
+        return data
+    except (OSError, ValueError, KeyError) as exc:
+        LOG.debug(f"Could not read cached data for {fname}: {exc}")
+        return None
+
+def _save_cached(fname, key, data):
+    cache_fname = _cache_fname(fname)
+    if cache_fname is None:
+        return
+    tmp_fname = cache_fname + f".{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(cache_fname), exist_ok=True)
+        with open(tmp_fname, "wb") as f:
+            np.savez(f, data=data, **key)
+        os.replace(tmp_fname, cache_fname)
+        trim_cache(cache_fname)
+    except OSError as exc:
+        # Not fatal - e.g. the cache directory may be read-only or full
+        LOG.debug(f"Could not write cached data for {fname}: {exc}")
+        try:
+            os.remove(tmp_fname)
+        except OSError:
+            pass
+
+def _parse_binary_map(content):
+    """
+    Parse a whitespace separated matrix of single 0/1 digits directly from its bytes
+
+    :return: 2D uint8 array or None if the content is not a binary map
+    """
+    buf = np.frombuffer(content, dtype=np.uint8)
+    if not _BINARY_CHARS[buf].all():
+        return None
+    first_line = content.strip().split(b"\n", 1)[0]
+    num_cols = len(first_line.split())
+    digits = buf[(buf == ord("0")) | (buf == ord("1"))] - ord("0")
+    if num_cols == 0 or digits.size % num_cols != 0:
+        return None
+    return digits.reshape(-1, num_cols)
+
+def _parse(fname, dtype, skip_header):
+    with open(fname, "rb") as f:
+        for _ in range(skip_header):
+            f.readline()
+        content = f.read()
+
+    data = None
+    if np.dtype(dtype) == np.uint8:
+        data = _parse_binary_map(content)
+    if data is None:
+        lines = content.decode("utf-8").splitlines()
+        data = np.loadtxt(lines, dtype=dtype, ndmin=2)
+    return data
+
+def read_text_array(fname, dtype=float, skip_header=0, ncols=None, cache=True):
+    """
+    Read a 2D numeric matrix from a whitespace separated text file
+
+    :param fname: File name
+    :param dtype: Data type of values
+    :param skip_header: Number of header lines to skip
+    :param ncols: Expected number of columns, or None to accept any
+    :param cache: If True, use and update the binary cache of decoded data, if the
+                  image cache directory is enabled
+    :return: 2D Numpy array [NROWS, NCOLS]
+    """
+    key = _cache_key(fname, dtype, skip_header)
+    data = _load_cached(fname, key) if cache else None
+    if data is None:
+        data = _parse(fname, dtype, skip_header)
+        if cache:
+            _save_cached(fname, key, data)
+
+    if ncols is not None and data.shape[1] != ncols:
+        raise ValueError(f"Expected {ncols} columns in {fname} - found {data.shape[1]}")
+    return data
+
+def read_eddy_text(fname, cache=True):
+    """
+    Read an EDDY text output file using its known layout
+
+    :param fname: File name, which must end with a recognized EDDY extension
+    :param cache: If True, use and update the binary cache of decoded data, if the
+                  image cache directory is enabled
+    :return: 2D Numpy array [NROWS, NCOLS]
+    """
+    for ext, fmt in EDDY_TEXT_FORMATS.items():
+        if fname.endswith(ext):
+            return read_text_array(fname, cache=cache, **fmt)
+    raise ValueError(f"Not a recognized EDDY text output file: {fname}")
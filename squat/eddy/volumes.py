@@ -0,0 +1,373 @@
+"""
+SQUAT: Study-wise QUality Assessment Tool
+
+Streaming access to 4D images from an EDDY run. Volumes are read in blocks
+directly from the image data object so the whole 4D image is never held in
+memory at once. Reads can be restricted to a bounding box, e.g. of the brain
+mask, so voxels which do not contribute to a reduction are never processed.
+
+Reductions can be done at ``float32`` or ``float64`` precision. At ``float32``
+precision blocks are read in the stored data type without applying the NIfTI
+``scl_slope``/``scl_inter`` scaling, element-wise arithmetic is done in float32
+and sums are accumulated in float64. The scaling is applied to the aggregated
+results, which is exact for means and standard deviations since it is linear
+
+Martin Craig, SPMIC, Nottingham
+"""
+import collections
+import concurrent.futures
+import logging
+import threading
+
+import numpy as np
+
+from ..utils.imageio import load_image, close_image, has_index, image_memmap
+
+LOG = logging.getLogger(__name__)
+
+PRECISIONS = ("float32", "float64")
+
+DEFAULT_PRECISION = "float32"
+
+DEFAULT_BLOCK_SIZE = 8
+
+# Maximum relative difference between statistics computed at float32 precision
+# and the same statistics computed at float64 precision. This is checked by the
+# test suite and is well below the precision to which QC values are reported
+FLOAT32_RTOL = 1e-5
+
+def compute_dtype(precision):
+    """
+    :param precision: One of :data:`PRECISIONS`
+    :return: Numpy dtype used for element-wise arithmetic at given precision
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision: {precision} - must be one of {', '.join(PRECISIONS)}")
+    return np.dtype(precision)
+
+def crop_shape(shape, bbox):
+    """
+    :param shape: Image shape
+    :param bbox: Bounding box from :func:`squat.eddy.stats.mask_bbox`, or None for no cropping
+    :return: Shape of the image cropped to the bounding box
+    """
+    if bbox is None:
+        return tuple(shape)
+    return tuple(len(range(*box.indices(size))) for box, size in zip(bbox, shape[:3])) + tuple(shape[3:])
+
+def _reads_unscaled(img, precision):
+    """
+    :return: True if blocks of an image are read in the stored data type at given precision
+    """
+    return compute_dtype(precision) != np.float64 and hasattr(getattr(img, "dataobj", None), "_get_unscaled")
+
+def scaling(img, precision="float64"):
+    """
+    Get the scaling to apply to aggregates of blocks from :func:`iter_volume_blocks`
+
+    :param img: nibabel image or Numpy array
+    :param precision: Precision passed to :func:`iter_volume_blocks`
+    :return: Tuple of (slope, intercept). Blocks which have already been scaled
+             have a slope of 1 and intercept of 0
+    """
+    if not _reads_unscaled(img, precision):
+        return 1.0, 0.0
+    return float(img.dataobj.slope), float(img.dataobj.inter)
+
+def _read_block(dataobj, slicer, unscaled):
+    if unscaled:
+        return np.asanyarray(dataobj._get_unscaled(slicer))
+    return np.asanyarray(dataobj[slicer])
+
+def _iter_volume_blocks_concurrent(img, ranges, threads, unscaled, bbox):
+    """
+    Read blocks of volumes on a pool of threads, each with its own handle on the image
+
+    At most ``threads`` blocks are in flight at once, and blocks are yielded in order
+    """
+    fname = img.get_filename()
+    local = threading.local()
+    thread_imgs = []
+
+    def _read(start, stop):
+        if not hasattr(local, "img"):
+            local.img = load_image(fname)
+            thread_imgs.append(local.img)
+        return _read_block(local.img.dataobj, bbox + (slice(start, stop),), unscaled)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+            pending = collections.deque()
+            for start, stop in ranges:
+                pending.append((start, executor.submit(_read, start, stop)))
+                if len(pending) >= threads:
+                    start, future = pending.popleft()
+                    yield start, future.result()
+            while pending:
+                start, future = pending.popleft()
+                yield start, future.result()
+    finally:
+        for thread_img in thread_imgs:
+            close_image(thread_img)
+
+def iter_volume_blocks(img, block_size=1, threads=1, precision="float64", bbox=None):
+    """
+    Iterate over blocks of volumes in a 3D or 4D image
+
+    :param img: nibabel image or Numpy array. Compressed images should be loaded with
+                :func:`squat.utils.imageio.load_image` so consecutive blocks are read
+                without decompressing the file from the start each time. A 3D
+                image is treated as a single volume
+    :param block_size: Maximum number of volumes in each block
+    :param threads: Maximum number of blocks to read concurrently. Only used for
+                    images which have a persisted seek-point index, since
+                    otherwise each thread would decompress from the start of the file
+    :param precision: If ``float32``, blocks of nibabel images are returned in the stored
+                      data type without scaling, and :func:`scaling` gives the
+                      scaling to apply to aggregated results
+    :param bbox: Tuple of three slices selecting the part of each volume to read, e.g.
+                 from :func:`squat.eddy.stats.mask_bbox`. Defaults to the whole volume
+    :return: Generator of tuples (start index, block data [NX, NY, NZ, NVOLS])
+    """
+    dataobj = getattr(img, "dataobj", img)
+    unscaled = _reads_unscaled(img, precision)
+    bbox = (slice(None),) * 3 if bbox is None else tuple(bbox)
+    if unscaled:
+        # Blocks of a memory-mapped image are views, so nothing is copied until they are used
+        mapped = image_memmap(img)
+        if mapped is not None:
+            dataobj, unscaled = mapped, False
+    if len(img.shape) == 3:
+        yield 0, _read_block(dataobj, bbox, unscaled)[..., np.newaxis]
+        return
+
+    block_size = max(1, int(block_size))
+    num_vols = img.shape[3]
+    ranges = [(start, min(start + block_size, num_vols)) for start in range(0, num_vols, block_size)]
+    if isinstance(dataobj, np.memmap):
+        for start, stop in ranges:
+            yield start, dataobj[bbox + (slice(start, stop),)]
+    elif threads > 1 and len(ranges) > 1 and has_index(img):
+        LOG.debug(f"Reading {len(ranges)} blocks using {threads} threads")
+        yield from _iter_volume_blocks_concurrent(img, ranges, threads, unscaled, bbox)
+    else:
+        for start, stop in ranges:
+            yield start, _read_block(dataobj, bbox + (slice(start, stop),), unscaled)
+
+class Accumulator:
+    """
+    A metric computed from a single read pass over a 4D image
+
+    Accumulators are passed to :func:`accumulate`, which reads the image once and
+    passes every block of volumes to every accumulator, so adding a metric to the
+    pass needs no extra reading or decompression.
+
+    Blocks are 2D arrays [NVOXELS, NVOLS] of the voxels of each volume in Fortran
+    order, at the compute precision of the pass. At ``float32`` precision the image
+    scaling has not been applied, so accumulators should only compute quantities
+    which the scaling can be applied to afterwards in :meth:`result`
+    """
+
+    def start(self, shape, dtype):
+        """
+        Called before the first block
+
+        :param shape: Image shape
+        :param dtype: Compute data type of blocks
+        """
+        self.shape = tuple(shape)
+
+    def add(self, start, block, shell_idx, pe_idx):
+        """
+        Add a block of volumes
+
+        :param start: Index of first volume in block
+        :param block: Array [NVOXELS, NVOLS]
+        :param shell_idx: Shell index of each volume in the block
+        :param pe_idx: Phase encoding direction index of each volume in the block
+        """
+        raise NotImplementedError()
+
+    def result(self, slope=1.0, inter=0.0):
+        """
+        :param slope: Image scaling slope to apply to the result
+        :param inter: Image scaling intercept to apply to the result
+        :return: The metric
+        """
+        raise NotImplementedError()
+
+class GroupMeans(Accumulator):
+    """
+    Mean volume of each of a number of groups of volumes
+
+    Peak memory is the per-group running sums plus a single block of volumes, regardless
+    of the number of volumes in the acquisition. Subclasses define the group of each volume
+    """
+
+    def __init__(self, num_groups):
+        self.num_groups = num_groups
+
+    def groups(self, shell_idx, pe_idx):
+        """
+        :return: Group index of each volume in a block, or -1 for volumes not in any group
+        """
+        raise NotImplementedError()
+
+    def start(self, shape, dtype):
+        Accumulator.start(self, shape, dtype)
+        self.sums = np.zeros((int(np.prod(shape[:3])), self.num_groups), dtype=np.float64)
+        self.counts = np.zeros(self.num_groups, dtype=np.float64)
+
+    def add(self, start, block, shell_idx, pe_idx):
+        groups = np.asarray(self.groups(shell_idx, pe_idx))
+        # Each group is summed over its own volumes only, so a non-finite voxel in one
+        # volume only affects the mean of that volume's group
+        for group in np.unique(groups[groups >= 0]):
+            vols = groups == group
+            self.sums[:, group] += block[:, vols].sum(axis=1, dtype=np.float64)
+            self.counts[group] += np.count_nonzero(vols)
+
+    def result(self, slope=1.0, inter=0.0):
+        """
+        :return: Array of mean volumes [NX, NY, NZ, NGROUPS]. Groups with no volumes are NaN
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = self.sums / self.counts
+            if (slope, inter) != (1.0, 0.0):
+                means = means * slope + inter
+        return np.reshape(means, self.shape[:3] + (self.num_groups,), order="F")
+
+class ShellMeans(GroupMeans):
+    """
+    Mean volume of each shell
+    """
+    def groups(self, shell_idx, pe_idx):
+        return shell_idx
+
+class ShellPeMeans(GroupMeans):
+    """
+    Mean volume for each phase encoding direction of the volumes in one shell,
+    e.g. the b=0 volumes
+    """
+
+    def __init__(self, shell, num_pe_dirs):
+        GroupMeans.__init__(self, num_pe_dirs)
+        self.shell = shell
+
+    def groups(self, shell_idx, pe_idx):
+        return np.where(shell_idx == self.shell, pe_idx, -1)
+
+class VolumeSignal(Accumulator):
+    """
+    Mean in-mask signal of each volume
+    """
+
+    def __init__(self, mask_idx):
+        """
+        :param mask_idx: In-mask voxel index from :func:`squat.eddy.stats.mask_index`
+        """
+        self.mask_idx = mask_idx
+
+    def start(self, shape, dtype):
+        Accumulator.start(self, shape, dtype)
+        self.sums = np.zeros(1 if len(shape) == 3 else shape[3], dtype=np.float64)
+
+    def add(self, start, block, shell_idx, pe_idx):
+        self.sums[start:start+block.shape[1]] = block[self.mask_idx].sum(axis=0, dtype=np.float64)
+
+    def result(self, slope=1.0, inter=0.0):
+        """
+        :return: 1D array of mean in-mask signal for each volume
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.sums / self.mask_idx.size * slope + inter
+
+class SliceProfiles(Accumulator):
+    """
+    Mean in-mask signal of each slice of each volume
+    """
+
+    def __init__(self, mask_idx):
+        """
+        :param mask_idx: In-mask voxel index from :func:`squat.eddy.stats.mask_index`
+        """
+        self.mask_idx = mask_idx
+
+    def start(self, shape, dtype):
+        Accumulator.start(self, shape, dtype)
+        # The Fortran-order voxel index is sorted by slice, so in-mask voxels of each slice
+        # are contiguous and slices can be summed with a single reduceat
+        slices = self.mask_idx // (shape[0] * shape[1])
+        self.counts = np.bincount(slices, minlength=shape[2])
+        self.slices = np.flatnonzero(self.counts)
+        self.offsets = np.searchsorted(slices, self.slices)
+        self.sums = np.zeros((1 if len(shape) == 3 else shape[3], shape[2]), dtype=np.float64)
+
+    def add(self, start, block, shell_idx, pe_idx):
+        if self.slices.size:
+            sums = np.add.reduceat(block[self.mask_idx], self.offsets, axis=0, dtype=np.float64)
+            self.sums[start:start+block.shape[1], self.slices] = sums.T
+
+    def result(self, slope=1.0, inter=0.0):
+        """
+        :return: Array [NVOLS, NZ] of mean in-mask signal. Slices with no voxels in the mask are NaN
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.sums / self.counts * slope + inter
+
+def accumulate(img, accumulators, shell_idx=None, pe_idx=None, block_size=1, threads=1, precision="float64", bbox=None):
+    """
+    Pass every block of volumes from a single read pass over an image to a set of accumulators
+
+    :param img: 3D or 4D nibabel image or Numpy array
+    :param accumulators: Sequence of :class:`Accumulator` instances
+    :param shell_idx: Shell index of each volume. Defaults to all zero
+    :param pe_idx: Phase encoding direction index of each volume. Defaults to all zero
+    :param block_size: Maximum number of volumes to read at a time
+    :param threads: Maximum number of blocks to read concurrently
+    :param precision: Precision of element-wise arithmetic. Sums are always accumulated
+                      in float64
+    :param bbox: Bounding box from :func:`squat.eddy.stats.mask_bbox`. If given only
+                 the bounding box of each volume is read, and accumulators see the
+                 image as if it had been cropped to it
+    :return: List of the results of each accumulator
+    """
+    num_vols = 1 if len(img.shape) == 3 else img.shape[3]
+    indices = []
+    for name, idx in (("shell", shell_idx), ("phase encoding direction", pe_idx)):
+        idx = np.zeros(num_vols, dtype=int) if idx is None else np.asarray(idx, dtype=int)
+        if idx.size != num_vols:
+            raise ValueError(f"Number of {name} indices {idx.size} does not match number of volumes {num_vols}")
+        indices.append(idx)
+    shell_idx, pe_idx = indices
+
+    dtype = compute_dtype(precision)
+    shape = crop_shape(img.shape, bbox)
+    num_vox = int(np.prod(shape[:3]))
+    for acc in accumulators:
+        acc.start(shape, dtype)
+    for start, block in iter_volume_blocks(img, block_size, threads, precision, bbox):
+        num_block_vols = block.shape[3]
+        block = np.reshape(block, (num_vox, num_block_vols), order="F").astype(dtype, copy=False)
+        stop = start + num_block_vols
+        for acc in accumulators:
+            acc.add(start, block, shell_idx[start:stop], pe_idx[start:stop])
+        LOG.debug(f"Accumulated volumes {start}-{stop-1}")
+
+    slope, inter = scaling(img, precision)
+    return [acc.result(slope, inter) for acc in accumulators]
+
+def shell_means(img, shell_idx, num_shells, block_size=1, threads=1, precision="float64"):
+    """
+    Get the mean volume for each shell, reading the image a block of volumes at a time
+
+    :param img: 4D nibabel image
+    :param shell_idx: Array mapping each volume to a shell index in range [0, num_shells)
+    :param num_shells: Number of shells
+    :param block_size: Maximum number of volumes to read at a time
+    :param threads: Maximum number of blocks to read concurrently
+    :param precision: Precision of element-wise arithmetic. Sums are always accumulated
+                      in float64
+    :return: Array of mean volumes [NX, NY, NZ, NSHELLS]
+    """
+    return accumulate(img, [ShellMeans(num_shells)], shell_idx, None, block_size, threads, precision)[0]
@@ -13,17 +13,11 @@ import logging
 import argparse
 import sys
 
-import matplotlib
-import matplotlib.style
-
 warnings.filterwarnings("ignore")
-matplotlib.use('Agg')   # generate pdf output by default
-matplotlib.interactive(False)
-matplotlib.style.use('classic')
 
 from ._version import __version__
-from .report import Report
 from .data import GroupData, SubjectData, read_json
+from .utils.jsonio import parse_digits
 from .test.data import generate_test_data
 
 LOG = logging.getLogger(__name__)
@@ -41,6 +35,22 @@ def _get_subjects(subjdir, fname):
         except IOError as exc:
             raise ValueError(f"Failed to find any subject directories in {subjdir}: {exc}")
 
+def _report_class():
+    """
+    Import the report generator and set up plotting
+
+    Report pulls in matplotlib, seaborn, pandas and nibabel, so this is deferred until
+    a report is actually requested
+    """
+    import matplotlib
+    import matplotlib.style
+    matplotlib.use('Agg')   # generate pdf output by default
+    matplotlib.interactive(False)
+    matplotlib.style.use('classic')
+
+    from .report import Report
+    return Report
+
 def _setup_logging(args):
     if args.debug:
         logging.getLogger("squat").setLevel(logging.DEBUG)
@@ -74,6 +84,10 @@ def main():
     parser.add_argument('--overwrite', action="store_true", default=False, help='If specified, overwrite any existing output')
     parser.add_argument('--generate-test-data', action="store_true", default=False, help='Generate test data')
     parser.add_argument('--generate-test-data-n', type=int, default=10, help='Generate test data for for this number of subjects')
+    parser.add_argument('--compact-json', action="store_true", default=False, help="Write group_data.json without indentation or line breaks")
+    parser.add_argument('--json-digits', nargs="+", help="Number of significant digits of floating point QC values in group_data.json, e.g. 6. A field name or glob pattern can be given to set the digits of matching fields, e.g. qc_outliers_*=3. By default values are written exactly")
+    parser.add_argument('--cache-dir', help="Directory of uncompressed copies of large compressed images shared with squat_eddy. Defaults to the SQUAT_CACHE_DIR environment variable")
+    parser.add_argument('--render-cache-dir', help="Directory of rendered slice images shared with squat_eddy, so report images of unchanged data are not rendered again. Defaults to the SQUAT_RENDER_CACHE_DIR environment variable")
     parser.add_argument('--debug', action="store_true", default=False, help="Enable debug logging")
     args = parser.parse_args()
 
@@ -82,17 +96,25 @@ def main():
         sys.exit(1)
 
     _setup_logging(args)
+    if args.cache_dir:
+        from .utils.imageio import configure_cache
+        configure_cache(args.cache_dir)
+    if args.render_cache_dir:
+        from .utils.rendercache import configure_render_cache
+        configure_render_cache(args.render_cache_dir)
     LOG.info(f"SQUAT: Study-wise QUality Assessment Tool v{__version__}")
 
     if not args.extract and not args.group_data and not args.generate_test_data:
         raise ValueError("Must specify either --extract or provide a previously extracted group data file with --group-data")
     elif args.extract and args.group_data:
         raise ValueError("Cannot specify --extract and --group-data at the same time")
+    digits, field_digits = parse_digits(args.json_digits)
 
     if args.group_report or args.subject_reports:
         if not args.report_def:
             raise ValueError("Report definition not given (--report-def)")
         report_def = read_json(args.report_def, "report definition")
+        Report = _report_class()
 
     if args.comparison_dists:
         args.comparison_dists = read_json(args.comparison_dists)
@@ -123,7 +145,7 @@ def main():
     if args.extract:
         LOG.info('Generating group data...')
         group_data = GroupData(subject_datas=subjqcdata)
-        group_data.write(os.path.join(args.output, "group_data.json"))
+        group_data.write(os.path.join(args.output, "group_data.json"), compact=args.compact_json, digits=digits, field_digits=field_digits)
         LOG.info('DONE')
     else:
         group_data = GroupData(fname=args.group_data)
@@ -5,8 +5,7 @@ Matteo Bastiani, FMRIB, Oxford
 Martin Craig, SPMIC, Nottingham
 """
 import datetime
-import os
-import tempfile
+import io
 import logging
 
 import numpy as np
@@ -18,7 +17,9 @@ import seaborn
 seaborn.set()
 import pandas as pd
 
-import fsl.wrappers as fsl
+from .utils.slicer import slice_strip
+from .utils.imageio import load_image
+from .utils.rendercache import render_key, cached_render
 
 LOG = logging.getLogger(__name__)
 
@@ -27,6 +28,18 @@ AMBER = [0.91, 0.71, 0.09, 0.5]
 GREEN = [0.18, 0.79, 0.22, 0.5]
 NOCOLOUR = [0, 0, 0, 0]
 
+def _render_strip(fname, fill):
+    """
+    Render orthogonal slices of the first volume of a NIfTI image
+
+    :return: Slice strip as a float32 array in .npy format
+    """
+    nii = load_image(fname)
+    vol = nii.dataobj if nii.ndim == 3 else nii.dataobj[..., 0]
+    buf = io.BytesIO()
+    np.save(buf, slice_strip(vol, zooms=nii.header.get_zooms()[:3], fill=fill))
+    return buf.getvalue()
+
 class Report():
 
     def __init__(self, report_def, group_data, subject_data=None, comparison_dists={}, amber_sigma=1, red_sigma=2):
@@ -391,21 +404,21 @@ class Report():
         if not img:
             return False
 
-        with tempfile.TemporaryDirectory() as tempdir:
-            vmax, vmin = None, None
-            if ".nii" in img:
-                slice_img_fname = os.path.join(tempdir, "slice.png")
-                vmin, vmax = plot.pop("vmin", 0), plot.pop("vmax", 1)
-                fsl.slicer(img, i=f"{vmin} {vmax}", a=slice_img_fname)
-            else:
-                slice_img_fname = img
-
-            slice_img = matplotlib.image.imread(slice_img_fname)
-            im = ax.imshow(slice_img.data, interpolation='none', cmap="gray")
-            if vmax is not None:
-                plt.colorbar(im, ax=ax)
-            ax.grid(False)
-            ax.axis('off')
+        vmax, vmin = None, None
+        if ".nii" in img:
+            # Render slices in-process so the colour bar shows the real intensity window.
+            # Renderings are reused from the render cache if the image is unchanged
+            vmin, vmax = plot.pop("vmin", 0), plot.pop("vmax", 1)
+            key = render_key([img], volume=0, window=[vmin, vmax], renderer="slice_strip")
+            slice_img = np.load(io.BytesIO(cached_render(key, lambda: _render_strip(img, vmin))))
+        else:
+            slice_img = matplotlib.image.imread(img)
+
+        im = ax.imshow(slice_img, interpolation='none', cmap="gray", vmin=vmin, vmax=vmax)
+        if vmax is not None:
+            plt.colorbar(im, ax=ax)
+        ax.grid(False)
+        ax.axis('off')
         return True
 
     def _distribution_plot(self, ax, plot):
@@ -0,0 +1,135 @@
+"""
+Benchmark of QC extraction on synthetic EDDY output
+
+Times each extraction stage at a range of data sizes using the performance
+data recorded by squat_eddy --perf. Run as::
+
+    python -m squat.test.benchmark --sizes small medium ukb --save results.json
+    python -m squat.test.benchmark --compare results.json
+
+Results saved from one version can be compared against a later version to
+check the effect of performance changes
+"""
+import argparse
+import glob
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from squat.eddy.extract import extract
+from squat.test.eddy_data import generate_eddy_dir
+
+# Data sizes. ukb resembles the UK Biobank diffusion protocol
+SIZES = {
+    "small" : {"shape" : (32, 32, 20), "num_vols" : 30, "num_shells" : 2, "num_pe_dirs" : 2, "mb_factor" : 1},
+    "medium" : {"shape" : (64, 64, 40), "num_vols" : 64, "num_shells" : 2, "num_pe_dirs" : 2, "mb_factor" : 2},
+    "ukb" : {"shape" : (104, 104, 72), "num_vols" : 105, "num_shells" : 2, "num_pe_dirs" : 2, "mb_factor" : 3, "zooms" : (2.0, 2.0, 2.0)},
+}
+
+def _clear_caches(*cache_dirs):
+    """
+    Remove index and cache files so each run measures a first extraction
+    """
+    for cache_dir in cache_dirs:
+        if cache_dir:
+            for fname in glob.glob(os.path.join(cache_dir, "*")):
+                if os.path.isfile(fname):
+                    os.remove(fname)
+
+def run_benchmark(size, datadir, repeats=3, keep_caches=False, **options):
+    """
+    Time extraction stages for one data size
+
+    :param size: Key in :data:`SIZES`
+    :param datadir: Directory for synthetic data. Data already generated there is reused
+    :param repeats: Number of times to run the extraction
+    :param keep_caches: If True, keep seek point indexes and text caches between runs
+    :param options: Other extraction options
+    :return: Dictionary mapping step name to the minimum wall time, CPU time and
+             peak memory over all runs, and the bytes read in the first run
+    """
+    eddydir = os.path.join(datadir, size)
+    args_fname = os.path.join(eddydir, "benchmark_args.json")
+    if os.path.isfile(args_fname):
+        with open(args_fname, "r") as f:
+            args = json.load(f)
+    else:
+        args = generate_eddy_dir(eddydir, **SIZES[size])
+        with open(args_fname, "w") as f:
+            json.dump(args, f)
+
+    # Seek point indexes are kept with the data rather than in the user's cache directory
+    options = dict(options, index_dir=os.path.join(datadir, "indexes"))
+    results = {}
+    for _ in range(repeats):
+        if not keep_caches:
+            _clear_caches(options.get("cache_dir"), options["index_dir"])
+        outdir = os.path.join(datadir, size + ".qc")
+        extract(**args, output=outdir, overwrite=True, perf=True, **options)
+        with open(os.path.join(outdir, "qc.json"), "r") as f:
+            perf = json.load(f)["perf"]
+        for step, measures in perf.items():
+            if step not in results:
+                results[step] = dict(measures)
+            else:
+                for key in ("wall_time", "cpu_time", "peak_rss"):
+                    if measures[key] is not None:
+                        results[step][key] = min(results[step][key], measures[key])
+    return results
+
+def _print_results(size, results, baseline=None):
+    print(f"\n{size}")
+    header = f"{'step':<14}{'wall (s)':>10}{'cpu (s)':>10}{'read (MB)':>11}{'peak (MB)':>11}"
+    if baseline is not None:
+        header += f"{'vs base':>9}"
+    print(header)
+    for step, measures in sorted(results.items(), key=lambda item: -item[1]["wall_time"]):
+        read = "-" if measures["bytes_read"] is None else f"{measures['bytes_read'] / 1e6:.1f}"
+        peak = "-" if measures["peak_rss"] is None else f"{measures['peak_rss'] / 1e6:.0f}"
+        line = f"{step:<14}{measures['wall_time']:>10.3f}{measures['cpu_time']:>10.3f}{read:>11}{peak:>11}"
+        if baseline is not None and step in baseline and baseline[step]["wall_time"] > 0:
+            line += f"{measures['wall_time'] / baseline[step]['wall_time']:>8.2f}x"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser("Benchmark QC extraction on synthetic EDDY output")
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=["small", "medium"], help="Data sizes to benchmark")
+    parser.add_argument("--datadir", help="Directory for synthetic data, reused between invocations. Defaults to a temporary directory")
+    parser.add_argument("--repeats", type=int, default=3, help="Number of runs at each size. The minimum time is reported")
+    parser.add_argument("--keep-caches", action="store_true", default=False, help="Keep seek point indexes and text caches between runs")
+    parser.add_argument("--threads", type=int, default=1, help="Extraction --threads option")
+    parser.add_argument("--precision", help="Extraction --precision option")
+    parser.add_argument("--cache-dir", help="Extraction --cache-dir option. Needed for text caches to be used")
+    parser.add_argument("--save", help="Save results to JSON file")
+    parser.add_argument("--compare", help="Compare against results previously saved with --save")
+    args = parser.parse_args()
+
+    options = {"threads" : args.threads}
+    if args.precision:
+        options["precision"] = args.precision
+    if args.cache_dir:
+        options["cache_dir"] = args.cache_dir
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+
+    datadir = args.datadir if args.datadir else tempfile.mkdtemp(prefix="squat_benchmark")
+    all_results = {}
+    try:
+        for size in args.sizes:
+            all_results[size] = run_benchmark(size, datadir, args.repeats, args.keep_caches, **options)
+            _print_results(size, all_results[size], baseline.get(size) if args.compare else None)
+    finally:
+        if not args.datadir:
+            shutil.rmtree(datadir)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(all_results, f, sort_keys=True, indent=4, separators=(',', ': '))
+
+if __name__ == "__main__":
+    sys.exit(main())
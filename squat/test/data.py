@@ -7,7 +7,8 @@ def generate_test_data(n_subjects, outdir, sample_subject):
         subjdir=os.path.join(outdir, "s%i" % sid)
         os.makedirs(subjdir, exist_ok=True)
         subj_data = {}
-        for k, v in sample_subject.items():
+        for k in sample_subject:
+            v = sample_subject[k]
             try:
                 v = v * random.normalvariate(v, v*2)
                 subj_data[k] = v
@@ -0,0 +1,140 @@
+"""
+Synthetic EDDY output for tests and benchmarks
+
+The generated data has the same files, shapes and data types as a real EDDY
+run. Image values are plausible but do not need to be physically consistent
+"""
+import os
+
+import numpy as np
+import nibabel as nib
+
+EDDYBASE = "eddy_corrected"
+
+OUTLIER_MAP_HEADER = "One row per scan, one column per slice. Outlier: 1, Non-outlier: 0"
+STDEV_MAP_HEADER = "One row per scan, one column per slice. Number of standard deviations off mean difference between observation and prediction"
+
+# Phase encoding direction rows of the acquisition parameters file
+PE_DIRS = [[0, 1, 0], [0, -1, 0], [1, 0, 0], [-1, 0, 0]]
+
+def _save_img(data, fname, zooms):
+    img = nib.Nifti1Image(data, np.diag(list(zooms) + [1]))
+    img.header.set_zooms(tuple(zooms) + (1.0,) * (data.ndim - 3))
+    nib.save(img, fname)
+
+def _open_img(fname, shape, dtype, zooms):
+    """
+    Open a NIfTI file for writing a volume at a time
+
+    :return: Open file, positioned at the start of the image data. Volumes must
+             be written in Fortran order
+    """
+    header = nib.Nifti1Header()
+    header.set_data_shape(shape)
+    header.set_data_dtype(dtype)
+    header.set_zooms(tuple(zooms) + (1.0,) * (len(shape) - 3))
+    header.set_sform(np.diag(list(zooms) + [1]), code="aligned")
+    header.set_data_offset(header.single_vox_offset)
+    f = nib.openers.ImageOpener(fname, "wb")
+    header.write_to(f)
+    return f
+
+def _save_text(fname, data, fmt, header=None):
+    with open(fname, "w") as f:
+        if header:
+            f.write(header + "\n")
+        np.savetxt(f, data, fmt=fmt)
+
+def _brain_mask(shape):
+    """
+    :return: Ellipsoidal mask filling most of the volume
+    """
+    coords = np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing="ij")
+    return sum(np.square(c / 0.8) for c in coords) <= 1
+
+def generate_eddy_dir(outdir, shape=(32, 32, 20), num_vols=30, num_shells=2, num_pe_dirs=2, mb_factor=1, zooms=(2.0, 2.0, 2.0), seed=0):
+    """
+    Write a synthetic EDDY output directory
+
+    Volumes cycle through b=0 and each shell, and through the phase encoding
+    directions. Shell b-values are jittered as in real acquisitions.
+
+    :param outdir: Output directory, created if it does not exist
+    :param shape: Image matrix size (NX, NY, NZ)
+    :param num_vols: Number of volumes
+    :param num_shells: Number of non-zero shells
+    :param num_pe_dirs: Number of phase encoding directions, up to 4
+    :param mb_factor: Multiband factor. Must divide the number of slices
+    :param zooms: Voxel sizes in mm
+    :param seed: Random seed
+    :return: Dictionary of keyword arguments for :func:`squat.eddy.extract.extract`
+    """
+    if shape[2] % mb_factor != 0:
+        raise ValueError(f"Multiband factor {mb_factor} does not divide number of slices {shape[2]}")
+    if not 1 <= num_pe_dirs <= len(PE_DIRS):
+        raise ValueError(f"Number of phase encoding directions must be between 1 and {len(PE_DIRS)}")
+
+    os.makedirs(outdir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    num_slices = shape[2]
+    num_ex = num_slices // mb_factor
+
+    def _eddyfile(ext):
+        return os.path.join(outdir, EDDYBASE + ext)
+
+    # Acquisition
+    shell_idx = np.arange(num_vols) % (num_shells + 1)
+    bvals = shell_idx * 1000 + rng.integers(-10, 11, num_vols) * (shell_idx > 0)
+    bvecs = rng.normal(size=(3, num_vols))
+    bvecs /= np.linalg.norm(bvecs, axis=0)
+    pe_idx = np.arange(num_vols) % num_pe_dirs
+    acqp = np.array([PE_DIRS[pe] + [0.05] for pe in range(num_pe_dirs)])
+    slspec = np.arange(num_slices).reshape(mb_factor, num_ex).T
+    _save_text(os.path.join(outdir, "bvals"), bvals[np.newaxis, :], "%i")
+    _save_text(os.path.join(outdir, "bvecs"), bvecs, "%.6f")
+    _save_text(os.path.join(outdir, "index.txt"), pe_idx[np.newaxis, :] + 1, "%i")
+    _save_text(os.path.join(outdir, "acqp.txt"), acqp, "%g")
+    _save_text(os.path.join(outdir, "slspec.txt"), slspec, "%i")
+
+    # Images, written a volume at a time to limit memory use at large sizes
+    mask = _brain_mask(shape)
+    _save_img(mask.astype(np.uint8), os.path.join(outdir, "nodif_brain_mask.nii.gz"), zooms)
+    shape4d = tuple(shape) + (num_vols,)
+    with _open_img(_eddyfile(".nii.gz"), shape4d, np.int16, zooms) as data, \
+         _open_img(_eddyfile(".eddy_residuals.nii.gz"), shape4d, np.float32, zooms) as residuals:
+        for vol in range(num_vols):
+            signal = 2000 * np.exp(-bvals[vol] * 0.0008) * mask
+            data.write(np.clip(signal + rng.normal(0, 30, shape), 0, None).astype(np.int16).tobytes(order="F"))
+            residuals.write((rng.normal(0, 30, shape) * mask).astype(np.float32).tobytes(order="F"))
+    cnr = rng.gamma(4, 1.0, tuple(shape) + (num_shells + 1,)).astype(np.float32) * mask[..., np.newaxis]
+    _save_img(cnr, _eddyfile(".eddy_cnr_maps.nii.gz"), zooms)
+    field = (rng.normal(0, 20, shape) * mask).astype(np.float32)
+    _save_img(field, os.path.join(outdir, "fieldmap_Hz.nii.gz"), zooms)
+
+    # Text outputs
+    motion = np.abs(rng.normal(0, 0.3, (num_vols, 2)))
+    params = np.hstack([rng.normal(0, 0.5, (num_vols, 3)), rng.normal(0, 0.01, (num_vols, 3)), rng.normal(0, 0.001, (num_vols, 10))])
+    s2v = np.hstack([rng.normal(0, 0.5, (num_vols * num_ex, 3)), rng.normal(0, 0.01, (num_vols * num_ex, 3))])
+    ol_map = (rng.random((num_vols, num_slices)) < 0.02).astype(np.uint8)
+    # EDDY does not detect outliers in b=0 volumes
+    ol_map[shell_idx == 0] = 0
+    ol_stdev = rng.normal(0, 1, (num_vols, num_slices))
+    _save_text(_eddyfile(".eddy_movement_rms"), motion, "%.6f")
+    _save_text(_eddyfile(".eddy_restricted_movement_rms"), motion / 2, "%.6f")
+    _save_text(_eddyfile(".eddy_parameters"), params, "%.6e")
+    _save_text(_eddyfile(".eddy_movement_over_time"), s2v, "%.6e")
+    _save_text(_eddyfile(".eddy_outlier_map"), ol_map, "%i", OUTLIER_MAP_HEADER)
+    _save_text(_eddyfile(".eddy_outlier_n_stdev_map"), ol_stdev, "%.6f", STDEV_MAP_HEADER)
+    _save_text(_eddyfile(".eddy_outlier_n_sqr_stdev_map"), np.square(ol_stdev), "%.6f", STDEV_MAP_HEADER)
+
+    return {
+        "eddydir" : outdir,
+        "eddybase" : EDDYBASE,
+        "idx" : "index.txt",
+        "eddy_params" : "acqp.txt",
+        "mask" : "nodif_brain_mask.nii.gz",
+        "bvals" : "bvals",
+        "bvecs" : "bvecs",
+        "field" : os.path.join(outdir, "fieldmap_Hz.nii.gz"),
+        "slspec" : os.path.join(outdir, "slspec.txt"),
+    }
@@ -3,6 +3,7 @@ import json
 import os
 
 import pytest
+import numpy as np
 
 from squat.data import GroupData, SubjectData
 
@@ -184,3 +185,15 @@ def test_load():
     finally:
         if fname is not None:
             os.remove(fname)
+
+def test_get_data_cached():
+    data = GroupData()
+    data["qc_test1"] = [[3, 4], [5, None]]
+    values = data.get_data("test1")
+    assert(values.shape == (2, 2))
+    assert(np.array_equal(values, [[3, 4], [5, np.nan]], equal_nan=True))
+    assert(not values.flags.writeable)
+    assert(np.shares_memory(data.get_data("test1"), values))
+    data["qc_test1"] = [[1], [2]]
+    assert(np.array_equal(data.get_data("test1"), [[1], [2]]))
+    assert(data.get_data("test2").size == 0)
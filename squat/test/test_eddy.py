@@ -0,0 +1,914 @@
+import tempfile
+import os
+import json
+import threading
+import shutil
+import re
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+from squat.eddy.volumes import shell_means, iter_volume_blocks, FLOAT32_RTOL, accumulate, ShellMeans, ShellPeMeans, VolumeSignal, SliceProfiles
+from squat.eddy.extract import extract, extract_batch
+from squat.eddy import manifest, memory
+from squat.eddy.scheduler import run_tasks
+from squat.utils import imageio
+from squat.utils.imageio import load_image, save_index, has_index, configure_cache, configure_index_cache, image_memmap, INDEX_SUFFIX
+from squat.eddy.textfiles import read_text_array, read_eddy_text, CACHE_SUFFIX
+from squat.eddy.stats import mask_index, masked_volume_stats, mask_bbox, uncrop
+from squat.eddy.outliers import outlier_counts
+from squat.utils.packbits import pack_outlier_map, unpack_outlier_map, packed_counts
+from squat.eddy.acquisition import acquisition_summary
+from squat.eddy.motion import excitation_mask, s2v_variance
+from squat.utils.bvals import bval_shells, round_bvals_median
+from squat.test.eddy_data import generate_eddy_dir, EDDYBASE
+from squat.data import SubjectData, GroupData, arrays_fname, read_json
+from squat.utils.jsonio import write_json, parse_digits
+from squat.utils.rendercache import configure_render_cache, render_key, cached_render, RENDER_SUFFIX
+from squat.eddy import stages
+
+def _save_img(data, fname):
+    nib.save(nib.Nifti1Image(data, np.eye(4)), fname)
+    return fname
+
+@pytest.mark.parametrize("block_size", [1, 3, 100])
+def test_shell_means(block_size):
+    data = np.random.rand(4, 5, 6, 7)
+    shell_idx = np.array([0, 1, 2, 1, 0, 2, 2])
+    with tempfile.TemporaryDirectory() as tempdir:
+        img = nib.load(_save_img(data, os.path.join(tempdir, "data.nii.gz")), keep_file_open=True)
+        means = shell_means(img, shell_idx, 3, block_size=block_size)
+    assert(means.shape == (4, 5, 6, 3))
+    for shell in range(3):
+        assert(np.allclose(means[..., shell], np.mean(data[..., shell_idx == shell], axis=3)))
+
+@pytest.mark.parametrize("precision", ["float32", "float64"])
+def test_group_means_nan(precision):
+    data = np.random.rand(4, 5, 6, 8).astype(np.float32)
+    data[1, 2, 3, 2] = np.nan
+    shell_idx = np.array([0, 1, 2, 0, 1, 2, 0, 1])
+    pe_idx = np.array([0, 1, 0, 1, 0, 1, 0, 1])
+    with tempfile.TemporaryDirectory() as tempdir:
+        img = nib.load(_save_img(data, os.path.join(tempdir, "data.nii.gz")))
+        shells, pes = accumulate(img, [ShellMeans(3), ShellPeMeans(0, 2)], shell_idx, pe_idx, block_size=3, precision=precision)
+    # Only the mean of the shell of the volume with the NaN is affected
+    assert(np.isnan(shells[1, 2, 3, 2]))
+    assert(np.count_nonzero(np.isnan(shells)) == 1)
+    assert(not np.any(np.isnan(pes)))
+    for shell in range(2):
+        assert(np.allclose(shells[..., shell], np.mean(data[..., shell_idx == shell], axis=3)))
+
+def test_shell_means_wrong_size():
+    with tempfile.TemporaryDirectory() as tempdir:
+        img = nib.load(_save_img(np.zeros((2, 2, 2, 3)), os.path.join(tempdir, "data.nii.gz")))
+        with pytest.raises(ValueError):
+            shell_means(img, [0, 1], 2)
+
+@pytest.mark.parametrize("precision", ["float32", "float64"])
+def test_accumulate(precision):
+    data = np.random.randint(0, 1000, size=(4, 5, 6, 9)).astype(np.int16)
+    mask = np.random.rand(4, 5, 6) > 0.4
+    mask[..., 2] = False
+    shell_idx = np.array([0, 1, 2, 0, 1, 2, 0, 1, 2])
+    pe_idx = np.array([0, 0, 0, 0, 1, 1, 1, 1, 1])
+    mask_idx = mask_index(mask)
+    with tempfile.TemporaryDirectory() as tempdir:
+        img = nib.Nifti1Image(data, np.eye(4))
+        img.header.set_slope_inter(2.0, 10.0)
+        nib.save(img, os.path.join(tempdir, "data.nii.gz"))
+        img = load_image(os.path.join(tempdir, "data.nii.gz"))
+        accumulators = [ShellMeans(3), ShellPeMeans(0, 2), VolumeSignal(mask_idx), SliceProfiles(mask_idx)]
+        means, b0_pe_means, signal, profiles = accumulate(img, accumulators, shell_idx, pe_idx, block_size=4, precision=precision)
+
+    scaled = data * 2.0 + 10.0
+    for shell in range(3):
+        assert(np.allclose(means[..., shell], np.mean(scaled[..., shell_idx == shell], axis=3)))
+    for pe in range(2):
+        assert(np.allclose(b0_pe_means[..., pe], np.mean(scaled[..., (shell_idx == 0) & (pe_idx == pe)], axis=3)))
+    assert(np.allclose(signal, [np.mean(scaled[..., vol][mask]) for vol in range(9)]))
+    assert(profiles.shape == (9, 6))
+    assert(np.all(np.isnan(profiles[:, 2])))
+    for vol in range(9):
+        for z in (0, 1, 3, 4, 5):
+            assert(np.isclose(profiles[vol, z], np.mean(scaled[:, :, z, vol][mask[:, :, z]])))
+
+def test_accumulate_wrong_size():
+    with pytest.raises(ValueError):
+        accumulate(np.zeros((2, 2, 2, 3)), [ShellMeans(1)], pe_idx=[0, 1])
+
+def _write_text(fname, data, fmt, header=None):
+    with open(fname, "w") as f:
+        if header:
+            f.write(header + "\n")
+        np.savetxt(f, data, fmt=fmt)
+    return fname
+
+def test_read_outlier_map():
+    ol_map = (np.random.rand(20, 9) < 0.2).astype(int)
+    with tempfile.TemporaryDirectory() as tempdir:
+        fname = _write_text(os.path.join(tempdir, "s.eddy_outlier_map"), ol_map, "%d", "One row per scan")
+        data = read_eddy_text(fname, cache=False)
+    assert(data.shape == (20, 9))
+    assert(np.all(data == ol_map))
+
+def test_read_float_map():
+    std_map = np.random.normal(size=(20, 9))
+    with tempfile.TemporaryDirectory() as tempdir:
+        fname = _write_text(os.path.join(tempdir, "s.eddy_outlier_n_stdev_map"), std_map, "%.6f", "One row per scan")
+        data = read_eddy_text(fname, cache=False)
+    assert(np.allclose(data, std_map, atol=1e-6))
+
+def test_read_single_row():
+    with tempfile.TemporaryDirectory() as tempdir:
+        fname = _write_text(os.path.join(tempdir, "s.eddy_movement_rms"), [[0.1, 0.2]], "%f")
+        data = read_eddy_text(fname, cache=False)
+    assert(data.shape == (1, 2))
+
+def test_read_wrong_columns():
+    with tempfile.TemporaryDirectory() as tempdir:
+        fname = _write_text(os.path.join(tempdir, "s.eddy_movement_rms"), np.zeros((4, 3)), "%f")
+        with pytest.raises(ValueError):
+            read_eddy_text(fname, cache=False)
+
+def test_read_unknown_file():
+    with pytest.raises(ValueError):
+        read_eddy_text("s.eddy_unknown")
+
+def test_read_cache(image_cache):
+    with tempfile.TemporaryDirectory() as tempdir:
+        fname = _write_text(os.path.join(tempdir, "params.txt"), np.ones((5, 6)), "%f")
+        data = read_text_array(fname)
+        assert(os.listdir(tempdir) == ["params.txt"])
+        assert([f for f in os.listdir(image_cache) if f.endswith(CACHE_SUFFIX)])
+        assert(np.all(read_text_array(fname) == data))
+
+        # Modified source file must invalidate the cached data
+        _write_text(fname, np.zeros((5, 7)), "%f")
+        os.utime(fname, ns=(0, 0))
+        data = read_text_array(fname)
+        assert(data.shape == (5, 7))
+        assert(np.all(data == 0))
+
+def test_read_cache_size_limit(image_cache):
+    with tempfile.TemporaryDirectory() as tempdir:
+        fnames = [_write_text(os.path.join(tempdir, f"params{idx}.txt"), np.ones((50, 6)), "%f") for idx in range(3)]
+        read_text_array(fnames[0])
+        entry_size = os.path.getsize(os.path.join(image_cache, os.listdir(image_cache)[0]))
+        configure_cache(image_cache, max_size=int(2.5 * entry_size))
+        for fname in fnames[1:]:
+            read_text_array(fname)
+        assert(len(os.listdir(image_cache)) == 2)
+
+def test_read_no_cache_dir():
+    with tempfile.TemporaryDirectory() as tempdir:
+        fname = _write_text(os.path.join(tempdir, "params.txt"), np.ones((5, 6)), "%f")
+        assert(np.all(read_text_array(fname) == 1))
+        assert(os.listdir(tempdir) == ["params.txt"])
+
+@pytest.mark.parametrize("block_size", [1, 2, 10])
+def test_masked_volume_stats(block_size):
+    data = np.random.normal(size=(5, 6, 7, 4))
+    data[1, 2, 3, 1] = np.nan
+    data[2, 2, 3, 2] = np.inf
+    mask = np.random.rand(5, 6, 7) > 0.5
+    mask[1, 2, 3] = mask[2, 2, 3] = True
+    stats = masked_volume_stats(data, mask_index(mask), block_size=block_size)
+    for vol in range(4):
+        values = data[..., vol][mask]
+        values = values[np.isfinite(values)]
+        assert(np.isclose(stats["mean"][vol], np.mean(values)))
+        assert(np.isclose(stats["std"][vol], np.std(values)))
+        assert(np.isclose(stats["mean_sq"][vol], np.mean(np.square(values))))
+        assert(stats["num_finite"][vol] == values.size)
+    assert(list(stats["num_nan"]) == [0, 1, 0, 0])
+
+def test_masked_volume_stats_3d():
+    data = np.random.normal(size=(5, 6, 7))
+    mask = np.zeros((5, 6, 7))
+    mask[1:3, 2:4, 3:6] = 1
+    with tempfile.TemporaryDirectory() as tempdir:
+        img = nib.load(_save_img(data, os.path.join(tempdir, "field.nii.gz")))
+        stats = masked_volume_stats(img, mask_index(mask))
+    assert(stats["std"].shape == (1,))
+    assert(np.isclose(stats["std"][0], np.std(data[mask > 0])))
+
+def test_mask_bbox():
+    mask = np.zeros((10, 12, 8))
+    mask[3:5, 0:2, 4] = 1
+    assert(mask_bbox(mask, margin=2) == (slice(1, 7), slice(0, 4), slice(2, 7)))
+    assert(mask_bbox(mask, margin=0) == (slice(3, 5), slice(0, 2), slice(4, 5)))
+    assert(mask_bbox(np.zeros((3, 4, 5))) == (slice(0, 3), slice(0, 4), slice(0, 5)))
+
+def test_uncrop():
+    bbox = (slice(1, 3), slice(2, 5), slice(0, 1))
+    full = uncrop(np.ones((2, 3, 1, 2)), bbox, (4, 6, 2), fill=np.nan)
+    assert(full.shape == (4, 6, 2, 2))
+    assert(np.all(full[bbox] == 1))
+    assert(np.count_nonzero(np.isnan(full)) == full.size - 12)
+
+def test_masked_volume_stats_bbox():
+    data = np.random.normal(size=(8, 9, 7, 5))
+    mask = np.zeros((8, 9, 7))
+    mask[2:5, 3:7, 1:4] = np.random.rand(3, 4, 3) > 0.3
+    bbox = mask_bbox(mask)
+    cropped = masked_volume_stats(data, mask_index(mask[bbox]), block_size=2, bbox=bbox)
+    full = masked_volume_stats(data, mask_index(mask), block_size=2)
+    for key in full:
+        assert(np.allclose(cropped[key], full[key]))
+
+def test_accumulate_bbox():
+    data = np.random.normal(size=(8, 9, 7, 5))
+    mask = np.zeros((8, 9, 7))
+    mask[2:5, 3:7, 1:4] = 1
+    bbox = mask_bbox(mask, margin=1)
+    shell_idx = np.array([0, 1, 0, 1, 1])
+    means, signal = accumulate(data, [ShellMeans(2), VolumeSignal(mask_index(mask[bbox]))], shell_idx, block_size=2, bbox=bbox)
+    assert(means.shape == (5, 6, 5, 2))
+    for shell in range(2):
+        assert(np.allclose(means[..., shell], data[bbox][..., shell_idx == shell].mean(axis=3)))
+    assert(np.allclose(signal, [data[..., vol][mask > 0].mean() for vol in range(5)]))
+
+def _save_scaled_img(data, fname, slope, inter):
+    img = nib.Nifti1Image(data, np.eye(4))
+    img.header.set_slope_inter(slope, inter)
+    nib.save(img, fname)
+    return fname
+
+@pytest.mark.parametrize("dtype", [np.int16, np.float32])
+def test_float32_precision(dtype):
+    """
+    Statistics at float32 precision agree with float64 within FLOAT32_RTOL
+    """
+    data = (np.random.normal(size=(10, 11, 12, 6)) * 1000 + 5000).astype(dtype)
+    mask = np.random.rand(10, 11, 12) > 0.3
+    shell_idx = np.array([0, 1, 1, 0, 2, 2])
+    with tempfile.TemporaryDirectory() as tempdir:
+        img = load_image(_save_scaled_img(data, os.path.join(tempdir, "data.nii.gz"), 0.37, -12.5))
+        stats64 = masked_volume_stats(img, mask_index(mask), block_size=4, precision="float64")
+        stats32 = masked_volume_stats(img, mask_index(mask), block_size=4, precision="float32")
+        means64 = shell_means(img, shell_idx, 3, block_size=4, precision="float64")
+        means32 = shell_means(img, shell_idx, 3, block_size=4, precision="float32")
+    for key in ("mean", "std", "mean_sq"):
+        assert(np.allclose(stats32[key], stats64[key], rtol=FLOAT32_RTOL, atol=0))
+    assert(np.allclose(means32, means64, rtol=FLOAT32_RTOL, atol=0))
+    assert(np.isclose(stats64["mean"][0], np.mean(data[..., 0][mask] * 0.37 - 12.5)))
+
+def test_unknown_precision():
+    with pytest.raises(ValueError):
+        masked_volume_stats(np.zeros((2, 2, 2)), [0], precision="float16")
+
+@pytest.mark.parametrize("value, expected", [("1024", 1024), ("4K", 4096), ("1.5g", 3 * 1024**3 // 2), ("512MB", 512 * 1024**2)])
+def test_parse_memory(value, expected):
+    assert(memory.parse_memory(value) == expected)
+
+def test_parse_memory_invalid():
+    with pytest.raises(ValueError):
+        memory.parse_memory("lots")
+
+def test_fit_block_size():
+    with tempfile.TemporaryDirectory() as tempdir:
+        img = nib.load(_save_img(np.zeros((10, 10, 10, 20), dtype=np.int16), os.path.join(tempdir, "data.nii.gz")))
+        per_block = [memory.pass_memory(img, n, precision="float32") for n in (1, 2, 3)]
+        block_size = memory.fit_block_size(img, 1000 + per_block[2] - 1, fixed_memory=1000, precision="float32")
+        assert(block_size == 2)
+        assert(memory.fit_block_size(img, 10**9, precision="float32") == 20)
+        assert(memory.fit_block_size(img, 10**9, max_block_size=5, precision="float32") == 5)
+        with pytest.raises(ValueError):
+            memory.fit_block_size(img, per_block[0] - 1, precision="float32")
+
+@pytest.fixture
+def index_cache(monkeypatch):
+    pytest.importorskip("indexed_gzip")
+    monkeypatch.setattr(imageio, "CACHE_MIN_SIZE", 0)
+    with tempfile.TemporaryDirectory() as index_dir:
+        configure_index_cache(index_dir)
+        yield index_dir
+    configure_index_cache()
+
+def test_gzip_index(index_cache):
+    data = np.random.rand(4, 5, 6, 9).astype(np.float32)
+    with tempfile.TemporaryDirectory() as tempdir:
+        fname = _save_img(data, os.path.join(tempdir, "data.nii.gz"))
+        img = load_image(fname)
+        assert(not has_index(img))
+        assert(np.all(np.asanyarray(img.dataobj[..., 4]) == data[..., 4]))
+        save_index(img)
+        assert(os.listdir(tempdir) == ["data.nii.gz"])
+        assert([f for f in os.listdir(index_cache) if f.endswith(INDEX_SUFFIX)])
+
+        img = load_image(fname)
+        assert(has_index(img))
+        blocks = list(iter_volume_blocks(img, block_size=2, threads=3))
+        assert([start for start, _block in blocks] == [0, 2, 4, 6, 8])
+        assert(np.all(np.concatenate([block for _start, block in blocks], axis=3) == data))
+
+def test_gzip_index_stale(index_cache):
+    with tempfile.TemporaryDirectory() as tempdir:
+        fname = _save_img(np.zeros((2, 2, 2, 3)), os.path.join(tempdir, "data.nii.gz"))
+        save_index(load_image(fname))
+        assert(has_index(load_image(fname)))
+
+        # Replaced by a copy with an older modification time, as by cp -p
+        data = np.random.rand(3, 3, 3, 4).astype(np.float32)
+        _save_img(data, fname)
+        os.utime(fname, ns=(0, 0))
+        img = load_image(fname)
+        assert(not has_index(img))
+        assert(np.all(np.asanyarray(img.dataobj) == data))
+        save_index(img)
+        assert(len(os.listdir(index_cache)) == 1)
+
+def test_gzip_index_size_limit(index_cache):
+    with tempfile.TemporaryDirectory() as tempdir:
+        fnames = [_save_img(np.random.rand(8, 8, 8, 3), os.path.join(tempdir, f"data{idx}.nii.gz")) for idx in range(2)]
+        configure_index_cache(index_cache, max_size=1)
+        for fname in fnames:
+            img = load_image(fname)
+            np.asanyarray(img.dataobj)
+            save_index(img)
+        assert(os.listdir(index_cache) == [os.path.basename(imageio._index_fname(fnames[1]))])
+
+def test_gzip_index_inconsistent(index_cache):
+    data = np.random.rand(4, 5, 6, 9).astype(np.float32)
+    with tempfile.TemporaryDirectory() as tempdir:
+        other_fname = _save_img(np.random.rand(8, 8, 8, 9), os.path.join(tempdir, "other.nii.gz"))
+        save_index(load_image(other_fname))
+        fname = _save_img(data, os.path.join(tempdir, "data.nii.gz"))
+        # Index of a different file in the place of this file's index
+        other_index = os.path.join(index_cache, os.listdir(index_cache)[0])
+        index_fname = imageio._index_fname(fname)
+        os.replace(other_index, index_fname)
+        img = load_image(fname)
+        assert(np.all(np.asanyarray(img.dataobj) == data))
+        assert(not os.path.exists(index_fname))
+
+def test_gzip_index_small(index_cache, monkeypatch):
+    monkeypatch.setattr(imageio, "CACHE_MIN_SIZE", 1024**2)
+    with tempfile.TemporaryDirectory() as tempdir:
+        fname = _save_img(np.zeros((2, 2, 2, 3)), os.path.join(tempdir, "data.nii.gz"))
+        save_index(load_image(fname))
+        assert(os.listdir(index_cache) == [])
+
+def test_gzip_index_default_dir(monkeypatch):
+    pytest.importorskip("indexed_gzip")
+    monkeypatch.setattr(imageio, "CACHE_MIN_SIZE", 0)
+    monkeypatch.delenv(imageio.INDEX_DIR_ENV, raising=False)
+    monkeypatch.delenv(imageio.CACHE_DIR_ENV, raising=False)
+    with tempfile.TemporaryDirectory() as tempdir:
+        # Default settings, with the user's cache directory moved to a temporary directory
+        monkeypatch.setenv("XDG_CACHE_HOME", os.path.join(tempdir, "cache"))
+        args = generate_eddy_dir(os.path.join(tempdir, "eddy"), shape=(16, 16, 12), num_vols=12)
+        extract(**args, output=os.path.join(tempdir, "qc"))
+        index_dir = os.path.join(tempdir, "cache", "squat", "indexes")
+        assert([f for f in os.listdir(index_dir) if f.endswith(INDEX_SUFFIX)])
+        assert(has_index(load_image(os.path.join(args["eddydir"], EDDYBASE + ".nii.gz"))))
+
+        shutil.rmtree(index_dir)
+        try:
+            extract(**args, output=os.path.join(tempdir, "qc_no_index"), no_index_cache=True)
+        finally:
+            configure_index_cache()
+        assert(not os.path.exists(index_dir))
+
+def test_gzip_index_threads_closed(index_cache, monkeypatch):
+    from squat.eddy import volumes
+    closed = []
+    monkeypatch.setattr(volumes, "close_image", closed.append)
+    data = np.random.rand(4, 5, 6, 9).astype(np.float32)
+    with tempfile.TemporaryDirectory() as tempdir:
+        fname = _save_img(data, os.path.join(tempdir, "data.nii.gz"))
+        img = load_image(fname)
+        np.asanyarray(img.dataobj)
+        save_index(img)
+        blocks = iter_volume_blocks(load_image(fname), block_size=2, threads=3)
+        assert(next(blocks)[0] == 0)
+        assert(not closed)
+        blocks.close()
+        assert(1 <= len(closed) <= 3)
+
+@pytest.fixture
+def image_cache(monkeypatch):
+    monkeypatch.setattr(imageio, "CACHE_MIN_SIZE", 0)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        configure_cache(cache_dir)
+        yield cache_dir
+    configure_cache(None)
+
+def test_image_cache(image_cache):
+    data = np.random.randint(0, 1000, (4, 5, 6, 9)).astype(np.int16)
+    with tempfile.TemporaryDirectory() as tempdir:
+        fname = _save_img(data, os.path.join(tempdir, "data.nii.gz"))
+        img = load_image(fname)
+        assert(os.path.dirname(img.get_filename()) == image_cache)
+        assert(image_memmap(img) is not None)
+        blocks = list(iter_volume_blocks(img, block_size=4, precision="float32"))
+        assert(np.all(np.concatenate([block for _start, block in blocks], axis=3) == data))
+        assert(load_image(fname).get_filename() == img.get_filename())
+
+        # Changing the source image replaces the cached copy
+        _save_img(data + 1, fname)
+        os.utime(fname, ns=(0, 0))
+        img = load_image(fname)
+        assert(np.all(np.asanyarray(img.dataobj) == data + 1))
+        assert(len(os.listdir(image_cache)) == 1)
+
+def test_image_cache_size_limit(image_cache):
+    data = np.zeros((10, 10, 10, 2), dtype=np.int16)
+    with tempfile.TemporaryDirectory() as tempdir:
+        fnames = [_save_img(data, os.path.join(tempdir, f"data{idx}.nii.gz")) for idx in range(3)]
+        configure_cache(image_cache, max_size=int(2.5 * (data.nbytes + 352)))
+        cached = [load_image(fname).get_filename() for fname in fnames]
+        assert(sorted(os.listdir(image_cache)) == sorted(os.path.basename(fname) for fname in cached[1:]))
+        configure_cache(image_cache, max_size=100)
+        assert(load_image(fnames[0]).get_filename() == fnames[0])
+
+def test_image_cache_too_large(image_cache, monkeypatch):
+    data = np.zeros((10, 10, 10, 2), dtype=np.int16)
+    with tempfile.TemporaryDirectory() as tempdir:
+        fname = _save_img(data, os.path.join(tempdir, "data.nii.gz"))
+        configure_cache(image_cache, max_size=data.nbytes)
+
+        # Too large to cache, which must be detected without decompressing
+        def _gzip_open(*args, **kwargs):
+            raise AssertionError("Decompressed image which is too large to cache")
+        monkeypatch.setattr(imageio.gzip, "open", _gzip_open)
+        assert(imageio.cached_file(fname) is None)
+        assert(os.listdir(image_cache) == [])
+
+@pytest.fixture
+def render_cache():
+    with tempfile.TemporaryDirectory() as cache_dir:
+        configure_render_cache(cache_dir)
+        yield cache_dir
+    configure_render_cache(None)
+
+def test_render_cache(render_cache):
+    renders = []
+    def _render():
+        renders.append(1)
+        return b"image"
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        fname = os.path.join(tempdir, "data.nii")
+        with open(fname, "wb") as f:
+            f.write(b"data")
+        key = render_key([fname, None], volume=0, window=[0, 1])
+        assert(cached_render(key, _render) == b"image")
+        assert(cached_render(render_key([fname], volume=0, window=[0, 1]), _render) == b"image")
+        assert(len(renders) == 1)
+        assert(render_key([fname], volume=1, window=[0, 1]) != key)
+
+        # Keys depend on file content, not name or modification time
+        shutil.copy(fname, os.path.join(tempdir, "copy.nii"))
+        assert(render_key([os.path.join(tempdir, "copy.nii")], volume=0, window=[0, 1]) == key)
+        with open(fname, "wb") as f:
+            f.write(b"changed")
+        assert(render_key([fname], volume=0, window=[0, 1]) != key)
+
+def test_render_cache_size_limit(render_cache):
+    configure_render_cache(render_cache, max_size=250)
+    for idx in range(4):
+        cached_render(str(idx), lambda: bytes(100))
+    assert(sorted(os.listdir(render_cache)) == [f"2{RENDER_SUFFIX}", f"3{RENDER_SUFFIX}"])
+
+def test_render_cache_disabled():
+    assert(render_key(["missing"], volume=0) is None)
+    assert(cached_render(None, lambda: b"image") == b"image")
+
+def test_extract_render_cache(render_cache, monkeypatch):
+    with tempfile.TemporaryDirectory() as tempdir:
+        args = generate_eddy_dir(os.path.join(tempdir, "eddy"), shape=(16, 16, 12), num_vols=12)
+        first = extract(**args, output=os.path.join(tempdir, "first"))
+        # Images of unchanged data come from the cache without computing mean volumes
+        monkeypatch.setattr(stages, "render_slices", None)
+        monkeypatch.setattr(stages, "ShellMeans", None)
+        second = extract(**args, output=os.path.join(tempdir, "second"))
+        pngs = sorted(f for f in os.listdir(first) if f.endswith(".png"))
+        assert(pngs and pngs == sorted(f for f in os.listdir(second) if f.endswith(".png")))
+        for fname in pngs:
+            with open(os.path.join(first, fname), "rb") as f1, open(os.path.join(second, fname), "rb") as f2:
+                assert(f1.read() == f2.read())
+        qc = [read_json(os.path.join(outdir, "qc.json"), "qc") for outdir in (first, second)]
+    assert(qc[0] == qc[1])
+
+@pytest.mark.parametrize("mb_factor", [1, 3])
+def test_extract_synthetic(mb_factor):
+    with tempfile.TemporaryDirectory() as tempdir:
+        args = generate_eddy_dir(os.path.join(tempdir, "eddy"), shape=(16, 16, 12), num_vols=12, num_pe_dirs=2, mb_factor=mb_factor)
+        outdir = extract(**args, output=os.path.join(tempdir, "qc"), perf=True)
+        with open(os.path.join(outdir, "qc.json")) as f:
+            qc = json.load(f)
+        motion = np.loadtxt(os.path.join(args["eddydir"], EDDYBASE + ".eddy_movement_rms"))
+        residuals = nib.load(os.path.join(args["eddydir"], EDDYBASE + ".eddy_residuals.nii.gz")).get_fdata()
+        mask = nib.load(os.path.join(args["eddydir"], args["mask"])).get_fdata() > 0
+        for fname in ("avg_b0.png", "avg_b1000.png", "avg_b2000.png", "avg_b0_pe0.png", "avg_b0_pe1.png", "cnr_b0.png"):
+            assert(os.path.isfile(os.path.join(outdir, fname)))
+
+    assert(qc["data_num_b0_vols"] == 4)
+    assert(qc["data_unique_bvals"] == [1000, 2000])
+    assert(qc["data_protocol"] == [2, 2, 2, 2, 2, 2])
+    assert(np.allclose(qc["qc_motion_abs"], motion[:, 0]))
+    assert(np.allclose(qc["qc_res_mean"], [np.mean(np.square(residuals[..., vol][mask])) for vol in range(12)], rtol=1e-5))
+    assert(len(qc["qc_motion_s2v_trans_var"]) == 12)
+    assert({"inputs", "corrected_volumes", "cnr", "residuals", "json_write"} <= set(qc["perf"]))
+
+def test_extract_bval_rounding_median():
+    with tempfile.TemporaryDirectory() as tempdir:
+        args = generate_eddy_dir(os.path.join(tempdir, "eddy"), shape=(16, 16, 12), num_vols=12)
+        outdir = extract(**args, output=os.path.join(tempdir, "qc"), bval_rounding="median")
+        with open(os.path.join(outdir, "qc.json")) as f:
+            qc = json.load(f)
+        bvals = np.loadtxt(os.path.join(args["eddydir"], "bvals"))
+    assert(qc["data_unique_bvals"] == [int(np.median(bvals[1::3])), int(np.median(bvals[2::3]))])
+    assert(qc["data_protocol"] == [2, 2, 2, 2, 2, 2])
+
+def test_extract_no_crop():
+    with tempfile.TemporaryDirectory() as tempdir:
+        args = generate_eddy_dir(os.path.join(tempdir, "eddy"), shape=(16, 16, 12), num_vols=12)
+        qc = []
+        for no_crop in (False, True):
+            outdir = extract(**args, output=os.path.join(tempdir, f"qc{no_crop}"), no_crop=no_crop)
+            with open(os.path.join(outdir, "qc.json")) as f:
+                qc.append(json.load(f))
+    assert(qc[0].keys() == qc[1].keys())
+    assert(qc[0]["qc_outliers_map"] == qc[1]["qc_outliers_map"])
+    for key in [k for k in qc[0] if k.startswith("qc_") and k != "qc_outliers_map"]:
+        assert(np.allclose(np.array(qc[0][key], dtype=float), np.array(qc[1][key], dtype=float), equal_nan=True))
+
+def test_extract_signal_profiles():
+    with tempfile.TemporaryDirectory() as tempdir:
+        args = generate_eddy_dir(os.path.join(tempdir, "eddy"), shape=(16, 16, 12), num_vols=12)
+        default = read_json(os.path.join(extract(**args, output=os.path.join(tempdir, "default")), "qc.json"), "default")
+        outdir = extract(**args, output=os.path.join(tempdir, "signal"), signal_profiles=True)
+        qc = read_json(os.path.join(outdir, "qc.json"), "signal")
+        data = np.asanyarray(nib.load(os.path.join(args["eddydir"], EDDYBASE + ".nii.gz")).dataobj)
+        mask = np.asanyarray(nib.load(os.path.join(args["eddydir"], args["mask"])).dataobj) > 0
+    assert("qc_signal_vol" not in default and "qc_signal_slice_vol" not in default)
+    assert(np.allclose(qc["qc_signal_vol"], data[mask].mean(axis=0)))
+    signal_slice_vol = np.array(qc["qc_signal_slice_vol"])
+    assert(signal_slice_vol.shape == (12, 12))
+    assert(np.all(np.isfinite(signal_slice_vol)))
+    for z in range(12):
+        expected = data[..., z, :][mask[..., z]].mean(axis=0) if np.any(mask[..., z]) else 0
+        assert(np.allclose(signal_slice_vol[:, z], expected))
+
+def test_bval_shells():
+    bvals = np.array([1000, 5, 2010, 990, 0, 1090, 2000, 1185])
+    assert(list(bval_shells(bvals)) == [1, 0, 2, 1, 0, 1, 2, 1])
+    assert(bval_shells(np.array([])).size == 0)
+
+def test_round_bvals_median():
+    bvals = np.array([1000, 5, 2010, 990, 0, 1090, 2000, 1185, 3, 1995])
+    assert(list(round_bvals_median(bvals)) == [1045, 0, 2000, 1045, 0, 1045, 2000, 1045, 0, 2000])
+
+def test_acquisition_summary():
+    bvals = np.random.choice([0, 1000, 2000], 40)
+    eddy_idxs = np.random.randint(1, 4, 40)
+    acq = acquisition_summary(bvals, eddy_idxs)
+    assert(list(acq["unique_bvals"]) == sorted(set(bvals)))
+    assert(list(acq["unique_pedirs"]) == sorted(set(eddy_idxs)))
+    assert(np.all(acq["unique_bvals"][acq["shell_idx"]] == bvals))
+    assert(np.all(acq["unique_pedirs"][acq["pe_idx"]] == eddy_idxs))
+    for c_p, p in enumerate(acq["unique_pedirs"]):
+        for c_b, b in enumerate(acq["unique_bvals"]):
+            assert(acq["protocol"][c_p, c_b] == ((bvals == b) & (eddy_idxs == p)).sum())
+    assert(list(acq["shell_counts"]) == list(acq["protocol"].sum(axis=0)))
+    assert(list(acq["pe_counts"]) == list(acq["protocol"].sum(axis=1)))
+
+def test_acquisition_summary_wrong_size():
+    with pytest.raises(ValueError):
+        acquisition_summary(np.zeros(5), np.ones(4))
+
+@pytest.mark.parametrize("packed", [False, True])
+def test_outlier_counts(packed):
+    ol_map = (np.random.rand(20, 9) < 0.2).astype(np.uint8)
+    shell_idx = np.random.randint(0, 3, 20)
+    pe_idx = np.random.randint(0, 2, 20)
+    counts = outlier_counts(pack_outlier_map(ol_map) if packed else ol_map, shell_idx, pe_idx, 3, 2)
+    assert(list(counts["vol"]) == list(ol_map.sum(axis=1)))
+    assert(list(counts["slice"]) == list(ol_map.sum(axis=0)))
+    for shell in range(3):
+        for pe in range(2):
+            vols = (shell_idx == shell) & (pe_idx == pe)
+            assert(counts["shell_pe"][shell, pe] == np.count_nonzero(ol_map[vols]))
+            assert(counts["vols_shell_pe"][shell, pe] == np.count_nonzero(vols))
+
+@pytest.mark.parametrize("num_slices", [1, 8, 13, 72])
+def test_pack_outlier_map(num_slices):
+    ol_map = (np.random.rand(30, num_slices) < 0.3).astype(np.uint8)
+    packed = pack_outlier_map(ol_map)
+    assert(packed["shape"] == [30, num_slices])
+    assert(json.loads(json.dumps(packed)) == packed)
+    assert(np.array_equal(unpack_outlier_map(packed), ol_map))
+    per_vol, per_slice = packed_counts(packed)
+    assert(np.array_equal(per_vol, ol_map.sum(axis=1)))
+    assert(np.array_equal(per_slice, ol_map.sum(axis=0)))
+
+def test_pack_outlier_map_wrong_size():
+    packed = pack_outlier_map(np.ones((4, 10)))
+    packed["shape"] = [5, 10]
+    with pytest.raises(ValueError):
+        packed_counts(packed)
+
+def test_group_slice_outliers():
+    with tempfile.TemporaryDirectory() as tempdir:
+        subjects = []
+        for subjid in ("a", "b"):
+            args = generate_eddy_dir(os.path.join(tempdir, subjid), shape=(16, 16, 12), num_vols=12)
+            outdir = extract(**args, output=os.path.join(tempdir, subjid, "qc"))
+            subjects.append(SubjectData(subjid, tempdir, [os.path.join(outdir, "qc.json")]))
+        os.remove(os.path.join(outdir, "qc.json"))
+        subjects.append(SubjectData("missing", tempdir, []))
+        group = GroupData(subject_datas=subjects)
+        group.write(os.path.join(tempdir, "group_data.json"))
+        read = GroupData(os.path.join(tempdir, "group_data.json"))
+        ol_map = read_eddy_text(os.path.join(tempdir, "b", EDDYBASE + ".eddy_outlier_map"))
+    slice_outliers = read.get_slice_outliers()
+    assert(slice_outliers.shape == (3, 12))
+    assert(np.array_equal(slice_outliers[1], ol_map.sum(axis=0)))
+    assert(np.all(np.isnan(slice_outliers[2])))
+    assert(np.array_equal(unpack_outlier_map(read.get_outlier_maps()[1]), ol_map))
+
+def test_outlier_counts_wrong_size():
+    with pytest.raises(ValueError):
+        outlier_counts(np.zeros((5, 3)), np.zeros(4), np.zeros(4), 1, 1)
+
+def test_s2v_variance():
+    params = np.random.normal(size=(7 * 5, 6))
+    ex_mask = np.array([True, False, True, True, True])
+    var = s2v_variance(params, 7, ex_mask)
+    assert(var.shape == (7, 6))
+    for vol in range(7):
+        assert(np.allclose(var[vol], np.var(params[vol*5:(vol+1)*5][ex_mask], ddof=1, axis=0)))
+
+def test_s2v_variance_wrong_size():
+    with pytest.raises(ValueError):
+        s2v_variance(np.zeros((10, 6)), 3, np.ones(4, dtype=bool))
+
+def test_excitation_mask():
+    mask = np.zeros((20, 20, 4))
+    mask[..., 1] = 1
+    mask[:10, :10, 3] = 1
+    num_ex, ex_mask = excitation_mask(np.array([0, 2, 1, 3]), mask, 4, min_voxels=240)
+    assert(num_ex == 4)
+    assert(list(ex_mask) == [False, False, True, False])
+    num_ex, ex_mask = excitation_mask(np.array([[0, 2], [1, 3]]), mask, 4)
+    assert(num_ex == 2 and np.all(ex_mask))
+    num_ex, ex_mask = excitation_mask(None, mask, 4)
+    assert(num_ex == 4 and np.all(ex_mask))
+
+@pytest.mark.parametrize("threads", [1, 3])
+def test_run_tasks(threads):
+    started, lock = [], threading.Lock()
+    def _run(name):
+        with lock:
+            started.append(name)
+        return name.upper()
+    dependencies = {"a" : ["c"], "b" : [], "c" : ["b"], "d" : []}
+    results = run_tasks(dependencies, _run, threads)
+    assert(results == {"a" : "A", "b" : "B", "c" : "C", "d" : "D"})
+    for name, deps in dependencies.items():
+        assert(all(started.index(dep) < started.index(name) for dep in deps))
+
+@pytest.mark.parametrize("threads", [1, 3])
+def test_run_tasks_invalid(threads):
+    with pytest.raises(ValueError):
+        run_tasks({"a" : ["b"], "b" : ["a"], "c" : []}, str, threads)
+    with pytest.raises(ValueError):
+        run_tasks({"a" : ["x"]}, str, threads)
+
+@pytest.mark.parametrize("threads", [1, 3])
+def test_run_tasks_failure(threads):
+    def _run(name):
+        if name == "b":
+            raise RuntimeError("failed")
+        return name
+    with pytest.raises(RuntimeError):
+        run_tasks({"a" : [], "b" : [], "c" : ["b"]}, _run, threads)
+
+def test_extract_threads():
+    with tempfile.TemporaryDirectory() as tempdir:
+        args = generate_eddy_dir(os.path.join(tempdir, "eddy"), shape=(16, 16, 12), num_vols=12)
+        qc = []
+        for threads in (1, 4):
+            outdir = extract(**args, output=os.path.join(tempdir, f"qc{threads}"), threads=threads)
+            with open(os.path.join(outdir, "qc.json")) as f:
+                qc.append(json.load(f))
+    assert(qc[0] == qc[1])
+
+def test_extract_array_sidecar():
+    with tempfile.TemporaryDirectory() as tempdir:
+        args = generate_eddy_dir(os.path.join(tempdir, "eddy"), shape=(16, 16, 12), num_vols=12)
+        inline = SubjectData("inline", tempdir, [os.path.join(extract(**args, output=os.path.join(tempdir, "inline")), "qc.json")])
+        outdir = extract(**args, output=os.path.join(tempdir, "sidecar"), array_sidecar=True)
+        with open(os.path.join(outdir, "qc.json")) as f:
+            qc = json.load(f)
+        assert(os.path.isfile(arrays_fname(os.path.join(outdir, "qc.json"))))
+        assert(qc["qc_motion_abs"]["shape"] == [12])
+        assert(isinstance(qc["qc_motion_abs_mean"], float))
+
+        sidecar = SubjectData("sidecar", tempdir, [os.path.join(outdir, "qc.json")])
+        assert(sorted(sidecar.qc_fields) == sorted(inline.qc_fields))
+        assert("qc_res_mean" in sidecar._array_refs)
+        for field in inline.qc_fields:
+            assert(np.array_equal(sidecar.get_data(field), inline.get_data(field), equal_nan=True))
+        assert(not sidecar._array_refs)
+
+        # Previous results in the sidecar are reused by an incremental run
+        extract(**args, output=outdir, array_sidecar=True, incremental=True)
+        with open(os.path.join(outdir, "qc.json")) as f:
+            assert(json.load(f) == qc)
+
+@pytest.mark.parametrize("indent", [None, 4])
+def test_write_json(indent):
+    data = {
+        "b" : np.random.rand(5, 3),
+        "a" : [1, "x", None, True, {"z" : np.int64(3)}],
+        "c" : np.array([1.5, np.nan, np.inf, -np.inf], dtype=np.float32),
+        "d" : np.float64(0.1),
+        "e" : np.arange(4),
+        "f" : np.array([True, False]),
+    }
+    with tempfile.TemporaryDirectory() as tempdir:
+        fname = os.path.join(tempdir, "data.json")
+        write_json(fname, data, indent=indent)
+        read = read_json(fname, "test")
+        with open(fname) as f:
+            text = f.read()
+    assert(list(read) == ["a", "b", "c", "d", "e", "f"])
+    assert(read["a"] == [1, "x", None, True, {"z" : 3}])
+    assert(np.array_equal(read["b"], data["b"]))
+    assert(np.array_equal(np.array(read["c"], dtype=np.float32), data["c"], equal_nan=True))
+    assert(read["d"] == 0.1 and read["e"] == [0, 1, 2, 3] and read["f"] == [True, False])
+    # Each innermost list is written on one line
+    assert("[1.5,NaN,Infinity,-Infinity]" in text)
+    if indent is None:
+        assert(" " not in text and "\n" not in text.strip())
+
+def test_write_json_digits():
+    data = {"qc_a" : np.array([1/3, 2.0]), "qc_b" : 1/3, "c" : 2/3}
+    with tempfile.TemporaryDirectory() as tempdir:
+        fname = os.path.join(tempdir, "data.json")
+        write_json(fname, data, digits=3, field_digits={"qc_*" : 2})
+        read = read_json(fname, "test")
+    assert(read == {"qc_a" : [0.33, 2], "qc_b" : 0.33, "c" : 0.667})
+    assert(isinstance(read["qc_b"], float))
+
+def test_parse_digits():
+    assert(parse_digits(None) == (None, {}))
+    assert(parse_digits(["6", "qc_outliers_*=3"]) == (6, {"qc_outliers_*" : 3}))
+    for spec in ["x", "a=0", "a=18"]:
+        with pytest.raises(ValueError):
+            parse_digits([spec])
+
+def test_extract_compact_json():
+    with tempfile.TemporaryDirectory() as tempdir:
+        args = generate_eddy_dir(os.path.join(tempdir, "eddy"), shape=(16, 16, 12), num_vols=12)
+        default = read_json(os.path.join(extract(**args, output=os.path.join(tempdir, "default")), "qc.json"), "default")
+        compact_fname = os.path.join(extract(**args, output=os.path.join(tempdir, "compact"), compact_json=True, json_digits=["qc_outliers_slice_vol=2"]), "qc.json")
+        compact = read_json(compact_fname, "compact")
+        group = GroupData(subject_datas=[SubjectData("compact", tempdir, [compact_fname])])
+        group.write(os.path.join(tempdir, "group_data.json"), compact=True)
+        group_read = read_json(os.path.join(tempdir, "group_data.json"), "group")
+        group.write(os.path.join(tempdir, "group_default.json"))
+        with open(os.path.join(tempdir, "group_default.json")) as f:
+            group_text = f.read()
+        group.write(os.path.join(tempdir, "group_rounded.json"), digits=3)
+        group_rounded = read_json(os.path.join(tempdir, "group_rounded.json"), "group")
+    assert(sorted(group_read) == sorted(group))
+    for field in group.qc_fields:
+        # Array fields are float32 values, written with the shortest text which reproduces them
+        dtype = np.float32 if "qc_" + field in group._float32_fields else float
+        assert(np.array_equal(np.array(group_read["qc_" + field], dtype=dtype), np.array(group["qc_" + field], dtype=dtype), equal_nan=True))
+        assert(np.allclose(group_rounded["qc_" + field], group["qc_" + field], rtol=1e-2, equal_nan=True))
+    # Float32 array values are written with no more digits than they need to round-trip
+    key = None
+    for line in group_text.splitlines():
+        match = re.match(r'\s*"(\w+)":', line)
+        if match:
+            key = match.group(1)
+        if key in group._float32_fields:
+            for number in re.findall(r"[\d.]+(?=e|[,\]])", line):
+                assert(len(number.replace(".", "").lstrip("0")) <= 9)
+    assert(sorted(compact) == sorted(default))
+    for key, value in default.items():
+        if key == "qc_outliers_slice_vol":
+            assert(np.allclose(compact[key], value, rtol=0.05))
+        else:
+            assert(compact[key] == value)
+
+def test_extract_max_memory():
+    with tempfile.TemporaryDirectory() as tempdir:
+        args = generate_eddy_dir(os.path.join(tempdir, "eddy"), shape=(16, 16, 12), num_vols=12)
+        outdirs = [extract(**args, output=os.path.join(tempdir, "default")),
+                   extract(**args, output=os.path.join(tempdir, "limited"), max_memory="1G")]
+        qc = []
+        for outdir in outdirs:
+            with open(os.path.join(outdir, "qc.json")) as f:
+                qc.append(json.load(f))
+        assert(qc[0]["qc_field_disp_std"] == qc[1]["qc_field_disp_std"])
+        with pytest.raises(ValueError):
+            extract(**args, output=os.path.join(tempdir, "too_small"), max_memory="1K")
+
+def test_extract_max_memory_no_cache(monkeypatch):
+    monkeypatch.setattr(imageio, "CACHE_MIN_SIZE", 0)
+    with tempfile.TemporaryDirectory() as tempdir:
+        args = generate_eddy_dir(os.path.join(tempdir, "eddy"), shape=(16, 16, 12), num_vols=12)
+        cache_dir = os.path.join(tempdir, "cache")
+        os.makedirs(cache_dir)
+        try:
+            with pytest.raises(ValueError):
+                extract(**args, output=os.path.join(tempdir, "too_small"), max_memory="1K", cache_dir=cache_dir)
+        finally:
+            configure_cache(None)
+        # The memory budget is checked using image headers only
+        assert(os.listdir(cache_dir) == [])
+
+def test_extract_unknown_option():
+    with pytest.raises(ValueError):
+        extract("eddydir", "index.txt", "acqp.txt", "mask", "bvals", not_an_option=True)
+
+@pytest.mark.parametrize("option", [{"precision" : "float16"}, {"threads" : "many"}, {"bval_rounding" : "up"}])
+def test_extract_invalid_option(option):
+    with pytest.raises(ValueError, match="invalid"):
+        extract("eddydir", "index.txt", "acqp.txt", "mask", "bvals", **option)
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_extract_batch_failures_isolated(jobs):
+    with tempfile.TemporaryDirectory() as tempdir:
+        eddydirs = [os.path.join(tempdir, "missing"), tempdir]
+        results = extract_batch(eddydirs, jobs=jobs, idx="index.txt", eddy_params="acqp.txt", mask="mask", bvals="bvals")
+    assert([r["eddydir"] for r in results] == eddydirs)
+    assert(not any(r["success"] for r in results))
+    assert(all(r["error"] for r in results))
+
+def test_extract_batch_duplicate_output():
+    with pytest.raises(ValueError):
+        extract_batch(["a/subj", "b/subj"], output="out", idx="index.txt", eddy_params="acqp.txt", mask="mask", bvals="bvals")
+
+def test_manifest_unchanged():
+    with tempfile.TemporaryDirectory() as tempdir:
+        fname = os.path.join(tempdir, "input.txt")
+        with open(fname, "w") as f:
+            f.write("1 2 3")
+        previous = manifest.stage_record([fname, None], {"opt" : 1}, ["a"], [], with_hash=True)
+        current = manifest.stage_record([fname], {"opt" : 1}, [], [], previous)
+        assert(manifest.stage_unchanged(previous, current))
+
+        # Same content with a new modification time is unchanged if the hash matches
+        os.utime(fname, ns=(0, 0))
+        current = manifest.stage_record([fname], {"opt" : 1}, [], [], previous, with_hash=True)
+        assert(manifest.stage_unchanged(previous, current))
+
+        # Different options
+        current = manifest.stage_record([fname], {"opt" : 2}, [], [], previous, with_hash=True)
+        assert(not manifest.stage_unchanged(previous, current))
+
+        # Different content
+        with open(fname, "w") as f:
+            f.write("1 2 4")
+        current = manifest.stage_record([fname], {"opt" : 1}, [], [], previous, with_hash=True)
+        assert(not manifest.stage_unchanged(previous, current))
+
+def test_manifest_new_input():
+    with tempfile.TemporaryDirectory() as tempdir:
+        fname = os.path.join(tempdir, "input.txt")
+        previous = manifest.stage_record([fname], {}, [], [])
+        assert(previous["inputs"][fname] is None)
+        assert(manifest.stage_unchanged(previous, manifest.stage_record([fname], {}, [], [])))
+        with open(fname, "w") as f:
+            f.write("1")
+        assert(not manifest.stage_unchanged(previous, manifest.stage_record([fname], {}, [], [])))
+
+def test_manifest_missing_output():
+    with tempfile.TemporaryDirectory() as tempdir:
+        record = manifest.stage_record([], {}, [], [os.path.join(tempdir, "avg_b0.png")])
+        assert(not manifest.stage_unchanged(record, record))
+
+def test_extract_incremental(monkeypatch):
+    hashed, ran = [], []
+    file_hash = manifest.file_hash
+    monkeypatch.setattr(manifest, "file_hash", lambda fname: hashed.append(fname) or file_hash(fname))
+    for stage in stages.STAGES:
+        def _run(ctx, stage=stage, run=stage.run):
+            ran.append(stage.name)
+            return run(ctx)
+        monkeypatch.setattr(stage, "run", _run)
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        args = generate_eddy_dir(os.path.join(tempdir, "eddy"), shape=(16, 16, 12), num_vols=12)
+        outdir = os.path.join(tempdir, "qc")
+        extract(**args, output=outdir, incremental=True)
+        # Files input to several stages, e.g. the 4D image, are hashed once per run
+        assert(len(hashed) == len(set(hashed)))
+        assert(sorted(ran) == sorted(stage.name for stage in stages.STAGES))
+
+        # Only the stage reading the changed input is run again
+        hashed.clear()
+        ran.clear()
+        with open(os.path.join(tempdir, "eddy", EDDYBASE + ".eddy_movement_rms"), "a") as f:
+            f.write("0.1 0.1\n")
+        extract(**args, output=outdir, incremental=True)
+        assert(ran == ["motion"])
+        assert(len(hashed) == 1)
@@ -0,0 +1,91 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from squat.utils import perf as perf_module
+from squat.utils.perf import PerfRecorder
+from squat.eddy.extract import extract
+from squat.test.eddy_data import generate_eddy_dir
+
+def test_perf_recorder():
+    perf = PerfRecorder()
+    with perf.measure("outer"):
+        for _ in range(3):
+            with perf.measure("inner"):
+                time.sleep(0.01)
+    results = perf.results()
+    assert(set(results) == {"outer", "inner"})
+    assert(results["inner"]["count"] == 3)
+    assert(results["outer"]["count"] == 1)
+    assert(results["inner"]["wall_time"] >= 0.03)
+    assert(results["outer"]["wall_time"] >= results["inner"]["wall_time"])
+    if results["outer"]["peak_rss"] is not None:
+        assert(results["outer"]["peak_rss"] >= results["inner"]["peak_rss"])
+
+def test_perf_recorder_exception():
+    perf = PerfRecorder()
+    try:
+        with perf.measure("failed"):
+            raise RuntimeError()
+    except RuntimeError:
+        pass
+    assert(perf.results()["failed"]["count"] == 1)
+
+def _no_peak_reset():
+    raise AssertionError("Performance measured without --perf")
+
+def test_extract_no_perf(monkeypatch):
+    monkeypatch.setattr(perf_module, "reset_peak_rss", _no_peak_reset)
+    with tempfile.TemporaryDirectory() as tempdir:
+        args = generate_eddy_dir(os.path.join(tempdir, "eddy"), shape=(8, 8, 4), num_vols=6)
+        output = extract(**args, output=os.path.join(tempdir, "qc"))
+        with open(os.path.join(output, "qc.json"), "r") as f:
+            assert("perf" not in json.load(f))
+
+        monkeypatch.setattr(perf_module, "reset_peak_rss", lambda: None)
+        output = extract(**args, output=os.path.join(tempdir, "qc"), overwrite=True, perf=True)
+        with open(os.path.join(output, "qc.json"), "r") as f:
+            assert("inputs" in json.load(f)["perf"])
+
+def _run_and_list_modules(code):
+    """
+    Run Python code in a new interpreter
+
+    :return: Tuple of (set of names of top level modules imported, wall time in seconds)
+    """
+    code = f"{code}\nimport sys\nprint(json.dumps(sorted(sys.modules)))"
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, "-c", "import json\n" + code], check=True, capture_output=True, text=True).stdout
+    elapsed = time.perf_counter() - start
+    return {m.split(".")[0] for m in json.loads(output.splitlines()[-1])}, elapsed
+
+def test_extract_import_time():
+    with tempfile.TemporaryDirectory() as tempdir:
+        args = generate_eddy_dir(os.path.join(tempdir, "eddy"), shape=(16, 16, 12), num_vols=12)
+        args["output"] = os.path.join(tempdir, "qc")
+        modules, elapsed = _run_and_list_modules(f"from squat.eddy.extract import extract\nextract(**{args!r})")
+        assert(os.path.isfile(os.path.join(args["output"], "qc.json")))
+    loaded = [m for m in ("matplotlib", "seaborn", "pandas", "fsl") if m in modules]
+    assert not loaded, f"squat_eddy imported {loaded} ({elapsed:.2f}s)"
+
+def test_group_extract_import_time():
+    with tempfile.TemporaryDirectory() as tempdir:
+        args = generate_eddy_dir(os.path.join(tempdir, "eddy"), shape=(16, 16, 12), num_vols=12)
+        extract(**args, output=os.path.join(tempdir, "subjects", "subj1"))
+        argv = ["squat", "--extract", "--subjdir", os.path.join(tempdir, "subjects"), "-o", os.path.join(tempdir, "group")]
+        # squat._version is generated by setup.py so may not exist in a source checkout
+        code = "\n".join([
+            "import sys, types",
+            "sys.modules.setdefault('squat._version', types.SimpleNamespace(__version__='test'))",
+            f"sys.argv = {argv!r}",
+            "from squat.main import main",
+            "main()",
+        ])
+        modules, elapsed = _run_and_list_modules(code)
+        assert(os.path.isfile(os.path.join(tempdir, "group", "group_data.json")))
+    # Report modules are only imported when reports are generated
+    loaded = [m for m in ("matplotlib", "seaborn", "pandas", "nibabel") if m in modules]
+    assert not loaded, f"squat --extract imported {loaded} ({elapsed:.2f}s)"
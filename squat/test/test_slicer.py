@@ -0,0 +1,53 @@
+import tempfile
+import os
+
+import numpy as np
+import matplotlib.image
+
+from squat.utils.slicer import ortho_slices, slice_strip, render_slices, save_slices
+
+def test_ortho_slices_shape():
+    vol = np.random.rand(10, 12, 8)
+    sag, cor, ax = ortho_slices(vol)
+    assert(sag.shape == (8, 12))
+    assert(cor.shape == (8, 10))
+    assert(ax.shape == (12, 10))
+
+def test_ortho_slices_zooms():
+    vol = np.random.rand(10, 12, 8)
+    sag, cor, ax = ortho_slices(vol, zooms=(1, 1, 2))
+    assert(sag.shape == (16, 12))
+    assert(cor.shape == (16, 10))
+    assert(ax.shape == (12, 10))
+
+def test_ortho_slices_superior_up():
+    vol = np.zeros((5, 5, 5))
+    vol[:, :, -1] = 1
+    sag, cor, _ = ortho_slices(vol)
+    assert(np.all(sag[0] == 1))
+    assert(np.all(cor[0] == 1))
+
+def test_slice_strip():
+    strip = slice_strip(np.ones((10, 12, 8)), fill=-1)
+    assert(strip.shape == (12, 12 + 10 + 10))
+    assert(np.count_nonzero(strip == -1) == 2 * 2 * (12 + 10))
+
+def test_render_window():
+    vol = np.full((4, 4, 4), 5.0)
+    assert(np.all(render_slices(vol, i=(0, 10)) == 128))
+    assert(np.all(render_slices(vol, i=(0, 2)) == 255))
+    assert(np.all(render_slices(vol, i=(6, 10)) == 0))
+
+def test_render_nan():
+    vol = np.full((4, 4, 4), np.nan)
+    assert(np.all(render_slices(vol, i=(0, 1)) == 0))
+
+def test_save_png():
+    vol = np.random.rand(6, 7, 8)
+    with tempfile.TemporaryDirectory() as tempdir:
+        fname = os.path.join(tempdir, "slices.png")
+        save_slices(vol, fname, i=(0, 1))
+        img = matplotlib.image.imread(fname)
+    expected = render_slices(vol, i=(0, 1))
+    assert(img.shape == expected.shape)
+    assert(np.allclose(np.round(img * 255), expected))
@@ -0,0 +1,52 @@
+"""
+SQUAT: Study-wise QUality Assessment Tool
+
+Identification of b-value shells
+
+Matteo Bastiani, Michiel Cottaar, Jesper Andersson, FMRIB, Oxford
+"""
+import logging
+
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+def bval_shells(bvals, tol=100):
+    """
+    Cluster b-values into shells
+
+    B-values are in the same shell if they are within ``tol`` of each other, or are
+    linked by a chain of such b-values. This is found by sorting the b-values once
+    and splitting wherever the gap between consecutive values is greater than ``tol``.
+
+    :param bvals: 1D array of b-values
+    :param tol: Tolerance
+    :return: Array of shell index for each b-value. Shells are numbered in order of
+             increasing b-value
+    """
+    bvals = np.asarray(bvals)
+    shells = np.zeros(bvals.size, dtype=int)
+    if bvals.size == 0:
+        return shells
+    order = np.argsort(bvals, kind="stable")
+    shells[order] = np.concatenate([[0], np.cumsum(np.diff(bvals[order]) > tol)])
+    return shells
+
+def round_bvals_median(bvals, tol=100):
+    """
+    Round bvals to the median value for each identified shell
+
+    :param bvals: 1D array of b-values
+    :param tol: Tolerance used to identify shells, see :func:`bval_shells`. Shells
+                with a median b-value at or below the tolerance are rounded to 0
+    :return: Array of rounded b-values
+    """
+    shells = bval_shells(bvals, tol)
+    res_b = bvals.copy()
+    for shell in range(shells.max() + 1 if shells.size else 0):
+        use = shells == shell
+        median_b = int(np.median(bvals[use]))
+        LOG.info('Found b-shell of %i orientations with b-value %f' % (use.sum(), median_b))
+        res_b[use] = median_b
+    res_b[res_b <= tol] = 0
+    return res_b
@@ -0,0 +1,23 @@
+"""
+SQUAT: Study-wise QUality Assessment Tool
+
+Content hashing of files
+
+Martin Craig, SPMIC, Nottingham
+"""
+import hashlib
+
+HASH_BLOCK_SIZE = 4 * 1024 * 1024
+
+def file_hash(fname):
+    """
+    :return: SHA-1 hex digest of file content
+    """
+    sha = hashlib.sha1()
+    with open(fname, "rb") as f:
+        while True:
+            block = f.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            sha.update(block)
+    return sha.hexdigest()
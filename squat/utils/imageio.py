@@ -0,0 +1,391 @@
+"""
+SQUAT: Image loading
+
+Compressed NIfTI images are opened through a seek-point index using the
+optional ``indexed_gzip`` package (``pip install squat[indexed_gzip]``). For
+images large enough to benefit, the index is persisted in an index directory,
+by default in the user's cache directory (see :func:`configure_index_cache`).
+Once the index exists, any volume can be read without decompressing the file
+from the start, and independent volume ranges can be read concurrently.
+Without ``indexed_gzip`` compressed images are read sequentially by nibabel.
+
+Optionally, large compressed images can be decompressed once into a cache
+directory shared between runs and tools. Cached copies are keyed on the source
+file path, size and modification time and are memory-mapped when read, so
+later runs read them without any decompression or copying
+
+Martin Craig, SPMIC, Nottingham
+"""
+import os
+import gzip
+import hashlib
+import logging
+import shutil
+import threading
+import zlib
+
+import numpy as np
+import nibabel as nib
+
+try:
+    import indexed_gzip as igzip
+except ImportError:
+    igzip = None
+
+LOG = logging.getLogger(__name__)
+
+INDEX_SUFFIX = ".gzidx"
+
+# Uncompressed bytes between index seek points
+INDEX_SPACING = 4 * 1024 * 1024
+
+# Extensions of compressed files, which cannot be memory-mapped
+COMPRESSED_EXTS = (".gz", ".bz2", ".zst")
+
+# Environment variable giving the default decompressed image cache directory
+CACHE_DIR_ENV = "SQUAT_CACHE_DIR"
+
+# Default limit on the total size of the decompressed image cache
+DEFAULT_CACHE_SIZE = 16 * 1024**3
+
+# Compressed images smaller than this are not worth caching or indexing
+CACHE_MIN_SIZE = 1024**2
+
+# Environment variable giving the default seek point index directory
+INDEX_DIR_ENV = "SQUAT_INDEX_DIR"
+
+# Default limit on the total size of persisted seek point indexes
+DEFAULT_INDEX_CACHE_SIZE = 1024**3
+
+_cache = {"dir" : os.environ.get(CACHE_DIR_ENV) or None, "max_size" : DEFAULT_CACHE_SIZE}
+
+_index_cache = {"dir" : None, "enabled" : True, "max_size" : DEFAULT_INDEX_CACHE_SIZE}
+
+def configure_cache(cache_dir, max_size=DEFAULT_CACHE_SIZE):
+    """
+    Enable or disable the decompressed image cache used by :func:`load_image`
+
+    The cache is disabled by default unless the ``SQUAT_CACHE_DIR`` environment
+    variable is set.
+
+    :param cache_dir: Directory in which to keep uncompressed copies of compressed
+                      images, created if it does not exist. None to disable the cache
+    :param max_size: Maximum total size in bytes of the cached copies. The least
+                     recently used copies are removed to keep within it
+    """
+    _cache["dir"] = cache_dir
+    _cache["max_size"] = max_size
+
+def configure_index_cache(index_dir=None, enabled=True, max_size=DEFAULT_INDEX_CACHE_SIZE):
+    """
+    Configure where the seek point indexes of compressed images are persisted
+
+    Indexes are independent of the decompressed image cache and are persisted by
+    default.
+
+    :param index_dir: Directory in which to keep indexes, created if it does not exist.
+                      If None, the ``SQUAT_INDEX_DIR`` environment variable or, if that
+                      is not set, ``squat/indexes`` in the user's cache directory
+    :param enabled: If False, indexes are not persisted
+    :param max_size: Maximum total size in bytes of the indexes. The least recently
+                     used are removed to keep within it
+    """
+    _index_cache["dir"] = index_dir
+    _index_cache["enabled"] = enabled
+    _index_cache["max_size"] = max_size
+
+def _index_dir():
+    """
+    :return: Directory of persisted seek point indexes, or None if disabled
+    """
+    if not _index_cache["enabled"]:
+        return None
+    if _index_cache["dir"]:
+        return _index_cache["dir"]
+    if os.environ.get(INDEX_DIR_ENV):
+        return os.environ[INDEX_DIR_ENV]
+    user_cache = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(user_cache, "squat", "indexes")
+
+def _cache_key(fname):
+    return hashlib.sha1(os.path.abspath(fname).encode("utf-8")).hexdigest()
+
+def cache_sidecar(fname, suffix):
+    """
+    Get the path in the cache directory of a small file derived from a source file,
+    e.g. decoded text data, so nothing is written beside the source
+
+    :param fname: Source file name
+    :param suffix: Suffix identifying the kind of derived file
+    :return: Path of the derived file, or None if the cache is disabled
+    """
+    if not _cache["dir"]:
+        return None
+    return os.path.join(_cache["dir"], _cache_key(fname) + suffix)
+
+def _remove_file(fname):
+    try:
+        os.remove(fname)
+    except OSError:
+        pass
+
+def evict_lru(cache_dir, max_size, keep, suffixes=None):
+    """
+    Remove least recently used cache entries until a cache is within its size limit
+
+    Entries are files in the cache directory whose modification time is updated
+    whenever they are used. Files still being written (``.tmp``) are not entries.
+
+    :param cache_dir: Cache directory
+    :param max_size: Maximum total size in bytes of the entries
+    :param keep: Path of the entry just added, which is never removed
+    :param suffixes: File name suffixes of cache entries, or None for every file in
+                     the cache directory. Other files are ignored
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.endswith(".tmp") or path == keep or (suffixes and not name.endswith(suffixes)):
+            continue
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # Removed by another process
+            continue
+        if os.path.isfile(path):
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+    total = os.path.getsize(keep) + sum(size for _mtime, size, _path in entries)
+    for _mtime, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        LOG.debug(f"Removing {path} from cache")
+        _remove_file(path)
+        total -= size
+
+def trim_cache(keep):
+    """
+    Keep the image cache within its size limit after adding an entry
+
+    Every file in the cache directory counts towards the limit, including files
+    derived from sources by other modules (see :func:`cache_sidecar`).
+
+    :param keep: Path of the entry just added, which is never removed
+    """
+    evict_lru(_cache["dir"], _cache["max_size"], keep)
+
+def _gzip_isize(fname):
+    """
+    :return: Uncompressed size of a gzip file modulo 2**32 from its trailer, which
+             is a lower bound on the true size
+    """
+    with open(fname, "rb") as f:
+        f.seek(-4, os.SEEK_END)
+        return int.from_bytes(f.read(4), "little")
+
+def cached_file(fname):
+    """
+    Get an uncompressed copy of a compressed image from the cache, creating it if needed
+
+    Failure to create the copy (e.g. lack of disk space) is not an error - the
+    compressed image should be read instead.
+
+    :param fname: Image file name
+    :return: Path to an up to date uncompressed copy, or None if the cache is disabled
+             or the image is not cached
+    """
+    cache_dir, max_size = _cache["dir"], _cache["max_size"]
+    if not cache_dir or not fname.endswith(".gz"):
+        return None
+
+    tmp_fname = None
+    try:
+        stat = os.stat(fname)
+        if stat.st_size < CACHE_MIN_SIZE:
+            return None
+        if _gzip_isize(fname) > max_size:
+            LOG.debug(f"Not caching {fname}: larger than the cache size limit")
+            return None
+        key = _cache_key(fname)
+        cached_fname = os.path.join(cache_dir, f"{key}_{stat.st_size}_{stat.st_mtime_ns}.nii")
+        if os.path.isfile(cached_fname):
+            # Mark as recently used
+            os.utime(cached_fname)
+            LOG.debug(f"Using cached copy of {fname}")
+            return cached_fname
+
+        os.makedirs(cache_dir, exist_ok=True)
+        for name in os.listdir(cache_dir):
+            if name.startswith(key + "_") and name.endswith(".nii"):
+                LOG.debug(f"Removing out of date cached copy of {fname}")
+                os.remove(os.path.join(cache_dir, name))
+
+        tmp_fname = cached_fname + f".{os.getpid()}.{threading.get_ident()}.tmp"
+        with gzip.open(fname, "rb") as src, open(tmp_fname, "wb") as dst:
+            shutil.copyfileobj(src, dst, 16 * 1024**2)
+        if os.path.getsize(tmp_fname) > max_size:
+            LOG.debug(f"Not caching {fname}: larger than the cache size limit")
+            os.remove(tmp_fname)
+            return None
+        os.replace(tmp_fname, cached_fname)
+        LOG.debug(f"Cached uncompressed copy of {fname}")
+        trim_cache(cached_fname)
+        return cached_fname
+    except (OSError, EOFError, zlib.error) as exc:
+        LOG.debug(f"Could not cache {fname}: {exc}")
+        if tmp_fname is not None:
+            try:
+                os.remove(tmp_fname)
+            except OSError:
+                pass
+        return None
+
+def image_memmap(img):
+    """
+    Get the stored data of an image as a memory-mapped array
+
+    :param img: nibabel image
+    :return: Memory-mapped array of the unscaled data, or None if the image is
+             not an uncompressed file which nibabel can memory-map
+    """
+    dataobj = getattr(img, "dataobj", None)
+    file_like = getattr(dataobj, "file_like", None)
+    if not isinstance(file_like, str) or file_like.endswith(COMPRESSED_EXTS):
+        return None
+    if not getattr(dataobj, "_mmap", False) or not hasattr(dataobj, "get_unscaled"):
+        return None
+    data = dataobj.get_unscaled()
+    return data if isinstance(data, np.memmap) else None
+
+def _index_fname(fname):
+    """
+    :return: Path of the persisted index of an image, keyed on the image path, size and
+             modification time, or None if indexes are not persisted or the image
+             cannot be read
+    """
+    index_dir = _index_dir()
+    if not index_dir:
+        return None
+    try:
+        stat = os.stat(fname)
+    except OSError:
+        return None
+    return os.path.join(index_dir, f"{_cache_key(fname)}_{stat.st_size}_{stat.st_mtime_ns}{INDEX_SUFFIX}")
+
+def _index_valid(fname):
+    """
+    :return: True if a persisted index of the current image file exists
+    """
+    index_fname = _index_fname(fname)
+    return index_fname is not None and os.path.isfile(index_fname)
+
+def _indexed_fileobj(img):
+    """
+    :return: The IndexedGzipFile an image was loaded from, or None
+    """
+    if igzip is None:
+        return None
+    fileobj = getattr(img.dataobj, "file_like", None)
+    if isinstance(fileobj, igzip.IndexedGzipFile):
+        return fileobj
+    return None
+
+def load_image(fname, use_index=True):
+    """
+    Load a NIfTI image for volume-wise reading
+
+    :param fname: Image file name
+    :param use_index: If True, and the image is gzip-compressed and ``indexed_gzip``
+                      is available, read it through a seek-point index. A
+                      previously saved index is reused if it is up to date
+    :return: nibabel image. The image file is kept open between reads. If the
+             decompressed image cache is enabled (see :func:`configure_cache`) a
+             large compressed image is loaded from its memory-mapped cached copy
+    """
+    cached_fname = cached_file(fname)
+    if cached_fname is not None:
+        return nib.load(cached_fname, mmap=True, keep_file_open=True)
+
+    if not use_index or not fname.endswith(".gz"):
+        return nib.load(fname, keep_file_open=True)
+    if igzip is None:
+        LOG.debug(f"indexed_gzip not available - reading {fname} sequentially")
+        return nib.load(fname, keep_file_open=True)
+
+    fileobj = None
+    if _index_valid(fname):
+        LOG.debug(f"Using seek point index for {fname}")
+        index_fname = _index_fname(fname)
+        try:
+            fileobj = igzip.IndexedGzipFile(fname, spacing=INDEX_SPACING, drop_handles=False, index_file=index_fname)
+            # Mark as recently used
+            os.utime(index_fname)
+        except (OSError, igzip.ZranError) as exc:
+            LOG.warn(f"Could not use seek point index for {fname} - rebuilding it: {exc}")
+            _remove_file(index_fname)
+    if fileobj is None:
+        fileobj = igzip.IndexedGzipFile(fname, spacing=INDEX_SPACING, drop_handles=False)
+    holder = nib.FileHolder(filename=fname, fileobj=fileobj)
+    try:
+        return nib.Nifti1Image.from_file_map({"header" : holder, "image" : holder})
+    except nib.spatialimages.HeaderDataError:
+        # Not NIfTI-1 - leave it to nibabel to work out the format
+        fileobj.close()
+        return nib.load(fname, keep_file_open=True)
+
+def close_image(img):
+    """
+    Close the file handles an image loaded with :func:`load_image` keeps open
+
+    :param img: nibabel image
+    """
+    dataobj = getattr(img, "dataobj", None)
+    opener = getattr(dataobj, "_opener", None)
+    if opener is not None:
+        opener.close_if_mine()
+    fileobj = getattr(dataobj, "file_like", None)
+    if not isinstance(fileobj, str) and hasattr(fileobj, "close"):
+        fileobj.close()
+
+def has_index(img):
+    """
+    :return: True if an image was loaded with a complete, persisted seek-point index
+    """
+    return _indexed_fileobj(img) is not None and _index_valid(img.get_filename())
+
+def save_index(img):
+    """
+    Persist the seek-point index of an image so later reads can use it
+
+    This should be called after the whole image has been read, at which point the
+    index covers the whole file and saving it costs no extra decompression.
+    The index is saved in the index directory (see :func:`configure_index_cache`),
+    and only for images of at least ``CACHE_MIN_SIZE`` bytes. Failure to save the
+    index (e.g. a read-only directory) is not an error.
+
+    :param img: Image returned by :func:`load_image`
+    """
+    fileobj = _indexed_fileobj(img)
+    fname = img.get_filename()
+    index_fname = _index_fname(fname)
+    if fileobj is None or index_fname is None or _index_valid(fname):
+        return
+
+    tmp_fname = index_fname + f".{os.getpid()}.tmp"
+    try:
+        if os.path.getsize(fname) < CACHE_MIN_SIZE:
+            return
+        index_dir = os.path.dirname(index_fname)
+        os.makedirs(index_dir, exist_ok=True)
+        key = _cache_key(fname)
+        for name in os.listdir(index_dir):
+            if name.startswith(key + "_") and name.endswith(INDEX_SUFFIX):
+                LOG.debug(f"Removing out of date seek point index for {fname}")
+                os.remove(os.path.join(index_dir, name))
+        fileobj.build_full_index()
+        fileobj.export_index(tmp_fname)
+        os.replace(tmp_fname, index_fname)
+        LOG.debug(f"Saved seek point index for {fname}")
+        evict_lru(index_dir, _index_cache["max_size"], index_fname, suffixes=(INDEX_SUFFIX,))
+    except (OSError, igzip.ZranError) as exc:
+        LOG.debug(f"Could not save seek point index for {fname}: {exc}")
+        _remove_file(tmp_fname)
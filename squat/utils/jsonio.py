@@ -0,0 +1,200 @@
+"""
+SQUAT: Study-wise QUality Assessment Tool
+
+Compact JSON output for QC data
+
+QC data contains large Numpy arrays. Rather than converting them to nested
+lists for the standard library encoder, which writes every value on its own
+indented line, arrays are formatted a row at a time and written straight to
+the file. Each innermost list is written on a single line, float32 arrays
+are written with the shortest text which reads back as the same float32
+value, the number of significant digits of floating point values can be
+limited per field, and whitespace can be omitted altogether.
+
+The output is standard JSON, apart from non-finite values which are written
+as ``NaN``, ``Infinity`` and ``-Infinity`` in the same way as the standard
+library, so it can be read with ``json.load``
+
+Martin Craig, SPMIC, Nottingham
+"""
+import fnmatch
+import json
+import logging
+
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+def _fix_nonfinite(text):
+    """
+    Replace Python's text for non-finite values with the JSON encoder's
+    """
+    if "n" not in text:
+        return text
+    return text.replace("nan", "NaN").replace("inf", "Infinity")
+
+def _format_floats(values, digits):
+    """
+    :param values: Sequence of Python floats
+    :param digits: Number of significant digits, or None for the shortest text which
+                   reproduces each value exactly
+    :return: Comma separated text of the values
+    """
+    if digits is None:
+        text = ",".join(map(float.__repr__, values))
+    else:
+        text = ",".join([f"%.{digits}g"] * len(values)) % tuple(values)
+    return _fix_nonfinite(text)
+
+def _format_float(value, digits):
+    text = _format_floats([float(value)], digits)
+    if digits is not None and not any(c in text for c in ".eIN"):
+        # Keep the value a float when it is read back
+        text += ".0"
+    return text
+
+def _format_row(row, digits):
+    """
+    :param row: 1D Numpy array
+    :return: Comma separated text of the values
+    """
+    if row.dtype.kind == "f":
+        if digits is None and row.dtype.itemsize <= 4:
+            # Numpy gives the shortest text which reproduces a float32 scalar
+            return _fix_nonfinite(",".join(map(str, row)))
+        return _format_floats(row.tolist(), digits)
+    elif row.dtype.kind == "b":
+        return ",".join(["true" if v else "false" for v in row.tolist()])
+    else:
+        return ",".join(map(str, row.tolist()))
+
+def _is_scalar(value):
+    return value is None or isinstance(value, (str, bool, int, float, np.generic))
+
+class _Writer:
+    def __init__(self, f, indent, digits, field_digits):
+        self.f = f
+        self.indent = indent
+        self.digits = digits
+        self.field_digits = field_digits
+        self.item_sep, self.key_sep = (",", ":") if indent is None else (",", ": ")
+
+    def newline(self, level):
+        if self.indent is not None:
+            self.f.write("\n" + " " * (self.indent * level))
+
+    def digits_for(self, key):
+        for pattern, digits in self.field_digits.items():
+            if fnmatch.fnmatchcase(key, pattern):
+                return digits
+        return self.digits
+
+    def write(self, value, digits, level):
+        f = self.f
+        if isinstance(value, np.ndarray) and value.dtype.kind in "biuf":
+            if value.ndim == 0:
+                self.write(value.item(), digits, level)
+            elif value.ndim == 1:
+                f.write("[" + _format_row(value, digits) + "]")
+            else:
+                self.write_items(list(value), digits, level)
+        elif isinstance(value, np.ndarray):
+            self.write(value.tolist(), digits, level)
+        elif value is None:
+            f.write("null")
+        elif isinstance(value, (bool, np.bool_)):
+            f.write("true" if value else "false")
+        elif isinstance(value, (int, np.integer)):
+            f.write(str(int(value)))
+        elif isinstance(value, (float, np.floating)):
+            f.write(_format_float(value, digits))
+        elif isinstance(value, str):
+            f.write(json.dumps(value))
+        elif isinstance(value, dict):
+            self.write_dict(value, digits, level)
+        elif isinstance(value, (list, tuple)):
+            if value and all(type(v) is float for v in value):
+                # Lists of floats converted from arrays are formatted in one go
+                f.write("[" + _format_floats(value, digits) + "]")
+            elif all(_is_scalar(v) for v in value):
+                # Innermost lists are written on one line
+                f.write("[")
+                for idx, v in enumerate(value):
+                    if idx:
+                        f.write(self.item_sep)
+                    self.write(v, digits, level)
+                f.write("]")
+            else:
+                self.write_items(value, digits, level)
+        else:
+            raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+    def write_items(self, items, digits, level):
+        self.f.write("[")
+        for idx, item in enumerate(items):
+            if idx:
+                self.f.write(self.item_sep)
+            self.newline(level + 1)
+            self.write(item, digits, level + 1)
+        if items:
+            self.newline(level)
+        self.f.write("]")
+
+    def write_dict(self, value, digits, level):
+        self.f.write("{")
+        for idx, key in enumerate(sorted(value, key=str)):
+            if idx:
+                self.f.write(self.item_sep)
+            self.newline(level + 1)
+            self.f.write(json.dumps(str(key)) + self.key_sep)
+            self.write(value[key], self.digits_for(str(key)) if level == 0 else digits, level + 1)
+        if value:
+            self.newline(level)
+        self.f.write("}")
+
+def parse_digits(specs):
+    """
+    Parse significant digit options
+
+    :param specs: Sequence of strings, each either a number of digits for all fields,
+                  e.g. ``6``, or a field name or glob pattern and number of digits for
+                  matching fields, e.g. ``qc_outliers_*=3``. May be None
+    :return: Tuple of (default digits or None, dictionary of field pattern to digits)
+    """
+    digits, field_digits = None, {}
+    for spec in specs or []:
+        pattern, _, value = str(spec).rpartition("=")
+        try:
+            value = int(value)
+        except ValueError:
+            raise ValueError(f"Invalid number of significant digits: {spec}")
+        if value < 1 or value > 17:
+            raise ValueError(f"Number of significant digits must be between 1 and 17: {spec}")
+        if pattern:
+            field_digits[pattern] = value
+        else:
+            digits = value
+    return digits, field_digits
+
+def write_json(fname, data, indent=4, digits=None, field_digits=None):
+    """
+    Write QC data to a JSON file
+
+    Keys are sorted as for ``json.dump(..., sort_keys=True)``.
+
+    :param fname: Output file name
+    :param data: Dictionary of data. Values may be Numpy arrays or scalars, or any
+                 value supported by the json module
+    :param indent: Number of spaces to indent nested values, or None for compact
+                   output with no whitespace
+    :param digits: Number of significant digits of floating point values. If None,
+                   float64 values are written exactly and float32 arrays with the
+                   shortest text which reproduces them exactly
+    :param field_digits: Optional dictionary mapping top-level keys to the number of
+                         significant digits for that field, overriding ``digits``.
+                         Keys may be glob patterns, e.g. ``qc_outliers_*``
+    """
+    with open(fname, "w") as f:
+        writer = _Writer(f, indent, digits, field_digits or {})
+        writer.write_dict(data, digits, 0)
+        f.write("\n")
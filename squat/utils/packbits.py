@@ -0,0 +1,76 @@
+"""
+SQUAT: Study-wise QUality Assessment Tool
+
+Bit-packed binary maps, e.g. EDDY outlier maps. Each row's values are packed
+into bytes as by ``np.packbits`` and base64 encoded so the packed map can be
+stored directly in JSON. Counts are computed from the packed bytes without
+unpacking
+
+Martin Craig, SPMIC, Nottingham
+"""
+import base64
+
+import numpy as np
+
+# Number of set bits in each byte value
+_BIT_COUNTS = np.unpackbits(np.arange(256, dtype=np.uint8)[:, np.newaxis], axis=1).sum(axis=1)
+
+def is_packed(value):
+    """
+    :return: True if a value is a bit-packed outlier map
+    """
+    return isinstance(value, dict) and "packbits" in value
+
+def pack_outlier_map(ol_map):
+    """
+    Pack a binary outlier map into bits
+
+    :param ol_map: Binary outlier map [NVOLS, NSLICES]. Non-zero values are outliers
+    :return: Dictionary containing ``shape`` ([NVOLS, NSLICES]) and ``packbits`` (base64
+             encoded bytes of the map packed along the slice axis by ``np.packbits``,
+             [NVOLS, ceil(NSLICES / 8)])
+    """
+    ol_map = np.asarray(ol_map)
+    if ol_map.ndim != 2:
+        raise ValueError(f"Outlier map must be 2D: shape {ol_map.shape}")
+    bits = np.packbits(ol_map != 0, axis=1)
+    return {
+        "shape" : list(ol_map.shape),
+        "packbits" : base64.b64encode(bits.tobytes()).decode("ascii"),
+    }
+
+def packed_bits(packed):
+    """
+    :param packed: Bit-packed outlier map
+    :return: uint8 array of packed bits [NVOLS, ceil(NSLICES / 8)]
+    """
+    num_vols, num_slices = packed["shape"]
+    bits = np.frombuffer(base64.b64decode(packed["packbits"]), dtype=np.uint8)
+    row_bytes = (num_slices + 7) // 8
+    if bits.size != num_vols * row_bytes:
+        raise ValueError(f"Packed outlier map has {bits.size} bytes, expected {num_vols * row_bytes} for shape {packed['shape']}")
+    return bits.reshape(num_vols, row_bytes)
+
+def unpack_outlier_map(packed):
+    """
+    :param packed: Bit-packed outlier map
+    :return: Binary outlier map as uint8 array [NVOLS, NSLICES]
+    """
+    return np.unpackbits(packed_bits(packed), axis=1, count=packed["shape"][1])
+
+def packed_counts(packed):
+    """
+    Count outliers in a bit-packed outlier map
+
+    :param packed: Bit-packed outlier map
+    :return: Tuple of integer arrays (outlier slices in each volume [NVOLS], outlier
+             volumes in each slice [NSLICES])
+    """
+    bits = packed_bits(packed)
+    per_vol = _BIT_COUNTS[bits].sum(axis=1, dtype=int)
+    # Bit 7 of each byte is the first of its 8 slices, so count each bit position
+    # over volumes and interleave the results back into slice order
+    per_slice = np.empty((bits.shape[1], 8), dtype=int)
+    for bit in range(8):
+        per_slice[:, 7 - bit] = np.count_nonzero(bits & (1 << bit), axis=0)
+    return per_vol, per_slice.ravel()[:packed["shape"][1]]
@@ -0,0 +1,164 @@
+"""
+SQUAT: Performance instrumentation
+
+Records wall time, CPU time, bytes read and peak resident memory for named
+steps of a run. Steps may be nested and a step may be measured more than once,
+in which case its times and bytes are summed and its peak memory is the
+maximum over all measurements.
+
+Bytes read and per-step peak memory come from ``/proc`` and are only
+available on Linux. Elsewhere bytes read are not recorded and the peak memory
+is the peak of the whole process up to the end of the step.
+
+Steps may be measured on different threads at the same time. CPU time, bytes
+read and peak memory are process-wide, so the measurements of concurrent
+steps include each other's activity
+
+Martin Craig, SPMIC, Nottingham
+"""
+import contextlib
+import logging
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+LOG = logging.getLogger(__name__)
+
+def bytes_read():
+    """
+    :return: Total bytes read by this process through read system calls, or None if not known
+    """
+    try:
+        with open("/proc/self/io", "r") as f:
+            for line in f:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+def peak_rss():
+    """
+    :return: Peak resident memory in bytes since the last call to :func:`reset_peak_rss`,
+             or since the process started. None if not known
+    """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    if resource is not None:
+        # Bytes on Mac, kilobytes elsewhere
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
+    return None
+
+def reset_peak_rss():
+    """
+    Reset the peak resident memory to the current resident memory, where supported
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+class PerfRecorder:
+    """
+    Collects performance measurements of named steps
+    """
+
+    def __init__(self):
+        self._steps = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._active = 0
+
+    def _stack(self):
+        """
+        :return: Steps being measured by the current thread, innermost last
+        """
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        """
+        Context manager measuring a step
+
+        :param name: Step name
+        """
+        stack = self._stack()
+        if stack:
+            # Peak memory of the enclosing step so far, before it is reset for this step
+            stack[-1]["peak_rss"] = _max(stack[-1]["peak_rss"], peak_rss())
+        with self._lock:
+            # The peak is process-wide, so it is only reset if no other thread is measuring a step
+            if self._active == len(stack):
+                reset_peak_rss()
+            self._active += 1
+        current = {"peak_rss" : None}
+        stack.append(current)
+        start_wall, start_cpu, start_read = time.perf_counter(), time.process_time(), bytes_read()
+        try:
+            yield
+        finally:
+            end_read = bytes_read()
+            step_peak = _max(current["peak_rss"], peak_rss())
+            with self._lock:
+                step = self._steps.setdefault(name, {"wall_time" : 0.0, "cpu_time" : 0.0, "bytes_read" : None, "peak_rss" : None, "count" : 0})
+                step["wall_time"] += time.perf_counter() - start_wall
+                step["cpu_time"] += time.process_time() - start_cpu
+                if start_read is not None and end_read is not None:
+                    step["bytes_read"] = (step["bytes_read"] or 0) + end_read - start_read
+                step["peak_rss"] = _max(step["peak_rss"], step_peak)
+                step["count"] += 1
+                self._active -= 1
+            stack.pop()
+            if stack:
+                stack[-1]["peak_rss"] = _max(stack[-1]["peak_rss"], step_peak)
+            LOG.debug(f"{name}: wall time {step['wall_time']:.3f}s, CPU time {step['cpu_time']:.3f}s")
+
+    def results(self):
+        """
+        :return: Dictionary mapping step name to a dictionary of ``wall_time`` and
+                 ``cpu_time`` (seconds), ``bytes_read``, ``peak_rss`` (bytes) and ``count``
+                 (number of times the step was measured)
+        """
+        with self._lock:
+            return {name : dict(step) for name, step in self._steps.items()}
+
+class NullPerfRecorder:
+    """
+    Recorder with the interface of :class:`PerfRecorder` which measures nothing,
+    for runs where performance data is not wanted
+    """
+
+    def measure(self, name):
+        """
+        Context manager which does nothing
+
+        :param name: Step name
+        """
+        return contextlib.nullcontext()
+
+    def results(self):
+        """
+        :return: Empty dictionary
+        """
+        return {}
+
+def _max(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return max(a, b)
@@ -0,0 +1,161 @@
+"""
+SQUAT: Study-wise QUality Assessment Tool
+
+Cache of rendered slice images shared between runs and tools. Each rendering is
+keyed on the content hash of the files it was rendered from together with the
+volume, intensity window and renderer options, so an unchanged image is never
+rendered twice, even if it has been copied or moved. The cache is kept within
+a byte budget by removing the least recently used renderings.
+
+Content hashes are remembered in the cache directory against the file path,
+size and modification time, so unchanged files are only hashed once
+
+Martin Craig, SPMIC, Nottingham
+"""
+import os
+import json
+import hashlib
+import logging
+import threading
+
+from .hashing import file_hash
+from .imageio import evict_lru
+
+LOG = logging.getLogger(__name__)
+
+# Environment variable giving the default render cache directory
+RENDER_CACHE_DIR_ENV = "SQUAT_RENDER_CACHE_DIR"
+
+# Default limit on the total size of cached renderings
+DEFAULT_RENDER_CACHE_SIZE = 1024**3
+
+# Suffix of cached renderings
+RENDER_SUFFIX = ".render"
+
+# Subdirectory of the cache directory in which content hashes are remembered
+HASHES_DIR = "hashes"
+
+_cache = {"dir" : os.environ.get(RENDER_CACHE_DIR_ENV) or None, "max_size" : DEFAULT_RENDER_CACHE_SIZE}
+
+def configure_render_cache(cache_dir, max_size=DEFAULT_RENDER_CACHE_SIZE):
+    """
+    Enable or disable the render cache
+
+    The cache is disabled by default unless the ``SQUAT_RENDER_CACHE_DIR`` environment
+    variable is set.
+
+    :param cache_dir: Directory in which to keep rendered images, created if it does not
+                      exist. None to disable the cache
+    :param max_size: Maximum total size in bytes of the rendered images. The least
+                     recently used are removed to keep within it
+    """
+    _cache["dir"] = cache_dir
+    _cache["max_size"] = max_size
+
+def _write_atomic(fname, content):
+    tmp_fname = fname + f".{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_fname, "wb") as f:
+            f.write(content)
+        os.replace(tmp_fname, fname)
+    finally:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+
+def source_hash(fname):
+    """
+    Get the content hash of a source file, reusing the remembered hash if the file
+    is unchanged
+
+    :param fname: File path
+    :return: SHA-1 hex digest of file content
+    """
+    stat = os.stat(fname)
+    fingerprint = f"{stat.st_size} {stat.st_mtime_ns}"
+    hashes_dir = os.path.join(_cache["dir"], HASHES_DIR)
+    memo_fname = os.path.join(hashes_dir, hashlib.sha1(os.path.abspath(fname).encode("utf-8")).hexdigest())
+    try:
+        with open(memo_fname, "r") as f:
+            memo_fingerprint, sha1 = f.read().rsplit(" ", 1)
+        if memo_fingerprint == fingerprint:
+            return sha1
+    except (OSError, ValueError):
+        pass
+
+    sha1 = file_hash(fname)
+    os.makedirs(hashes_dir, exist_ok=True)
+    _write_atomic(memo_fname, f"{fingerprint} {sha1}".encode("utf-8"))
+    return sha1
+
+def render_key(sources, **options):
+    """
+    Get the cache key of a rendering
+
+    :param sources: Paths of the files the rendering is derived from. None entries are ignored
+    :param options: Everything else the rendering depends on, e.g. volume index, intensity
+                    window and renderer options. Values must be JSON serializable
+    :return: Cache key, or None if the cache is disabled or a source file could not be read
+    """
+    if not _cache["dir"]:
+        return None
+    try:
+        hashes = [source_hash(fname) for fname in sources if fname is not None]
+    except OSError as exc:
+        LOG.debug(f"Not caching rendering of {sources}: {exc}")
+        return None
+    desc = json.dumps({"sources" : hashes, "options" : options}, sort_keys=True, default=float)
+    return hashlib.sha1(desc.encode("utf-8")).hexdigest()
+
+def lookup(key):
+    """
+    Get a rendering from the cache
+
+    :param key: Cache key from :func:`render_key`, or None
+    :return: Rendering as bytes, or None if it is not in the cache
+    """
+    if key is None:
+        return None
+    cached_fname = os.path.join(_cache["dir"], key + RENDER_SUFFIX)
+    try:
+        with open(cached_fname, "rb") as f:
+            content = f.read()
+        # Mark as recently used
+        os.utime(cached_fname)
+        LOG.debug(f"Using cached rendering {key}")
+        return content
+    except OSError:
+        return None
+
+def store(key, content):
+    """
+    Add a rendering to the cache
+
+    Failure to store the rendering (e.g. lack of disk space) is not an error.
+
+    :param key: Cache key from :func:`render_key`. If None nothing is stored
+    :param content: Rendering as bytes
+    """
+    if key is None:
+        return
+    cache_dir = _cache["dir"]
+    cached_fname = os.path.join(cache_dir, key + RENDER_SUFFIX)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        _write_atomic(cached_fname, content)
+        evict_lru(cache_dir, _cache["max_size"], cached_fname, suffixes=(RENDER_SUFFIX,))
+    except OSError as exc:
+        LOG.debug(f"Could not cache rendering {key}: {exc}")
+
+def cached_render(key, render):
+    """
+    Get a rendering from the cache, rendering and storing it if it is not there
+
+    :param key: Cache key from :func:`render_key`. If None the image is always rendered
+    :param render: Callable taking no arguments and returning the rendering as bytes
+    :return: Rendering as bytes
+    """
+    content = lookup(key)
+    if content is None:
+        content = render()
+        store(key, content)
+    return content
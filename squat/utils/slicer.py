@@ -0,0 +1,134 @@
+"""
+SQUAT: In-process orthogonal slice renderer
+
+Produces the same mid-sagittal, mid-coronal and mid-axial strip as FSL's
+``slicer -a`` directly from an in-memory array, without spawning a process
+or writing temporary NIfTI files
+
+Martin Craig, SPMIC, Nottingham
+"""
+import struct
+import zlib
+
+import numpy as np
+
+def _resample_axis(data, axis, zoom, unit):
+    """
+    Nearest-neighbour resample one axis of a 2D slice so each pixel has size ``unit``
+    """
+    num_in = data.shape[axis]
+    num_out = max(1, int(round(num_in * zoom / unit)))
+    if num_out == num_in:
+        return data
+    idx = np.minimum((np.arange(num_out) * unit / zoom).astype(int), num_in - 1)
+    return np.take(data, idx, axis=axis)
+
+def ortho_slices(vol, zooms=None):
+    """
+    Get the mid sagittal, coronal and axial slices of a volume, oriented for display
+
+    :param vol: 3D array. If 4D, the first volume is used
+    :param zooms: Optional voxel sizes. If given, slices are resampled so
+                  that displayed pixels are square
+    :return: List of 2D arrays (sagittal, coronal, axial)
+    """
+    vol = np.asanyarray(vol)
+    while vol.ndim > 3:
+        vol = vol[..., 0]
+    if vol.ndim != 3:
+        raise ValueError(f"Can only render slices from a 3D volume - got shape {vol.shape}")
+
+    mid = [int(n // 2) for n in vol.shape]
+    slices = [
+        (vol[mid[0], :, :], (1, 2)),
+        (vol[:, mid[1], :], (0, 2)),
+        (vol[:, :, mid[2]], (0, 1)),
+    ]
+
+    ret = []
+    for data, axes in slices:
+        if zooms is not None:
+            unit = min(zooms[:3])
+            for slice_axis, vol_axis in enumerate(axes):
+                data = _resample_axis(data, slice_axis, zooms[vol_axis], unit)
+        # Rotate so the second voxel axis runs up the page
+        ret.append(np.rot90(data))
+    return ret
+
+def slice_strip(vol, zooms=None, fill=0):
+    """
+    Combine orthogonal slices of a volume into a single horizontal strip
+
+    :param vol: 3D array
+    :param zooms: Optional voxel sizes
+    :param fill: Value used to pad slices to a common height
+    :return: 2D float array
+    """
+    slices = ortho_slices(vol, zooms)
+    height = max(s.shape[0] for s in slices)
+    padded = []
+    for s in slices:
+        pad_before = (height - s.shape[0]) // 2
+        pad_after = height - s.shape[0] - pad_before
+        padded.append(np.pad(s.astype(np.float32), ((pad_before, pad_after), (0, 0)), constant_values=fill))
+    return np.concatenate(padded, axis=1)
+
+def render_slices(vol, i=None, zooms=None):
+    """
+    Render orthogonal slices of a volume as an 8-bit greyscale strip
+
+    :param vol: 3D array
+    :param i: Tuple of (min, max) intensity window, as for FSL slicer ``-i``. If not
+              given, the robust range of the data is used
+    :param zooms: Optional voxel sizes
+    :return: 2D uint8 array
+    """
+    vol = np.asanyarray(vol)
+    if i is None:
+        finite = vol[np.isfinite(vol)]
+        if finite.size == 0:
+            i = (0, 1)
+        else:
+            i = tuple(np.percentile(finite, (2, 98)))
+    vmin, vmax = float(i[0]), float(i[1])
+    strip = slice_strip(vol, zooms, fill=vmin)
+    scale = 255.0 / (vmax - vmin) if vmax > vmin else 0.0
+    with np.errstate(invalid="ignore"):
+        scaled = np.clip((strip - vmin) * scale, 0, 255)
+    scaled[~np.isfinite(scaled)] = 0
+    return np.round(scaled).astype(np.uint8)
+
+def png_bytes(img):
+    """
+    Encode an 8-bit greyscale image as PNG
+
+    :param img: 2D uint8 array
+    :return: PNG file content as bytes
+    """
+    img = np.ascontiguousarray(img, dtype=np.uint8)
+    height, width = img.shape
+
+    def _chunk(tag, content):
+        chunk = tag + content
+        return struct.pack(">I", len(content)) + chunk + struct.pack(">I", zlib.crc32(chunk) & 0xffffffff)
+
+    # Each scanline is prefixed with filter type 0 (none)
+    raw = np.concatenate([np.zeros((height, 1), dtype=np.uint8), img], axis=1).tobytes()
+    return b"".join([
+        b"\x89PNG\r\n\x1a\n",
+        _chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)),
+        _chunk(b"IDAT", zlib.compress(raw, 6)),
+        _chunk(b"IEND", b""),
+    ])
+
+def save_slices(vol, fname, i=None, zooms=None):
+    """
+    Render orthogonal slices of a volume and save them as a PNG file
+
+    :param vol: 3D array
+    :param fname: Output PNG file name
+    :param i: Tuple of (min, max) intensity window
+    :param zooms: Optional voxel sizes
+    """
+    with open(fname, "wb") as f:
+        f.write(png_bytes(render_slices(vol, i, zooms)))